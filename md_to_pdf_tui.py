@@ -6,7 +6,11 @@ Added themes and png output to docx
 """
 
 import asyncio
+import base64
+import bisect
 import concurrent.futures
+import contextlib
+import importlib.util
 import json
 import os
 import subprocess
@@ -19,37 +23,25 @@ from typing import Optional
 import re
 import tempfile
 import uuid
-import urllib.request
+import urllib.parse
 import shutil
 import hashlib
-import webbrowser
-
-try:
-    from rich_pixels import Pixels
-    from PIL import Image
-    HAS_PIXELS = True
-except ImportError:
-    HAS_PIXELS = False
-
-# Textual imports (only if needed)
-try:
-    from textual.app import App, ComposeResult, events
-    from textual.containers import Container, Horizontal, Vertical, ScrollableContainer, VerticalScroll, Center
-    from textual.widgets import (
-        Button, Footer, Header, Input, Label, RichLog, Static, 
-        Select, Switch, ProgressBar, Rule, TabbedContent, TabPane, Markdown, TextArea, ContentSwitcher
-    )
-    from textual.binding import Binding
-    from textual.screen import ModalScreen
-    from textual import work
-    HAS_TEXTUAL = True
-except ImportError:
-    HAS_TEXTUAL = False
+import io
+from collections import OrderedDict
+
+# ⚡ Bolt: Heavy dependencies load on the code paths that use them. Textual,
+# rich_pixels and PIL only for the TUI, Playwright when a browser starts,
+# markdown-it on the first parse, so `--help` and headless runs start fast.
+# Availability is checked without importing anything.
+def _has_module(name: str) -> bool:
+    try:
+        return importlib.util.find_spec(name) is not None
+    except (ImportError, ValueError):
+        return False
 
-from playwright.async_api import async_playwright
-import markdown_it
-from mdit_py_plugins.front_matter import front_matter_plugin
-from mdit_py_plugins.footnote import footnote_plugin
+HAS_PIXELS = _has_module("rich_pixels") and _has_module("PIL")
+HAS_TEXTUAL = _has_module("textual")
+HAS_PIKEPDF = _has_module("pikepdf")
 
 # --- Constants ---
 CONFIG_DIR = Path.home() / ".md_to_pdf"
@@ -139,7 +131,37 @@ def load_settings() -> dict:
         "save_html": False, 
         "unlimited_height": True,
         "a4_fixed_width": True,
-        "save_diagrams": False
+        "save_diagrams": False,
+        "diagram_format": "png",
+        "png_dpi": 384,
+        "png_max_pixels": 16384,
+        "png_all_diagrams": False,
+        "stream_pdf": True,
+        "block_external": True,
+        "allowed_hosts": [],
+        "mermaid_worker": True,
+        "diagram_shards": 0,
+        "prewarm_browser": True,
+        "cpu_executor": "auto",
+        "process_pool_min_bytes": 2 << 20,
+        "pandoc_server": True,
+        "docx_diagrams": "png",
+        "batch_io_workers": 0,
+        "batch_cpu_workers": 0,
+        "batch_page_slots": 0,
+        "batch_pandoc_slots": 0,
+        "batch_optimize_slots": 0,
+        "spool_poll_seconds": 1.0,
+        "spool_heartbeat": 30,
+        "spool_stale_seconds": 300,
+        "min_concurrency": 1,
+        "max_concurrency": 0,
+        "render_job_memory_mb": 250,
+        "min_free_memory": 0.1,
+        "memory_budgets": {},
+        "pdf_optimize": False,
+        "pdf_image_quality": 80,
+        "pdf_linearize": True
     }
 
 def save_settings(settings: dict) -> None:
@@ -176,18 +198,197 @@ def open_folder_dialog() -> Optional[str]:
         return None
 
 # --- Regex Patterns ---
-# Regex for standard markdown images. Handles optional title: ![alt](url "title")
-MD_IMG_PATTERN = re.compile(r'!\[([^\]]*)\]\s*\(\s*([^\s)]+)(?:\s+["\'].*?["\'])?\s*\)')
-# Regex for HTML images
-HTML_IMG_PATTERN = re.compile(r'<img\s+[^>]*src=["\']([^"\']+)["\'][^>]*>')
-# Regex for Alerts
-ALERT_PATTERN = re.compile(r"^\s*>\s*\[!(NOTE|TIP|IMPORTANT|WARNING|CAUTION)\]", re.IGNORECASE)
-# Regex for Mermaid
-MERMAID_PATTERN = re.compile(r"^(?:`{3,}|~{3,})mermaid\s*\n(.*?)\n(?:`{3,}|~{3,})", re.DOTALL | re.MULTILINE)
-
-# Pre-compiled patterns for mermaid sanitization
-_MERMAID_STRING_PATTERN = re.compile(r'"((?:[^"\\]|\\.)*)"' + r"|'((?:[^'\\]|\\.)*)'", re.DOTALL)
-_MERMAID_LIST_MARKER_PATTERN = re.compile(r"(^|\n)(\s*)(?:([-*])|(\d+\.))\s+")
+# Closing quote of an image title, ![alt](url "title"), and the ")" after it
+_TITLE_CLOSE_PATTERN = re.compile(r"""["'](\s*)\)""")
+# Where an unquoted image url ends
+_URL_STOP_PATTERN = re.compile(r"[\s)]")
+# An HTML attribute name; anything else inside <img ...> is not a tag
+_ATTR_NAME_PATTERN = re.compile(r"[a-z_:][-a-z0-9_:.]*\Z")
+# Hand-written <div class="mermaid"> blocks in raw HTML
+_RAW_MERMAID_PATTERN = re.compile(r"""class\s*=\s*["'][^"']*\bmermaid\b""")
+# Indent, quote markers and list bullets in front of a nested block
+_BLOCK_PREFIX_PATTERN = re.compile(r"(?:[ \t>]|(?:[-*+]|\d{1,9}[.)])(?=[ \t]))*")
+# First line of a GitHub alert blockquote: [!NOTE], [!TIP], ...
+_ALERT_MARKER_PATTERN = re.compile(r"^\[!(NOTE|TIP|IMPORTANT|WARNING|CAUTION)\]", re.IGNORECASE)
+
+
+# --- Linear-Time Scanners ---
+# ⚡ Bolt: Images and diagram strings are found by hand-written scanners instead
+# of regexes over whole documents. With backtracking regexes, malformed input
+# (thousands of "![" without a "]", "<img" without a ">", unterminated quotes or
+# long blank runs in a diagram) retries a scan to the end of the text from
+# every start position, which is quadratic. Here every failed attempt is
+# remembered, so each character is examined a bounded number of times.
+
+def _skip_space(text: str, i: int) -> int:
+    n = len(text)
+    while i < n and text[i].isspace():
+        i += 1
+    return i
+
+def _scan_md_images(text: str) -> list:
+    """
+    Finds markdown images, ![alt](url) or ![alt](url "title"), in one pass.
+    Returns [(start, end, alt, url)]; alt runs to the first "]" and the title
+    (either quote style) must end on its line.
+    """
+    n = len(text)
+    results = []
+    close = -1 # Next "]", shared by every "![" before it
+    tails = {} # "]" position -> (end, url) or None
+    stop = -1 # Next ")" or whitespace after the latest url start; starts only move forward
+    title_ends = None
+    newlines = None
+
+    def _title_end(start: int) -> int:
+        # First closing quote + ")" at or after start on the same line, via bisect over precomputed positions
+        nonlocal title_ends, newlines
+        if title_ends is None:
+            title_ends = [(m.start(), m.end()) for m in _TITLE_CLOSE_PATTERN.finditer(text)]
+            newlines = [i for i, ch in enumerate(text) if ch == "\n"]
+        k = bisect.bisect_left(title_ends, (start, -1))
+        if k == len(title_ends):
+            return -1
+        quote, end = title_ends[k]
+        line_end = bisect.bisect_left(newlines, start)
+        if line_end < len(newlines) and newlines[line_end] < quote:
+            return -1
+        return end
+
+    def _tail(i: int):
+        # \s*\(\s*url(\s+"title")?\s*\) after the "]"
+        nonlocal stop
+        i = _skip_space(text, i)
+        if i >= n or text[i] != "(":
+            return None
+        start = _skip_space(text, i + 1)
+        if stop < start:
+            # "![a](![a](..." would otherwise rescan the same url run once per "]("
+            match = _URL_STOP_PATTERN.search(text, start)
+            stop = match.start() if match else n
+        i = stop
+        if i == start:
+            return None
+        url = text[start:i]
+        j = _skip_space(text, i)
+        if j < n and text[j] == ")":
+            return j + 1, url
+        if j > i and j < n and text[j] in "\"'":
+            end = _title_end(j + 1)
+            if end != -1:
+                return end, url
+        return None
+
+    pos = text.find("![")
+    while pos != -1:
+        if close < pos + 2:
+            close = text.find("]", pos + 2)
+            if close == -1:
+                break
+        if close not in tails:
+            tails[close] = _tail(close + 1)
+        tail = tails[close]
+        if tail is None:
+            pos = text.find("![", pos + 1)
+            continue
+        results.append((pos, tail[0], text[pos + 2:close], tail[1]))
+        pos = text.find("![", tail[0])
+    return results
+
+def _scan_html_images(text: str) -> list:
+    """
+    Finds the src of every <img ...> tag in one pass. Returns [(value start,
+    value end, url)]. Attributes are tokenized, so quoted values may contain
+    ">" and "data-src" is not "src"; the first src attribute wins. As with the
+    old pattern, the src value must be quoted; a tag holding junk or a nested
+    "<" outside quotes is not an image.
+    """
+    n = len(text)
+    # Attribute boundary -> (first src span at or after it, or None) once the tag
+    # closed, or False when it never does. Tags that share a tail share the work.
+    outcome = {}
+
+    def _attribute(i: int):
+        # Returns (next boundary, src span or None), "end", or None when the tag never closes
+        i = _skip_space(text, i)
+        if i >= n:
+            return None
+        if text[i] == ">":
+            return "end"
+        if text[i] == "/":
+            return i + 1, None
+        j = i + 1
+        while j < n and text[j] not in "=><" and not text[j].isspace():
+            j += 1
+        name = text[i:j].lower()
+        if not _ATTR_NAME_PATTERN.match(name):
+            return None
+        k = _skip_space(text, j)
+        if k >= n or text[k] != "=":
+            return j, None
+        v = _skip_space(text, k + 1)
+        if v >= n:
+            return None
+        if text[v] in "\"'":
+            close = text.find(text[v], v + 1)
+            if close == -1:
+                return None
+            span = (v + 1, close)
+            after = close + 1
+        else:
+            after = v
+            while after < n and text[after] not in "><" and not text[after].isspace():
+                after += 1
+            return after, None # Unquoted: never a src
+        if name != "src" or span[1] == span[0] or "'" in text[span[0]:span[1]] or '"' in text[span[0]:span[1]]:
+            return after, None
+        return after, span
+
+    def _tag(boundary: int):
+        path = []
+        result = False
+        while boundary not in outcome:
+            step = _attribute(boundary)
+            if step is None:
+                break
+            if step == "end":
+                result = None
+                break
+            path.append((boundary, step[1]))
+            boundary = step[0]
+        else:
+            result = outcome[boundary]
+        for b, src in reversed(path):
+            if result is not False and src is not None:
+                result = src
+            outcome[b] = result
+        if not path:
+            outcome[boundary] = result
+        return result
+
+    results = []
+    pos = text.find("<img")
+    while pos != -1:
+        if pos + 4 < n and text[pos + 4].isspace():
+            span = _tag(pos + 4)
+            if span:
+                results.append((span[0], span[1], text[span[0]:span[1]]))
+        pos = text.find("<img", pos + 4)
+    return results
+
+def _string_closers(code: str, quote: str) -> list:
+    """closers[i] is where a quote-delimited string whose content starts at i ends (backslash escapes), or -1."""
+    n = len(code)
+    closers = [-1] * (n + 2)
+    for i in range(n - 1, -1, -1):
+        ch = code[i]
+        if ch == quote:
+            closers[i] = i
+        elif ch == "\\":
+            closers[i] = closers[i + 2] if i + 1 < n else -1
+        else:
+            closers[i] = closers[i + 1]
+    return closers
 
 def process_resources(md_text: str, temp_dir: Path) -> str:
     """
@@ -216,7 +417,8 @@ def process_resources(md_text: str, temp_dir: Path) -> str:
                     req = urllib.request.Request(url, headers={'User-Agent': 'Mozilla/5.0'})
                     with urllib.request.urlopen(req, timeout=15) as response, open(local_path, 'wb') as out_file:
                         shutil.copyfileobj(response, out_file)
-                return url, local_filename
+                # Absolute, like local files, so it resolves whatever the page/pandoc base directory
+                return url, local_path.resolve().as_posix()
             except Exception:
                 return url, None
         else:
@@ -234,14 +436,16 @@ def process_resources(md_text: str, temp_dir: Path) -> str:
     # ⚡ Bolt: Using set comprehensions and union (|) is computationally faster than explicit
     # for loops with set.add() due to native C iteration, yielding measurable improvements
     # for documents containing a large number of resources.
-    urls = {match.group(2) for match in MD_IMG_PATTERN.finditer(md_text)} | \
-           {match.group(1) for match in HTML_IMG_PATTERN.finditer(md_text)}
+    md_images = _scan_md_images(md_text)
+    html_images = _scan_html_images(md_text)
+    urls = {url for _, _, _, url in md_images} | {url for _, _, url in html_images}
 
     # Optimization: Early return if no resources to process, avoiding expensive substitution passes
     if not urls:
         return md_text
 
     # 2. Process in parallel
+    import urllib.request
     url_map = {}
     if urls:
         with concurrent.futures.ThreadPoolExecutor(max_workers=min(32, len(urls) + 4)) as executor:
@@ -257,27 +461,21 @@ def process_resources(md_text: str, temp_dir: Path) -> str:
         # Optimization: No resources found, return early to avoid unnecessary regex substitution passes
         return md_text
 
-    # 3. Replace in text
-    def replace_link(match):
-        alt = match.group(1)
-        url = match.group(2)
-        local_name = url_map.get(url)
-        if local_name:
-            return f'![{alt}]({local_name})'
-        return match.group(0)
-
-    def replace_html_src(match):
-        url = match.group(1)
-        full_tag = match.group(0)
-        local_name = url_map.get(url)
-        if local_name:
-            return full_tag.replace(url, local_name)
-        return full_tag
-
-    new_text = MD_IMG_PATTERN.sub(replace_link, md_text)
-    new_text = HTML_IMG_PATTERN.sub(replace_html_src, new_text)
-
-    return new_text
+    # 3. Replace in text, in one pass over the scanned spans
+    replacements = [(start, end, f'![{alt}]({url_map[url]})') for start, end, alt, url in md_images if url in url_map]
+    replacements.extend((start, end, url_map[url]) for start, end, url in html_images if url in url_map)
+    replacements.sort(key=lambda rep: rep[0])
+
+    parts = []
+    last_end = 0
+    for start, end, text in replacements:
+        if start < last_end:
+            continue # An <img> inside a markdown image's alt text
+        parts.append(md_text[last_end:start])
+        parts.append(text)
+        last_end = end
+    parts.append(md_text[last_end:])
+    return "".join(parts)
 
 def is_pure_mermaid(text: str) -> bool:
     """
@@ -296,37 +494,171 @@ def is_pure_mermaid(text: str) -> bool:
 
     return stripped.endswith(suffix)
 
-# --- Core Conversion Logic (Decoupled from TUI) ---
-# --- Core Conversion Logic (Decoupled from TUI) ---
-def _mermaid_insert_space(m):
-    prefix = m.group(1) + m.group(2)
-    marker = m.group(3) if m.group(3) else m.group(4)
-    # Insert zero-width space to break the list marker pattern
-    return f"{prefix}{marker}&#8203; "
-
-def _mermaid_replacer(match):
-    if match.group(1) is not None:
-        content = match.group(1)
-        quote = '"'
-    else:
-        content = match.group(2)
-        quote = "'"
+# Bare diagram sources start with a diagram type declaration
+_BARE_MERMAID_PATTERN = re.compile(
+    r"(?:graph|flowchart)\s+(?:TB|TD|BT|RL|LR)\b.*"
+    r"|pie(?:\s+(?:showData|title\s.*))?"
+    r"|gitGraph(?:\s+(?:LR|TB|BT):?)?"
+    r"|(?:sequenceDiagram|classDiagram(?:-v2)?|stateDiagram(?:-v2)?|erDiagram|journey|gantt|mindmap|timeline"
+    r"|quadrantChart|requirementDiagram|C4Context|sankey-beta|xychart-beta|block-beta)\s*"
+)
+
+def extract_pure_mermaid(text: str) -> Optional[str]:
+    """
+    Returns the diagram source when text is exactly one Mermaid diagram, either
+    a single ```mermaid / ~~~mermaid fence or a bare diagram such as "graph TD ...".
+    Returns None for anything else.
+    """
+    stripped = text.strip()
+    if not stripped:
+        return None
 
-    new_content = _MERMAID_LIST_MARKER_PATTERN.sub(_mermaid_insert_space, content)
-    return f"{quote}{new_content}{quote}"
+    lines = stripped.split("\n")
+    opener = lines[0].strip()
+    for fence in ("```", "~~~"):
+        if opener.startswith(fence) and opener.lstrip(fence[0]).strip() == "mermaid":
+            closer = lines[-1].strip()
+            if len(lines) < 2 or not closer.startswith(fence) or closer.strip(fence[0]):
+                return None
+            body = lines[1:-1]
+            # A second fence inside means more than one block
+            if any(l.strip().startswith(fence) for l in body):
+                return None
+            return "\n".join(body) + "\n"
+
+    if _BARE_MERMAID_PATTERN.fullmatch(opener) and "```" not in stripped and "~~~" not in stripped:
+        return stripped + "\n"
+    return None
+
+# --- Core Conversion Logic (Decoupled from TUI) ---
+def _break_list_markers(content: str) -> str:
+    """
+    Inserts a zero-width space after list markers (-, *, 1.) that start a line
+    of a quoted diagram string. Blank runs are skipped as a whole, so a string
+    of nothing but newlines costs one pass.
+    """
+    n = len(content)
+    parts = []
+    last = 0
+    anchor = 0
+    while anchor != -1:
+        start = _skip_space(content, anchor)
+        marker_end = start
+        if start < n and content[start] in "-*":
+            marker_end = start + 1
+        else:
+            while marker_end < n and content[marker_end].isdecimal():
+                marker_end += 1
+            marker_end = marker_end + 1 if start < marker_end < n and content[marker_end] == "." else start
+        if start < marker_end < n and content[marker_end].isspace():
+            parts.append(content[last:marker_end])
+            parts.append("&#8203; ")
+            last = anchor = _skip_space(content, marker_end)
+        else:
+            anchor = start # Every newline before start leads to the same failed match
+        anchor = content.find("\n", anchor)
+    if not parts:
+        return content
+    parts.append(content[last:])
+    return "".join(parts)
 
 def sanitize_mermaid_code(code: str) -> str:
     """
     Sanitizes mermaid code to prevent "Unsupported markdown" errors in nodes.
     Specifically handles list markers (-, *, 1.) inside quoted strings.
+    Strings are found in linear time: where each string would end is
+    precomputed once, so unterminated quotes cost no rescans.
     """
-    return _MERMAID_STRING_PATTERN.sub(_mermaid_replacer, code)
+    closers = {q: _string_closers(code, q) for q in "\"'" if q in code}
+    if not closers:
+        return code
+    parts = []
+    last = i = 0
+    n = len(code)
+    next_quote = {q: code.find(q) for q in closers}
+    while True:
+        for q in closers:
+            if next_quote[q] != -1 and next_quote[q] < i:
+                next_quote[q] = code.find(q, i)
+        found = [p for p in next_quote.values() if p != -1]
+        if not found:
+            break
+        i = min(found)
+        quote = code[i]
+        close = closers[quote][i + 1] if i + 1 < n else -1
+        if close == -1:
+            i += 1 # Unterminated: the quote stays as is
+            continue
+        parts.append(code[last:i])
+        parts.append(f"{quote}{_break_list_markers(code[i + 1:close])}{quote}")
+        last = i = close + 1
+    parts.append(code[last:])
+    return "".join(parts)
 
 _MD_PARSER = None
 _PANDOC_AVAILABLE = None
 
 _playwright_instance = None
 _browser_instance = None
+_browser_lock = None
+
+# --- Rendering Profile ---
+# Launch flags tuned for headless batch printing: no background services,
+# no throttling of hidden renderers and deterministic font rasterization.
+CHROMIUM_LAUNCH_ARGS = [
+    "--disable-extensions",
+    "--disable-background-networking",
+    "--disable-component-update",
+    "--disable-default-apps",
+    "--disable-sync",
+    "--disable-domain-reliability",
+    "--disable-breakpad",
+    "--disable-client-side-phishing-detection",
+    "--disable-background-timer-throttling",
+    "--disable-backgrounding-occluded-windows",
+    "--disable-renderer-backgrounding",
+    "--metrics-recording-only",
+    "--mute-audio",
+    "--no-first-run",
+    "--hide-scrollbars",
+    "--font-render-hinting=none",
+]
+MERMAID_JS_URL = "https://cdn.jsdelivr.net/npm/mermaid@11.4.1/dist/mermaid.min.js"
+# Hosts a render page may always reach (the Mermaid bundle)
+DEFAULT_ALLOWED_HOSTS = ("cdn.jsdelivr.net",)
+_LOCAL_SCHEMES = ("file", "data", "blob", "about")
+
+def _make_request_filter(allowed_hosts: set):
+    async def _filter(route):
+        url = route.request.url
+        if url.split(":", 1)[0] in _LOCAL_SCHEMES or urllib.parse.urlsplit(url).hostname in allowed_hosts:
+            await route.continue_()
+        else:
+            await route.abort("blockedbyclient")
+    return _filter
+
+async def _new_render_page(browser, settings: Optional[dict], needs_js: bool = True, **page_opts):
+    """
+    Opens a page with the rendering profile applied.
+    JavaScript is only enabled when the document needs the Mermaid runtime, and
+    requests to hosts outside the allowlist are aborted instead of fetched, so
+    an unreachable <img>/<link> host can no longer stall a render.
+    Set "block_external" to False to allow all requests; "allowed_hosts" extends the allowlist.
+    """
+    settings = settings or {}
+    page = await browser.new_page(java_script_enabled=needs_js, **page_opts)
+    if settings.get("block_external", True):
+        allowed = set(DEFAULT_ALLOWED_HOSTS) | set(settings.get("allowed_hosts", []))
+        await page.route("**/*", _make_request_filter(allowed))
+    return page
+
+def _needs_mermaid_runtime(md_text: str, settings: dict, diagram_svgs: Optional[dict] = None) -> bool:
+    doc = parse_document(md_text)
+    if doc.raw_mermaid:
+        return True
+    if not settings.get("mermaid_enabled", True) or not doc.diagrams:
+        return False
+    return not diagram_svgs or len(diagram_svgs) < len(doc.diagrams)
 
 async def _get_browser():
     """
@@ -335,10 +667,18 @@ async def _get_browser():
     instance alive during the application's lifecycle, we eliminate this startup latency
     for subsequent PDF/PNG/DOCX generations, improving batch and repeated export speeds.
     """
-    global _playwright_instance, _browser_instance
-    if _browser_instance is None:
+    global _playwright_instance, _browser_instance, _browser_lock
+    if _browser_instance is not None:
+        return _browser_instance
+    # Concurrent first callers (e.g. the TUI pre-warm and an export) share one launch
+    if _browser_lock is None:
+        _browser_lock = asyncio.Lock()
+    async with _browser_lock:
+        if _browser_instance is not None:
+            return _browser_instance
+        from playwright.async_api import async_playwright
         _playwright_instance = await async_playwright().start()
-        _browser_instance = await _playwright_instance.chromium.launch()
+        _browser_instance = await _playwright_instance.chromium.launch(args=CHROMIUM_LAUNCH_ARGS)
 
         # Register exit handler to clean up the browser process
         import atexit
@@ -356,23 +696,488 @@ async def _get_browser():
 
     return _browser_instance
 
+ALERT_ICONS = {"NOTE": "ℹ️", "TIP": "💡", "IMPORTANT": "📢", "WARNING": "⚠️", "CAUTION": "🛑"}
+
+def _alert_colors(theme_name: str) -> dict:
+    """Accent color per alert type, with brighter variants for dark themes."""
+    if any(k in theme_name for k in ("Dark", "Dracula", "Cyberpunk", "Obsidian", "Monokai")):
+        return {"NOTE": "#58a6ff", "TIP": "#3fb950", "IMPORTANT": "#a371f7", "WARNING": "#d29922", "CAUTION": "#f85149"}
+    return {"NOTE": "#0969da", "TIP": "#1f883d", "IMPORTANT": "#8250df", "WARNING": "#bf8700", "CAUTION": "#cf222e"}
+
+def _alert_css(theme_name: str) -> str:
+    t_data = THEMES.get(theme_name, THEMES["GitHub Light"])
+    rules = [f".markdown-alert {{ padding: 8px 16px; margin: 16px 0; border-left: 5px solid {t_data['brd']}; border-radius: 6px; background: {t_data['secondary']}; }}",
+             ".markdown-alert > :last-child { margin-bottom: 0; }",
+             ".markdown-alert-title { font-weight: bold; margin: 0 0 4px; }"]
+    for kind, color in _alert_colors(theme_name).items():
+        rules.append(f".markdown-alert-{kind.lower()} {{ border-left-color: {color}; }} .markdown-alert-{kind.lower()} .markdown-alert-title {{ color: {color}; }}")
+    return "\n".join(rules)
+
+def _block_prefix(text: str, start: int, own_quote: bool = False) -> str:
+    """
+    The container markers (indent, ">" and list bullets) in front of the block
+    whose first line starts at text[start], so the block's DOCX replacement
+    stays in its list or quote. own_quote drops the last ">", which belongs to
+    the block itself (an alert).
+    """
+    prefix = _BLOCK_PREFIX_PATTERN.match(text, start).group(0)
+    if own_quote and ">" in prefix:
+        prefix = prefix[:prefix.rindex(">")]
+    return prefix
+
+def _alert_table_html(kind: str, body_html: str, theme_name: str) -> str:
+    """Alert as a single-line HTML table, the form pandoc carries into DOCX."""
+    t_data = THEMES.get(theme_name, THEMES["GitHub Light"])
+    color = _alert_colors(theme_name).get(kind, "#0969da")
+    body_html = " ".join(line.strip() for line in body_html.splitlines() if line.strip())
+    return (f'<table style="width:100%; border-left: 5px solid {color}; background-color: {t_data["secondary"]}; margin-bottom: 10px;">'
+            f'<tr><td style="padding: 10px; color: {t_data["txt"]};"><strong>{ALERT_ICONS.get(kind, "")} {kind} - </strong><br/>{body_html}</td></tr></table>')
+
+def _alert_rule(state) -> None:
+    """
+    Core rule run right after block parsing: turns blockquotes that open with
+    [!NOTE], [!TIP], [!IMPORTANT], [!WARNING] or [!CAUTION] into alert_open /
+    alert_close tokens and strips the marker before inline parsing.
+    """
+    tokens = state.tokens
+    i = 0
+    while i < len(tokens):
+        t = tokens[i]
+        if t.type == "blockquote_open" and i + 2 < len(tokens) and tokens[i + 1].type == "paragraph_open":
+            marker = _ALERT_MARKER_PATTERN.match(tokens[i + 2].content)
+            if marker:
+                close = next(j for j in range(i + 1, len(tokens)) if tokens[j].type == "blockquote_close" and tokens[j].level == t.level)
+                t.type, t.tag, t.meta = "alert_open", "div", {"alert": marker.group(1).upper()}
+                tokens[close].type, tokens[close].tag = "alert_close", "div"
+                rest = tokens[i + 2].content[marker.end():].lstrip(" \t")
+                if rest.strip():
+                    tokens[i + 2].content = rest[1:] if rest.startswith("\n") else rest
+                else:
+                    del tokens[i + 1:i + 4] # Marker-only paragraph
+        i += 1
+
 def _get_md_parser():
     global _MD_PARSER
     if _MD_PARSER is None:
+        import markdown_it
+        from mdit_py_plugins.front_matter import front_matter_plugin
+        from mdit_py_plugins.footnote import footnote_plugin
         _MD_PARSER = markdown_it.MarkdownIt().use(front_matter_plugin).use(footnote_plugin).enable("table")
 
         def mf(tokens, idx, options, env):
             t = tokens[idx]
             m_enabled = env.get("mermaid_enabled", True) if env else True
             if t.info.strip() == "mermaid" and m_enabled:
+                svgs = env.get("mermaid_svgs")
+                if svgs and t.meta.get("diagram_index") in svgs:
+                    # Pre-rendered by the MermaidRenderer worker; no runtime needed
+                    return f'<div class="m-wrap"><div class="mermaid" data-processed="true">{svgs[t.meta["diagram_index"]]}</div></div>'
                 content = sanitize_mermaid_code(t.content)
                 return f'<div class="m-wrap"><div class="mermaid">{content}</div></div>'
             return f"<pre><code>{t.content}</code></pre>"
 
         _MD_PARSER.renderer.rules["fence"] = mf
+
+        # GitHub alerts: recognized once in the parse, rendered as styled divs
+        _MD_PARSER.core.ruler.after("block", "github_alerts", _alert_rule)
+        def alert_open(tokens, idx, options, env):
+            kind = tokens[idx].meta["alert"]
+            return f'<div class="markdown-alert markdown-alert-{kind.lower()}"><p class="markdown-alert-title">{ALERT_ICONS[kind]} {kind.title()}</p>\n'
+        _MD_PARSER.renderer.rules["alert_open"] = alert_open
+        _MD_PARSER.renderer.rules["alert_close"] = lambda tokens, idx, options, env: "</div>\n"
     return _MD_PARSER
 
-def create_html_content(md_text: str, settings: dict) -> str:
+_NEWLINE_PATTERN = re.compile(r"\r\n?|\n")
+
+class ParsedDocument:
+    """
+    A markdown document parsed once into a markdown-it token stream.
+    This is the document profile every stage consumes: front matter, diagrams
+    (sources and spans), image references, alerts, raw Mermaid HTML and size,
+    all collected in one walk over the tokens. It also renders the HTML body
+    from the cached tokens, so PDF, PNG, DOCX capture, gallery themes and
+    previews all share a single parse.
+    """
+
+    def __init__(self, md_text: str, source_hash: Optional[str] = None):
+        self.source = md_text
+        self.source_hash = source_hash or _hash_text(md_text)
+        self.size = len(md_text)
+        self.env = {}
+        self.tokens = _get_md_parser().parse(md_text, self.env)
+        self.front_matter = ""
+        self.diagrams = []  # Mermaid sources, in document order
+        self.diagram_lines = []  # (first line, end line) of each diagram fence
+        self.images = []  # Image URLs (markdown and inline HTML), in document order
+        self.alerts = []  # (TYPE, first line, end line) of each GitHub alert
+        self._alert_tokens = []  # (alert_open index, alert_close index), parallel to alerts
+        self.raw_mermaid = False  # Hand-written class="mermaid" HTML
+        self._line_starts = None
+        self._spans = None
+        self._bodies = {}
+        self._extract_metadata()
+
+    def _extract_metadata(self) -> None:
+        tokens = self.tokens
+        open_alerts = []
+        for i, t in enumerate(tokens):
+            if t.type == "front_matter":
+                self.front_matter = t.content
+            elif t.type == "fence" and t.info.strip() == "mermaid":
+                t.meta["diagram_index"] = len(self.diagrams)
+                self.diagrams.append(t.content)
+                self.diagram_lines.append(tuple(t.map))
+            elif t.type == "alert_open":
+                open_alerts.append(len(self.alerts))
+                self.alerts.append((t.meta["alert"], t.map[0], t.map[1]))
+                self._alert_tokens.append([i, None])
+            elif t.type == "alert_close":
+                self._alert_tokens[open_alerts.pop()][1] = i
+            elif t.type == "html_block":
+                self.images.extend(url for _, _, url in _scan_html_images(t.content))
+                self.raw_mermaid = self.raw_mermaid or bool(_RAW_MERMAID_PATTERN.search(t.content))
+            elif t.type == "inline" and t.children:
+                for child in t.children:
+                    if child.type == "image":
+                        self.images.append(child.attrGet("src"))
+                    elif child.type == "html_inline":
+                        self.images.extend(url for _, _, url in _scan_html_images(child.content))
+                        self.raw_mermaid = self.raw_mermaid or bool(_RAW_MERMAID_PATTERN.search(child.content))
+
+    @property
+    def has_mermaid(self) -> bool:
+        return bool(self.diagrams) or self.raw_mermaid
+
+    def _line_span(self, first: int, end: int) -> tuple:
+        """Character (start, end) of source lines [first, end), excluding the final newline."""
+        if self._line_starts is None:
+            self._line_starts = [0]
+            self._line_starts.extend(m.end() for m in re.finditer("\n", self.source))
+        starts = self._line_starts
+        start = starts[first]
+        stop = starts[end] - 1 if end < len(starts) else len(self.source)
+        return start, max(start, stop)
+
+    @property
+    def diagram_spans(self) -> list:
+        """Character (start, end) of each diagram fence, excluding the final newline."""
+        if self._spans is None:
+            self._spans = [self._line_span(a, b) for a, b in self.diagram_lines]
+        return self._spans
+
+    def alert_blocks(self) -> list:
+        """[(TYPE, start, end, body HTML)] per alert: the character span of its source and its rendered content."""
+        it = _get_md_parser()
+        env = dict(self.env)
+        env["mermaid_enabled"] = False
+        blocks = []
+        for (kind, first, end), (open_idx, close_idx) in zip(self.alerts, self._alert_tokens):
+            body = it.renderer.render(self.tokens[open_idx + 1:close_idx], it.options, env)
+            blocks.append((kind, *self._line_span(first, end), body))
+        return blocks
+
+    def render_body(self, mermaid_enabled: bool = True, diagram_svgs: Optional[dict] = None) -> str:
+        """
+        Renders the HTML body from the cached tokens. The plain body is theme
+        independent and cached; diagram_svgs ({diagram index: SVG}) inlines
+        pre-rendered diagrams, which are themed, so that variant is not cached.
+        """
+        body = None if diagram_svgs else self._bodies.get(mermaid_enabled)
+        if body is None:
+            it = _get_md_parser()
+            env = dict(self.env)
+            env["mermaid_enabled"] = mermaid_enabled
+            if diagram_svgs:
+                env["mermaid_svgs"] = diagram_svgs
+                return it.renderer.render(self.tokens, it.options, env)
+            body = it.renderer.render(self.tokens, it.options, env)
+            self._bodies[mermaid_enabled] = body
+        return body
+
+class IncrementalRenderer:
+    """
+    Block-level memoized HTML renderer for documents that are rendered over and
+    over while being edited (browser preview, TUI diagram render).
+    The token stream is split into top-level blocks; each block is keyed by its
+    source lines plus the context that can change its output (reference link
+    definitions, footnote numbering, the mermaid flag). Blocks with an unchanged
+    key reuse their cached fragment, so the output is byte-identical to
+    ParsedDocument.render_body() while only edited blocks are re-rendered.
+    Safe to share between threads; renders through one instance take turns.
+    """
+
+    def __init__(self):
+        self._fragments = {}
+        self._lock = threading.Lock()
+        self.last_misses = 0  # Blocks re-rendered by the most recent call
+
+    @staticmethod
+    def _blocks(tokens):
+        """Yields (start, end) slices of the top-level blocks in a token stream."""
+        start, depth = 0, 0
+        for i, t in enumerate(tokens):
+            depth += t.nesting
+            if depth == 0:
+                yield start, i + 1
+                start = i + 1
+
+    def render(self, doc: "ParsedDocument", mermaid_enabled: bool = True, diagram_svgs: Optional[dict] = None) -> str:
+        with self._lock:
+            return self._render(doc, mermaid_enabled, diagram_svgs)
+
+    def _render(self, doc: "ParsedDocument", mermaid_enabled: bool, diagram_svgs: Optional[dict]) -> str:
+        it = _get_md_parser()
+        env = dict(doc.env)
+        env["mermaid_enabled"] = mermaid_enabled
+        if diagram_svgs:
+            env["mermaid_svgs"] = diagram_svgs
+        lines = _NEWLINE_PATTERN.split(doc.source)
+        refs = env.get("references") or {}
+        refs_key = repr(sorted((k, v.get("href"), v.get("title")) for k, v in refs.items()))
+
+        parts = []
+        fragments = {}
+        self.last_misses = 0
+        for start, end in self._blocks(doc.tokens):
+            block = doc.tokens[start:end]
+            if block[0].map is None:
+                # Generated blocks (footnote list) depend on the whole document
+                parts.append(it.renderer.render(block, it.options, env))
+                self.last_misses += 1
+                continue
+
+            src = "\n".join(lines[block[0].map[0]:block[0].map[1]])
+            if block[0].map[1] < len(lines):
+                src += "\n" # A block at the very end keeps no trailing newline in its content
+            # The renderer opens a block that follows a hidden one (front matter) with a newline
+            after_hidden = start > 0 and doc.tokens[start - 1].hidden
+            ctx = [str(mermaid_enabled), str(after_hidden)]
+            if diagram_svgs and block[0].meta.get("diagram_index") in diagram_svgs:
+                ctx.append(_hash_text(diagram_svgs[block[0].meta["diagram_index"]]))
+            if "[" in src:
+                ctx.append(refs_key)
+            if "[^" in src or "^[" in src:
+                ctx.extend(
+                    f"{c.meta.get('id')}:{c.meta.get('subId')}"
+                    for t in block if t.children
+                    for c in t.children if c.type == "footnote_ref"
+                )
+            key = (tuple(ctx), src)
+
+            html = self._fragments.get(key)
+            if html is None:
+                html = fragments.get(key)
+            if html is None:
+                html = it.renderer.render(doc.tokens[start - 1:end] if after_hidden else block, it.options, env)
+                self.last_misses += 1
+            fragments[key] = html
+            parts.append(html)
+
+        # Keep only the fragments of the latest version to bound memory
+        self._fragments = fragments
+        return "".join(parts)
+
+_DOC_CACHE: "OrderedDict[str, ParsedDocument]" = OrderedDict()
+_DOC_CACHE_MAX = 16
+_DOC_CACHE_LOCK = threading.Lock()
+
+def _hash_text(text: str) -> str:
+    return hashlib.md5(text.encode("utf-8")).hexdigest()
+
+def parse_document(md_text: str) -> ParsedDocument:
+    """
+    ⚡ Bolt: Returns the ParsedDocument for md_text, parsing it only once per source hash.
+    Parsing dominates CPU time on large documents and the same text is rendered for
+    PDF, DOCX diagram capture, every gallery theme and previews; a small LRU keeps
+    the token stream around so each of those renders reuses one parse.
+    """
+    key = _hash_text(md_text)
+    with _DOC_CACHE_LOCK:
+        doc = _DOC_CACHE.get(key)
+        if doc is not None:
+            _DOC_CACHE.move_to_end(key)
+            return doc
+
+    doc = ParsedDocument(md_text, key)
+    with _DOC_CACHE_LOCK:
+        _DOC_CACHE[key] = doc
+        while len(_DOC_CACHE) > _DOC_CACHE_MAX:
+            _DOC_CACHE.popitem(last=False)
+    return doc
+
+def _mermaid_theme_css(t_data: dict, scope: str = ".mermaid ") -> str:
+    """Theme overrides for rendered diagrams; scope prefixes every selector."""
+    return f'''/* Dynamic Mermaid Overrides from Theme */
+{scope}.node rect, {scope}.node circle, {scope}.node polygon, {scope}.node path, {scope}.cluster rect {{ stroke: {t_data['line']} !important; stroke-width: 2px !important; fill: {t_data['bg']} !important; }}
+{scope}.edgePath path {{ stroke: {t_data['line']} !important; stroke-width: 2px !important; }}
+{scope}.label {{ color: {t_data['primary']} !important; }}
+{scope}.arrowheadPath {{ fill: {t_data['line']} !important; }}'''
+
+# --- CPU Executors ---
+_CPU_THREADS = None
+_CPU_PROCESSES = None
+
+def _cpu_executor(settings: Optional[dict] = None, size: int = 0):
+    """
+    Executor for the CPU-bound stages (parsing, HTML generation, DOCX rewrites).
+    "cpu_executor" picks it: "thread" uses a dedicated thread pool, "process" a
+    process pool, and "auto" (default) switches to processes for inputs of at
+    least "process_pool_min_bytes", where the GIL would serialize concurrent jobs.
+    """
+    global _CPU_THREADS, _CPU_PROCESSES
+    settings = settings or {}
+    mode = settings.get("cpu_executor", "auto")
+    if mode == "process" or (mode == "auto" and size >= int(settings.get("process_pool_min_bytes", 2 << 20))):
+        if _CPU_PROCESSES is None:
+            import multiprocessing
+            # Spawned workers import this module lazily, without the TUI or browser stack
+            _CPU_PROCESSES = concurrent.futures.ProcessPoolExecutor(max_workers=min(4, os.cpu_count() or 1), mp_context=multiprocessing.get_context("spawn"))
+        return _CPU_PROCESSES
+    if _CPU_THREADS is None:
+        _CPU_THREADS = concurrent.futures.ThreadPoolExecutor(max_workers=min(8, (os.cpu_count() or 1) + 2), thread_name_prefix="md2pdf-cpu")
+    return _CPU_THREADS
+
+async def run_cpu(fn, *args, settings: Optional[dict] = None, size: int = 0):
+    """
+    ⚡ Bolt: Runs a CPU-bound stage off the event loop, so a multi-MB document
+    no longer freezes the TUI or stalls the other renders of a gallery/batch run.
+    Process-pool jobs must be picklable module-level functions; a broken pool
+    falls back to the thread pool.
+    """
+    global _CPU_PROCESSES
+    loop = asyncio.get_running_loop()
+    executor = _cpu_executor(settings, size)
+    try:
+        return await loop.run_in_executor(executor, fn, *args)
+    except concurrent.futures.process.BrokenProcessPool:
+        if executor is not _CPU_PROCESSES:
+            raise
+        _CPU_PROCESSES = None
+        return await loop.run_in_executor(_cpu_executor({"cpu_executor": "thread"}), fn, *args)
+
+# --- Adaptive Concurrency ---
+def _host_pressure() -> tuple:
+    """
+    Returns (run-queue load per CPU, fraction of memory available) for the host.
+    Either value is None where the platform does not expose it.
+    """
+    load = None
+    try:
+        load = os.getloadavg()[0] / (os.cpu_count() or 1)
+    except (AttributeError, OSError):
+        pass
+    free = None
+    try:
+        info = {}
+        with open("/proc/meminfo") as f:
+            for line in f:
+                key, value = line.split(":", 1)
+                info[key] = int(value.split()[0])
+        free = info["MemAvailable"] / info["MemTotal"]
+    except (OSError, KeyError, ValueError, ZeroDivisionError):
+        pass
+    return load, free
+
+def _available_memory_mb() -> Optional[float]:
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) / 1024
+    except (OSError, ValueError):
+        pass
+    return None
+
+class ConcurrencyController:
+    """
+    ⚡ Bolt: Sets the number of in-flight renders the way TCP congestion control
+    sets its window, instead of a fixed semaphore. The limit starts small and
+    grows by one per finished job (slow start) up to a threshold, then by about
+    one per round of jobs (additive increase). It is halved (multiplicative
+    decrease) when a job signals congestion: the host run queue exceeds its
+    CPUs, available memory drops below "min_free_memory" (Chromium OOMs on
+    small runners otherwise), or a job takes "latency_factor" times longer than
+    the fastest one seen. Hard bounds come from "min_concurrency" and
+    "max_concurrency" (0 = CPUs x 2, further capped by available memory divided
+    by "render_job_memory_mb").
+    """
+
+    def __init__(self, settings: Optional[dict] = None, probe=_host_pressure):
+        settings = settings or {}
+        cpus = os.cpu_count() or 1
+        self.min_limit = max(1, int(settings.get("min_concurrency", 1)))
+        max_limit = int(settings.get("max_concurrency", 0))
+        if max_limit <= 0:
+            max_limit = cpus * 2
+            mem_mb = _available_memory_mb()
+            if mem_mb is not None:
+                max_limit = min(max_limit, int(mem_mb // max(1, int(settings.get("render_job_memory_mb", 250)))))
+        self.max_limit = max(self.min_limit, max_limit)
+        self.min_free = float(settings.get("min_free_memory", 0.1))
+        self.latency_factor = float(settings.get("latency_factor", 3.0))
+        self.probe = probe
+        self.limit = float(min(self.max_limit, max(self.min_limit, 2)))
+        self.threshold = float(self.max_limit)
+        self.in_flight = 0
+        self.best_latency = None
+        self._cond = None
+
+    def _congested(self, latency: float) -> bool:
+        load, free = self.probe()
+        if load is not None and load > 1.0:
+            return True
+        if free is not None and free < self.min_free:
+            return True
+        return self.best_latency is not None and latency > self.best_latency * self.latency_factor
+
+    def record(self, latency: float) -> None:
+        """Feeds back the latency of one finished job and adjusts the limit."""
+        if self._congested(latency):
+            self.threshold = max(float(self.min_limit), self.limit / 2)
+            self.limit = self.threshold
+        elif self.limit < self.threshold:
+            self.limit += 1
+        else:
+            self.limit += 1 / self.limit
+        self.limit = min(float(self.max_limit), max(float(self.min_limit), self.limit))
+        self.best_latency = latency if self.best_latency is None else min(self.best_latency, latency)
+
+    async def acquire(self) -> None:
+        if self._cond is None:
+            self._cond = asyncio.Condition()
+        async with self._cond:
+            await self._cond.wait_for(lambda: self.in_flight < int(self.limit))
+            self.in_flight += 1
+
+    async def release(self, latency: Optional[float] = None) -> None:
+        if latency is not None:
+            self.record(latency)
+        async with self._cond:
+            self.in_flight -= 1
+            self._cond.notify_all()
+
+    @contextlib.asynccontextmanager
+    async def slot(self, cost: float = 1.0):
+        """
+        Holds one render slot; the time spent inside, per unit of cost (e.g.
+        input size), feeds the controller. Failed jobs are not measured.
+        """
+        import time
+        await self.acquire()
+        started = time.perf_counter()
+        latency = None
+        try:
+            yield
+            latency = (time.perf_counter() - started) / max(cost, 1e-9)
+        finally:
+            await self.release(latency)
+
+def create_html_content(md_text: str, settings: dict, renderer: Optional[IncrementalRenderer] = None, diagram_svgs: Optional[dict] = None) -> str:
+    """
+    Builds the themed HTML page for md_text. diagram_svgs ({diagram index: SVG}
+    from prerender_diagrams) inlines pre-rendered diagrams; when every diagram
+    is inlined the page carries no Mermaid runtime at all.
+    """
     theme_name = settings.get("theme", "GitHub Light")
     # Fallback if theme name not found
     if theme_name not in THEMES: theme_name = "GitHub Light"
@@ -381,8 +1186,11 @@ def create_html_content(md_text: str, settings: dict) -> str:
     c_width = int(settings.get("content_width", 800))
     m_enabled = settings.get("mermaid_enabled", True)
     
-    it = _get_md_parser()
-    body = it.render(md_text, env={"mermaid_enabled": m_enabled})
+    doc = parse_document(md_text)
+    if renderer:
+        body = renderer.render(doc, m_enabled, diagram_svgs)
+    else:
+        body = doc.render_body(m_enabled, diagram_svgs)
     
     # Configure Mermaid Theme based on our palette
     m_theme_init = f'''theme: "base",
@@ -397,16 +1205,18 @@ def create_html_content(md_text: str, settings: dict) -> str:
             
     # ⚡ Bolt: Conditionally inject Mermaid.js only when the document contains mermaid
     # This prevents loading a large JS library for documents without diagrams, speeding up rendering.
+    # The profile knows the actual diagrams, so "mermaid" in prose or code no longer triggers it.
     mermaid_script = ""
-    if "mermaid" in body.lower():
-        mermaid_script = f'''<script src="https://cdn.jsdelivr.net/npm/mermaid@11.4.1/dist/mermaid.min.js"></script>
+    all_inlined = bool(diagram_svgs) and len(diagram_svgs) >= len(doc.diagrams)
+    if doc.raw_mermaid or (m_enabled and doc.diagrams and not all_inlined):
+        mermaid_script = f'''<script src="{MERMAID_JS_URL}"></script>
 <script>
 mermaid.initialize({{ 
     startOnLoad: true, 
     {m_theme_init},
     maxTextSize: 10000000,
     maxNodes: 10000,
-    flowchart: {{ useMaxWidth: false, htmlLabels: true, curve: "linear" }},
+    flowchart: {{ useMaxWidth: false, htmlLabels: {"true" if settings.get("mermaid_html_labels", True) else "false"}, curve: "linear" }},
     securityLevel: "loose"
 }});
 </script>'''
@@ -423,43 +1233,800 @@ th, td {{ border: 1px solid {t_data['brd']}; padding: 8px 12px; text-align: left
 th {{ background: {t_data['code']}; font-weight: bold; }}
 .m-wrap {{ width: 100%; margin: 32px 0; background: {t_data['code']}; border-radius: 8px; padding: 20px; border: 2px solid {t_data['brd']}; box-sizing: border-box; }}
 .mermaid svg {{ width: 100% !important; height: auto !important; }}
-/* Dynamic Mermaid Overrides from Theme */
-.mermaid .node rect, .mermaid .node circle, .mermaid .node polygon, .mermaid .node path, .mermaid .cluster rect {{ stroke: {t_data['line']} !important; stroke-width: 2px !important; fill: {t_data['bg']} !important; }}
-.mermaid .edgePath path {{ stroke: {t_data['line']} !important; stroke-width: 2px !important; }}
-.mermaid .label {{ color: {t_data['primary']} !important; }}
-.mermaid .arrowheadPath {{ fill: {t_data['line']} !important; }}
+{_mermaid_theme_css(t_data)}
+{_alert_css(theme_name)}
 .mermaid-error {{ background: #fee2e2 !important; color: #991b1b !important; border: 2px solid #ef4444 !important; padding: 20px !important; margin: 20px 0 !important; font-family: monospace !important; border-radius: 8px !important; white-space: pre-wrap !important; }}
 </style></head><body><div id="canvas">{body}</div></body></html>'''
 
-async def generate_pdf_core(md_path: Path, pdf_path: Path, settings: dict, log_fn=print, prog_fn=None, browser=None) -> None:
-    u_height = settings.get("unlimited_height", True)
-    a4_width = settings.get("a4_fixed_width", True)
+def _mermaid_config(theme_name: str, html_labels: bool = True) -> dict:
+    """
+    Mermaid configuration for a theme; mirrors the in-page initialize() call.
+    html_labels=False draws flowchart labels as SVG text instead of HTML in a
+    <foreignObject>, which only browsers can display.
+    """
+    t_data = THEMES.get(theme_name, THEMES["GitHub Light"])
+    return {
+        "startOnLoad": False,
+        "theme": "base",
+        "themeVariables": {
+            "primaryColor": t_data["bg"],
+            "primaryTextColor": t_data["primary"],
+            "primaryBorderColor": t_data["line"],
+            "lineColor": t_data["line"],
+            "secondaryColor": t_data["secondary"],
+            "tertiaryColor": t_data["bg"],
+        },
+        "maxTextSize": 10000000,
+        "maxNodes": 10000,
+        "flowchart": {"useMaxWidth": False, "htmlLabels": html_labels, "curve": "linear"},
+        "securityLevel": "loose",
+    }
+
+_MERMAID_ERROR_OPEN = '<div class="mermaid-error">'
+
+def _mermaid_error_html(message: str) -> str:
+    import html
+    return f'{_MERMAID_ERROR_OPEN}{html.escape(message)}</div>'
+
+def _mermaid_error_text(fragment: str) -> Optional[str]:
+    """Returns the message of an error box from _mermaid_error_html, or None for an SVG."""
+    import html
+    if not fragment.startswith(_MERMAID_ERROR_OPEN):
+        return None
+    return html.unescape(fragment[len(_MERMAID_ERROR_OPEN):-len("</div>")])
+
+class MermaidRenderer:
+    """
+    Persistent diagram renderer: long-lived pages with Mermaid already loaded
+    and initialized that turn diagram source into SVG through mermaid.render().
+    Library download, parse and start-up are paid once per browser instead of
+    once per document, and the final print page needs no JavaScript.
+    """
+
+    _RENDER_JS = """
+    async ([id, code, config]) => {
+        // Decode entities the way Mermaid does when it reads a .mermaid element
+        const ta = document.createElement('textarea');
+        ta.innerHTML = code;
+        mermaid.initialize(config);
+        try {
+            const { svg } = await mermaid.render(id, ta.value.trim());
+            return { svg };
+        } catch (e) {
+            document.getElementById('d' + id)?.remove();
+            return { error: String((e && e.message) || e) };
+        }
+    }
+    """
+
+    def __init__(self, browser, pages: int = 1):
+        self.browser = browser
+        self.size = max(1, pages)
+        self._idle = None
+        self._pages = []
+        self._counter = 0
+
+    async def _open_page(self):
+        page = await _new_render_page(self.browser, None)
+        await page.set_content('<!DOCTYPE html><html><head><meta charset="UTF-8"></head><body></body></html>')
+        await page.add_script_tag(url=MERMAID_JS_URL)
+        await page.wait_for_function("() => typeof window.mermaid !== 'undefined'")
+        return page
+
+    async def start(self) -> None:
+        if self._idle is not None:
+            return
+        self._idle = asyncio.Queue()
+        await self.ensure_pages(self.size)
+
+    async def ensure_pages(self, count: int) -> None:
+        """
+        Grows the pool to at least count pages, opened concurrently.
+        Mermaid renders one diagram at a time per page, so each page is a shard.
+        """
+        if self._idle is None or not self._pages:
+            # A fresh queue also drops the marker left by a pool that lost every page
+            self._idle = asyncio.Queue()
+        missing = count - len(self._pages)
+        if missing <= 0:
+            return
+        for page in await asyncio.gather(*(self._open_page() for _ in range(missing))):
+            self._pages.append(page)
+            self._idle.put_nowait(page)
+        self.size = len(self._pages)
+
+    async def render(self, code: str, theme_name: str, timeout: Optional[float] = None, html_labels: bool = True) -> str:
+        """
+        Returns the SVG for one diagram. Raises ValueError for invalid diagram
+        source and asyncio.TimeoutError when rendering exceeds timeout seconds.
+        """
+        await self.start()
+        if not self._pages:
+            await self.ensure_pages(1) # Every page was lost to failed replacements
+        self._counter += 1
+        render_id = f"mmd{self._counter}"
+        page = await self._idle.get()
+        if page is None:
+            self._idle.put_nowait(None)
+            raise RuntimeError("The diagram renderer lost all of its pages.")
+        try:
+            result = await asyncio.wait_for(
+                page.evaluate(self._RENDER_JS, [render_id, sanitize_mermaid_code(code), _mermaid_config(theme_name, html_labels)]),
+                timeout,
+            )
+        except asyncio.TimeoutError:
+            # The page is still busy inside mermaid.render(); swap in a fresh one
+            self._pages.remove(page)
+            try: await page.close()
+            except Exception: pass
+            page = None
+            try:
+                page = await self._open_page()
+            except Exception:
+                # Shrink the pool rather than count a page that no longer exists;
+                # ensure_pages() grows it back for the next document
+                self.size = len(self._pages)
+                if not self._pages:
+                    self._idle.put_nowait(None) # Wake waiters so they fail instead of hanging
+            else:
+                self._pages.append(page)
+            raise
+        finally:
+            if page is not None:
+                self._idle.put_nowait(page)
+        if "error" in result:
+            raise ValueError(result["error"])
+        return result["svg"]
+
+    async def close(self) -> None:
+        for page in self._pages:
+            try: await page.close()
+            except Exception: pass
+        self._pages = []
+        self._idle = None
+
+def _diagram_timeout_ms(code: str) -> int:
+    """Render budget for one diagram, scaled by its size (lines and edges)."""
+    lines = code.count("\n") + 1
+    edges = code.count("--") + code.count("==") + code.count("-.")
+    return 2000 + 40 * lines + 20 * edges
+
+def _diagrams_timeout_ms(diagrams: list, shards: int = 1, minimum: int = 10000) -> int:
+    """Wait budget for a set of diagrams rendered across shards (1 = in-page, sequential)."""
+    return max(minimum, sum(_diagram_timeout_ms(d) for d in diagrams) // max(1, shards))
+
+def _default_diagram_shards() -> int:
+    return max(1, min(4, os.cpu_count() or 1))
+
+_mermaid_renderer = None
+_mermaid_renderer_lock = None
+
+async def _get_mermaid_renderer(browser=None, pages: int = 1) -> MermaidRenderer:
+    """Returns the shared MermaidRenderer for browser (default: the shared browser) with at least pages shards."""
+    global _mermaid_renderer, _mermaid_renderer_lock
+    if _mermaid_renderer_lock is None:
+        _mermaid_renderer_lock = asyncio.Lock()
+    async with _mermaid_renderer_lock:
+        if browser is None:
+            browser = await _get_browser()
+        if _mermaid_renderer is None or _mermaid_renderer.browser is not browser:
+            renderer = MermaidRenderer(browser, pages)
+            await renderer.start()
+            _mermaid_renderer = renderer
+        else:
+            await _mermaid_renderer.ensure_pages(pages)
+        return _mermaid_renderer
+
+async def prewarm_browser(settings: Optional[dict] = None) -> float:
+    """
+    ⚡ Bolt: Pays the one-off startup costs ahead of the first export: starts
+    Playwright, launches Chromium, opens (and closes) a page so a renderer
+    process is warm, and loads the Mermaid bundle into the diagram worker.
+    Safe to run concurrently with an export; returns the seconds spent.
+    """
+    import time
+    settings = settings or {}
+    started = time.perf_counter()
+    browser = await _get_browser()
+    page = await _new_render_page(browser, settings, False)
+    try:
+        await page.set_content("<!DOCTYPE html><html><body></body></html>")
+    finally:
+        await page.close()
+    if settings.get("mermaid_worker", True) and settings.get("mermaid_enabled", True):
+        await _get_mermaid_renderer(browser)
+    return time.perf_counter() - started
+
+async def prerender_diagrams(md_text: str, settings: dict, browser=None, log_fn=None) -> Optional[dict]:
+    """
+    ⚡ Bolt: Renders every Mermaid diagram of md_text on the persistent MermaidRenderer.
+    Returns {diagram index: SVG (or error box)} for create_html_content to inline, or
+    None when there is nothing to do or the worker is disabled ("mermaid_worker")
+    or unavailable, in which case the page falls back to in-page rendering.
+    """
+    if not settings.get("mermaid_worker", True) or not settings.get("mermaid_enabled", True):
+        return None
+    diagrams = (await run_cpu(parse_document, md_text)).diagrams
+    if not diagrams:
+        return None
+
+    # ⚡ Bolt: Shard diagrams across several worker pages so diagram-heavy
+    # documents render concurrently instead of one after another.
+    shards = min(int(settings.get("diagram_shards", 0)) or _default_diagram_shards(), len(diagrams))
+    try:
+        renderer = await _get_mermaid_renderer(browser, shards)
+    except Exception as e:
+        if log_fn: log_fn(f"Warning: Mermaid worker unavailable, rendering in page: {e}")
+        return None
+
     theme_name = settings.get("theme", "GitHub Light")
-    
-    if log_fn: log_fn(f"Parsing Markdown: {md_path.name}")
+    html_labels = settings.get("mermaid_html_labels", True)
+
+    async def _render_one(i: int, code: str):
+        budget = _diagram_timeout_ms(code)
+        try:
+            return i, await renderer.render(code, theme_name, budget / 1000, html_labels)
+        except ValueError as e:
+            if log_fn: log_fn(f"Warning: Diagram {i+1} failed to render: {str(e).splitlines()[0] if str(e) else e}")
+            return i, _mermaid_error_html(str(e))
+        except asyncio.TimeoutError:
+            if log_fn: log_fn(f"Warning: Diagram {i+1} timed out after {budget / 1000:.1f}s")
+            return i, _mermaid_error_html(f"Diagram render timed out after {budget / 1000:.1f}s")
+        except Exception as e:
+            if log_fn: log_fn(f"Warning: Diagram {i+1} failed on the worker: {e}")
+            return i, _mermaid_error_html(str(e))
+
+    svgs = dict(await asyncio.gather(*(_render_one(i, code) for i, code in enumerate(diagrams))))
+    if log_fn: log_fn(f"Pre-rendered {len(svgs)} diagrams on {renderer.size} pages.")
+    return svgs
+
+_SVG_ROOT_PATTERN = re.compile(r"<svg\b[^>]*>")
+_SVG_VIEWBOX_PATTERN = re.compile(r'viewBox="\s*[-\d.eE]+[\s,]+[-\d.eE]+[\s,]+([\d.eE]+)[\s,]+([\d.eE]+)\s*"')
+
+def _svg_natural_size(svg: str) -> Optional[tuple]:
+    """Returns (width, height) of an SVG from its root viewBox, or None."""
+    root = _SVG_ROOT_PATTERN.search(svg)
+    vb = _SVG_VIEWBOX_PATTERN.search(root.group(0)) if root else None
+    if not vb:
+        return None
+    return float(vb.group(1)), float(vb.group(2))
+
+def _svg_fixed_size(svg: str) -> tuple:
+    """
+    Pins the root <svg> to its natural (viewBox) size. Mermaid emits width="100%"
+    plus a max-width style for most diagram types, which only resolves inside a
+    sized container. Returns (svg, width, height); sizes are None without a viewBox.
+    """
+    size = _svg_natural_size(svg)
+    if size is None:
+        return svg, None, None
+    w, h = size
+    root = _SVG_ROOT_PATTERN.search(svg)
+    tag = re.sub(r'\s(?:width|height)="[^"]*"', "", root.group(0))
+    tag = re.sub(r"max-width:\s*[^;\"]*;?", "", tag)
+    tag = f'{tag[:-1]} width="{w:g}" height="{h:g}">'
+    return svg[:root.start()] + tag + svg[root.end():], w, h
+
+# Serializes rendered diagrams from the DOM with the computed styles that
+# page CSS contributes inlined, so each SVG renders the same on its own.
+_SERIALIZE_SVGS_JS = """
+(diagrams) => {
+    const PROPS = ['fill', 'fill-opacity', 'stroke', 'stroke-width', 'stroke-dasharray', 'stroke-opacity',
+                   'opacity', 'color', 'font-family', 'font-size', 'font-weight', 'font-style', 'text-anchor'];
+    return diagrams.map(el => {
+        const svg = el.querySelector('svg');
+        if (!svg) return null; // Error box
+        const clone = svg.cloneNode(true);
+        const src = svg.querySelectorAll('*');
+        const dst = clone.querySelectorAll('*');
+        src.forEach((node, i) => {
+            const cs = getComputedStyle(node);
+            const inline = PROPS.map(p => `${p}:${cs.getPropertyValue(p)}`).join(';');
+            dst[i].setAttribute('style', `${dst[i].getAttribute('style') || ''};${inline}`);
+        });
+        const box = svg.getBoundingClientRect();
+        clone.setAttribute('xmlns', 'http://www.w3.org/2000/svg');
+        clone.setAttribute('width', box.width);
+        clone.setAttribute('height', box.height);
+        clone.style.maxWidth = 'none';
+        return new XMLSerializer().serializeToString(clone);
+    });
+}
+"""
+
+def _standalone_svg(svg: str, theme_name: str) -> str:
+    """
+    Makes a worker SVG self-contained: pinned to its natural size, with the XML
+    namespace, the theme background and the theme's diagram overrides inlined.
+    """
+    t_data = THEMES.get(theme_name, THEMES["GitHub Light"])
+    svg, _, _ = _svg_fixed_size(svg)
+    root = _SVG_ROOT_PATTERN.search(svg)
+    if not root:
+        return svg
+    tag = root.group(0)
+    if "xmlns=" not in tag:
+        tag = f'{tag[:-1]} xmlns="http://www.w3.org/2000/svg">'
+    if 'style="' in tag:
+        tag = tag.replace('style="', f'style="background-color: {t_data["bg"]}; ', 1)
+    else:
+        tag = f'{tag[:-1]} style="background-color: {t_data["bg"]};">'
+    root_id = re.search(r'\sid="([^"]+)"', tag)
+    scope = f"#{root_id.group(1)} " if root_id else ""
+    return f"{svg[:root.start()]}{tag}<style>{_mermaid_theme_css(t_data, scope)}</style>{svg[root.end():]}"
+
+def _standalone_svgs(svgs: dict, theme_name: str) -> dict:
+    """Applies _standalone_svg to every worker SVG, leaving error boxes untouched."""
+    return {i: svg if _mermaid_error_text(svg) is not None else _standalone_svg(svg, theme_name) for i, svg in svgs.items()}
+
+async def _serialize_page_svgs(page) -> dict:
+    """Returns {diagram index: standalone SVG} for the diagrams rendered in page; failed diagrams are left out."""
+    svgs = await page.eval_on_selector_all(".mermaid", _SERIALIZE_SVGS_JS)
+    return {i: svg for i, svg in enumerate(svgs) if svg}
+
+def _docx_svg_ok(svg: str) -> bool:
+    """True when a standalone SVG can go into a DOCX as is: not an error box and no HTML labels."""
+    return _mermaid_error_text(svg) is None and "<foreignObject" not in svg
+
+async def _write_diagram_svgs(svgs: dict, out_dir: Path, stem: str, log_fn=print) -> list:
+    """Writes one <stem>_diagram_<n>.svg per diagram, skipping diagrams that failed to render."""
+    loop = asyncio.get_running_loop()
+    paths = []
+    for i in sorted(svgs):
+        if _mermaid_error_text(svgs[i]) is not None:
+            if log_fn: log_fn(f"Skipping diagram {i+1}: it failed to render")
+            continue
+        d_path = out_dir / f"{stem}_diagram_{i+1}.svg"
+        await loop.run_in_executor(None, lambda p=d_path, svg=svgs[i]: p.write_text(svg, encoding="utf-8"))
+        paths.append(d_path)
+        if log_fn: log_fn(f"Saved diagram: {d_path}")
+    return paths
+
+# Every diagram's box in page coordinates, collected in one round-trip
+_DIAGRAM_BOXES_JS = """
+() => [...document.querySelectorAll('.mermaid')].map(el => {
+    const r = el.getBoundingClientRect();
+    return { x: r.left + window.scrollX, y: r.top + window.scrollY, width: r.width, height: r.height };
+})
+"""
+_MAX_CAPTURE_PX = 8192 # Device pixels per full-page capture band
+
+def _plan_capture_bands(boxes: list, band_height: float) -> list:
+    """
+    Groups diagram boxes (page coordinates) into vertical capture bands no taller
+    than band_height, skipping the text between them. Returns [(top, bottom, [box
+    indices])]; a single box taller than band_height gets a band of its own.
+    """
+    import math
+    bands = []
+    for i in sorted(range(len(boxes)), key=lambda i: boxes[i]["y"]):
+        top = math.floor(boxes[i]["y"])
+        bottom = math.ceil(boxes[i]["y"] + boxes[i]["height"])
+        if bands and bottom - bands[-1][0] <= band_height:
+            b_top, b_bottom, members = bands[-1]
+            bands[-1] = (b_top, max(b_bottom, bottom), members + [i])
+        else:
+            bands.append((top, bottom, [i]))
+    return bands
+
+def _crop_diagram(band, clip: dict, box: dict, path: Path) -> Path:
+    """Crops one diagram out of a decoded band image and encodes it to path."""
+    ratio = band.width / clip["width"]
+    left = max(0, round((box["x"] - clip["x"]) * ratio))
+    top = max(0, round((box["y"] - clip["y"]) * ratio))
+    right = min(band.width, max(left + 1, round((box["x"] + box["width"] - clip["x"]) * ratio)))
+    bottom = min(band.height, max(top + 1, round((box["y"] + box["height"] - clip["y"]) * ratio)))
+    band.crop((left, top, right, bottom)).save(path, "PNG")
+    return path
+
+async def capture_diagrams(page, path_for) -> list:
+    """
+    Saves every .mermaid element of a loaded page as a PNG at path_for(index)
+    and returns the paths in document order. path_for may return None to skip
+    a diagram; its entry in the result is None and it costs no capture.
+
+    ⚡ Bolt: Instead of one element.screenshot() per diagram (a scroll, layout
+    and encode round-trip each), all boxes come from a single evaluate(), the
+    page is captured in as few full-page bands as possible, and Pillow crops
+    and encodes the individual diagrams on the thread pool.
+    Falls back to per-element screenshots when Pillow is not installed.
+    """
     try:
-        md_text = await asyncio.get_running_loop().run_in_executor(None, lambda: md_path.read_text(encoding="utf-8"))
-    except UnicodeDecodeError:
-        raise ValueError(f"The file '{md_path.name}' is not a valid text file. Please ensure you are converting a Markdown (.md) file, not a binary file like PDF.")
-    if prog_fn: prog_fn(20)
-    
-    html_content = create_html_content(md_text, settings)
+        from PIL import Image as PILImage
+    except ImportError:
+        PILImage = None
+
+    if PILImage is None:
+        paths = []
+        for i, element in enumerate(await page.locator(".mermaid").all()):
+            paths.append(path_for(i))
+            if paths[-1] is not None:
+                await element.screenshot(path=str(paths[-1]))
+        return paths
+
+    boxes = await page.evaluate(_DIAGRAM_BOXES_JS)
+    if not boxes:
+        return []
+    dpr, page_w = await page.evaluate("() => [window.devicePixelRatio, document.documentElement.scrollWidth]")
+    loop = asyncio.get_running_loop()
+    paths = [path_for(i) for i in range(len(boxes))]
+    wanted = [i for i, path in enumerate(paths) if path is not None]
+
+    def _decode(data: bytes):
+        img = PILImage.open(io.BytesIO(data))
+        img.load()
+        return img
+
+    crops = []
+    for top, bottom, members in _plan_capture_bands([boxes[i] for i in wanted], _MAX_CAPTURE_PX / (dpr or 1)):
+        clip = {"x": 0, "y": top, "width": page_w, "height": max(1, bottom - top)}
+        band_png = await page.screenshot(clip=clip, full_page=True)
+        band = await loop.run_in_executor(None, _decode, band_png)
+        crops.extend(loop.run_in_executor(None, _crop_diagram, band, clip, boxes[wanted[m]], paths[wanted[m]]) for m in members)
+    await asyncio.gather(*crops)
+    return paths
+
+async def export_diagrams_svg(md_text: str, out_dir: Path, stem: str, settings: dict, base_dir: Optional[Path] = None, log_fn=print, browser=None) -> list:
+    """
+    ⚡ Bolt: Native SVG export, one <stem>_diagram_<n>.svg per diagram.
+    SVGs come straight from the Mermaid worker (or, without it, are serialized
+    from the rendered DOM), so nothing is rasterized: extraction takes
+    milliseconds and the files stay vector and small. Returns the written paths.
+    """
+    theme_name = settings.get("theme", "GitHub Light")
+    if browser is None:
+        browser = await _get_browser()
+    diagrams = (await run_cpu(parse_document, md_text)).diagrams
+    if not diagrams:
+        if log_fn: log_fn("No Mermaid diagrams found to export.")
+        return []
+
+    svgs = await prerender_diagrams(md_text, settings, browser, log_fn)
+    if svgs is not None:
+        svgs = _standalone_svgs(svgs, theme_name)
+    else:
+        page = await _new_render_page(browser, settings, True)
+        try:
+            await _load_html(page, await _document_html(md_text, settings), base_dir)
+            await page.wait_for_function("""
+                () => document.querySelectorAll('.mermaid[data-processed="true"]').length === document.querySelectorAll('.mermaid').length
+            """, timeout=_diagrams_timeout_ms(diagrams))
+            svgs = await _serialize_page_svgs(page)
+        finally:
+            await page.close()
+    return await _write_diagram_svgs(svgs, Path(out_dir), stem, log_fn)
+
+async def render_diagram(code: str, fmt: str, settings: dict, output=None, browser=None, log_fn=print) -> Optional[bytes]:
+    """
+    ⚡ Bolt: Pure-diagram fast path. Renders a single Mermaid diagram on the
+    persistent worker and returns it as SVG, PNG or PDF cropped to the diagram's
+    bounding box, skipping the markdown parse, canvas padding and full-page layout.
+    Returns bytes when output is None, otherwise writes to output (path or stream).
+    Raises RuntimeError when the diagram fails to render.
+    """
+    import math
+    fmt = fmt.lower()
+    if fmt not in ("svg", "png", "pdf"):
+        raise ValueError(f"Unsupported diagram format '{fmt}'")
+    theme_name = settings.get("theme", "GitHub Light")
+    if theme_name not in THEMES: theme_name = "GitHub Light"
+    t_data = THEMES[theme_name]
+
+    if browser is None:
+        browser = await _get_browser()
+    renderer = await _get_mermaid_renderer(browser)
+    budget = _diagram_timeout_ms(code)
+    try:
+        svg = await renderer.render(code, theme_name, budget / 1000)
+    except ValueError as e:
+        reason = (str(e).strip().split("\n") or ["Unknown Mermaid Error"])[0]
+        if log_fn: log_fn(f"\n[!] MERMAID RENDER FAILURE [!]\nReason: {reason}\nStatus: ABORTED\n")
+        raise RuntimeError(f"Mermaid render failure: {reason}")
+    except asyncio.TimeoutError:
+        raise RuntimeError(f"Mermaid render timed out after {budget / 1000:.1f}s")
+    if fmt == "svg":
+        data = _standalone_svg(svg, theme_name).encode("utf-8")
+    else:
+        svg, w, h = _svg_fixed_size(svg)
+        view_w, view_h = math.ceil(w or 800), math.ceil(h or 600)
+        # Same "png_dpi" / "png_max_pixels" scale as render_png
+        scale = _png_scale(view_w, view_h, settings) if fmt == "png" else 1
+        html = f'''<!DOCTYPE html><html><head><meta charset="UTF-8"><style>
+html, body {{ margin: 0; padding: 0; background: {t_data['bg']}; }}
+.mermaid svg {{ display: block; }}
+{_mermaid_theme_css(t_data)}
+</style></head><body><div class="mermaid">{svg}</div></body></html>'''
+        page = await _new_render_page(browser, settings, False, viewport={"width": view_w, "height": view_h}, device_scale_factor=scale)
+        try:
+            await page.set_content(html)
+            if w is None:
+                box = await page.locator(".mermaid svg").first.bounding_box()
+                view_w, view_h = math.ceil(box["width"]), math.ceil(box["height"])
+                if fmt == "png" and _png_scale(view_w, view_h, settings) != scale:
+                    # The device scale is fixed per page: reopen at the one the measured size needs
+                    await page.close()
+                    scale = _png_scale(view_w, view_h, settings)
+                    page = await _new_render_page(browser, settings, False, viewport={"width": view_w, "height": view_h}, device_scale_factor=scale)
+                    await page.set_content(html)
+                else:
+                    await page.set_viewport_size({"width": view_w, "height": view_h})
+            if fmt == "png":
+                data = await page.screenshot(clip={"x": 0, "y": 0, "width": view_w, "height": view_h})
+            else:
+                data = await page.pdf(width=f"{view_w}px", height=f"{view_h}px", print_background=True, page_ranges="1",
+                                      margin={"top": "0", "bottom": "0", "left": "0", "right": "0"})
+        finally:
+            await page.close()
+
+    result = _write_output(data, output)
+    if log_fn and isinstance(output, (str, Path)): log_fn(f"Created: {Path(output).resolve()}")
+    return result
+
+def _file_url(path: Path) -> str:
+    return f"file:///{str(path.resolve()).replace(os.sep, '/').lstrip('/')}"
+
+def _write_output(data: bytes, output) -> Optional[bytes]:
+    """
+    Delivers rendered bytes: returns them when output is None, writes them to
+    output when it is a path, otherwise treats output as a binary stream.
+    """
+    if output is None:
+        return data
+    if isinstance(output, (str, Path)):
+        Path(output).write_bytes(data)
+    else:
+        output.write(data)
+        if hasattr(output, "flush"): output.flush()
+    return None
+
+async def _load_html(page, html_content: str, base_dir: Optional[Path] = None) -> None:
+    """
+    Loads generated HTML into a page without writing it to disk.
+    Navigating to base_dir first gives the document a file:// origin, so local
+    images and relative links resolve as they would from a file next to the source.
+    """
+    if base_dir is not None:
+        await page.goto(_file_url(base_dir) + "/", wait_until="load")
+    await page.set_content(html_content, wait_until="load")
+
+_PDF_STREAM_CHUNK = 1 << 20  # 1 MiB per IO.read round-trip
+
+async def _print_pdf_streamed(page, params: dict, output) -> None:
+    """
+    ⚡ Bolt: Prints through CDP Page.printToPDF with transferMode ReturnAsStream and
+    copies the PDF to output one chunk at a time. page.pdf() pulls the whole
+    document across the protocol as a single base64 blob, so image-heavy PDFs
+    cost hundreds of MB of transient memory in both Chromium and Python;
+    streaming keeps peak memory flat at one chunk regardless of PDF size.
+    output is a path or a binary stream.
+    """
+    loop = asyncio.get_running_loop()
+    cdp = await page.context.new_cdp_session(page)
+    try:
+        result = await cdp.send("Page.printToPDF", {**params, "transferMode": "ReturnAsStream"})
+        handle = result["stream"]
+        part = None
+        try:
+            if isinstance(output, (str, Path)):
+                # Written beside the target and moved into place once complete, so a
+                # failed print never leaves a truncated PDF at the output path
+                target = Path(output)
+                part = target.with_name(f".{target.name}.{uuid.uuid4().hex[:8]}.part")
+                out = await loop.run_in_executor(None, open, part, "wb")
+                try:
+                    await _copy_pdf_stream(cdp, handle, out)
+                finally:
+                    await loop.run_in_executor(None, out.close)
+                await loop.run_in_executor(None, os.replace, part, target)
+                part = None
+            else:
+                await _copy_pdf_stream(cdp, handle, output)
+                if hasattr(output, "flush"): output.flush()
+        finally:
+            if part is not None:
+                with contextlib.suppress(OSError):
+                    part.unlink()
+            # A dead session must not hide the original error
+            with contextlib.suppress(Exception):
+                await cdp.send("IO.close", {"handle": handle})
+    finally:
+        await cdp.detach()
+
+async def _copy_pdf_stream(cdp, handle: str, out) -> None:
+    """Copies a CDP IO stream to a binary file object, one chunk at a time."""
+    loop = asyncio.get_running_loop()
+    while True:
+        chunk = await cdp.send("IO.read", {"handle": handle, "size": _PDF_STREAM_CHUNK})
+        data = chunk.get("data")
+        if data:
+            data = base64.b64decode(data) if chunk.get("base64Encoded") else data.encode("utf-8")
+            await loop.run_in_executor(None, out.write, data)
+        if chunk.get("eof"):
+            break
+
+def _pdf_value_key(value, dupes: dict):
+    """
+    A hashable key for a PDF dictionary value. Indirect references are keyed by
+    the objgen they resolve to after merging (pikepdf's repr shows only the
+    first bytes of a stream, so it cannot tell two alpha masks apart).
+    """
+    import pikepdf
+    if not isinstance(value, pikepdf.Object):
+        return (type(value).__name__, repr(value))
+    if value.is_indirect:
+        objgen = value.objgen
+        while objgen in dupes:
+            objgen = dupes[objgen].objgen
+        return ("ref", objgen)
+    if isinstance(value, pikepdf.Dictionary):
+        return ("dict", tuple(sorted((str(k), _pdf_value_key(v, dupes)) for k, v in value.items())))
+    if isinstance(value, pikepdf.Array):
+        return ("array", tuple(_pdf_value_key(v, dupes) for v in value))
+    return ("atom", value.unparse())
+
+def _dedupe_pdf_streams(pdf) -> set:
+    """
+    Points every reference to a stream at the first stream with identical
+    bytes and dictionary. The duplicates become unreachable, so they are not
+    written. Streams that refer to other streams (an image and its /SMask)
+    merge once their targets have, so rounds repeat until nothing changes.
+    Returns the (objnum, gen) of the merged duplicates.
+    """
+    import pikepdf
+    streams = [obj for obj in pdf.objects if isinstance(obj, pikepdf.Stream)]
+    digests = {obj.objgen: hashlib.sha256(obj.read_raw_bytes()).digest() for obj in streams}
+    dupes = {}
+    while True:
+        canonical = {}
+        merged = 0
+        for obj in streams:
+            if obj.objgen in dupes:
+                continue
+            info = tuple(sorted((str(k), _pdf_value_key(v, dupes)) for k, v in obj.stream_dict.items() if k != "/Length"))
+            first = canonical.setdefault((digests[obj.objgen], info), obj)
+            if first.objgen != obj.objgen:
+                dupes[obj.objgen] = first
+                merged += 1
+        if not merged:
+            break
+    if not dupes:
+        return set()
+    for objgen, first in dupes.items():
+        # A stream kept in one round may itself merge in a later one
+        while first.objgen in dupes:
+            first = dupes[first.objgen]
+        dupes[objgen] = first
+
+    def relink(container):
+        # Direct containers are walked; indirect children are handled as objects of their own
+        items = container.items() if isinstance(container, (pikepdf.Dictionary, pikepdf.Stream)) else enumerate(container)
+        for key, value in list(items):
+            if not isinstance(value, pikepdf.Object):
+                continue # Scalars come back as Python values
+            if value.is_indirect:
+                if value.objgen in dupes:
+                    container[key] = dupes[value.objgen]
+            elif isinstance(value, (pikepdf.Dictionary, pikepdf.Array)):
+                relink(value)
+
+    for obj in pdf.objects:
+        if isinstance(obj, (pikepdf.Dictionary, pikepdf.Array, pikepdf.Stream)):
+            relink(obj.stream_dict if isinstance(obj, pikepdf.Stream) else obj)
+    relink(pdf.trailer)
+    return set(dupes)
+
+def _recompress_pdf_images(pdf, quality: int, skip=frozenset()) -> int:
+    """Re-encodes 8-bit RGB/gray images as JPEG at quality where that is smaller. Returns the count."""
+    import pikepdf
+    count = 0
+    for obj in pdf.objects:
+        if not isinstance(obj, pikepdf.Stream) or obj.get("/Subtype") != pikepdf.Name.Image or obj.objgen in skip:
+            continue
+        if obj.get("/ImageMask", False) or obj.get("/BitsPerComponent") != 8 or "/Decode" in obj or "/Mask" in obj:
+            continue
+        try:
+            image = pikepdf.PdfImage(obj).as_pil_image()
+        except Exception:
+            continue # Color spaces PIL cannot represent stay as they are
+        if image.mode not in ("RGB", "L"):
+            continue
+        buf = io.BytesIO()
+        image.save(buf, "JPEG", quality=quality, optimize=True)
+        if buf.tell() >= len(obj.read_raw_bytes()):
+            continue
+        obj.write(buf.getvalue(), filter=pikepdf.Name.DCTDecode)
+        space = obj.get("/ColorSpace")
+        icc = isinstance(space, pikepdf.Array) and len(space) == 2 and space[0] == pikepdf.Name.ICCBased
+        if not (icc and int(space[1].get("/N", 0)) == len(image.getbands())):
+            # ICC profiles stay; palettes and the like are now plain device pixels
+            obj.ColorSpace = pikepdf.Name.DeviceRGB if image.mode == "RGB" else pikepdf.Name.DeviceGray
+        if "/DecodeParms" in obj:
+            del obj.DecodeParms
+        count += 1
+    return count
+
+def optimize_pdf(data: bytes, quality: int = 80, linearize: bool = True) -> tuple:
+    """
+    Post-processes a PDF: merges identical streams (repeated logos and theme
+    images are stored once), re-encodes images as JPEG at quality (0 keeps
+    them), packs objects into compressed object streams and, with linearize,
+    writes a linearized ("fast web view") file so the first page displays
+    before the download finishes. Returns (pdf bytes, stats).
+    Needs pikepdf; runs fine in a worker process.
+    """
+    import pikepdf
+    with pikepdf.open(io.BytesIO(data)) as pdf:
+        merged = _dedupe_pdf_streams(pdf)
+        recompressed = _recompress_pdf_images(pdf, quality, merged) if quality else 0
+        out = io.BytesIO()
+        pdf.save(out, linearize=linearize, object_stream_mode=pikepdf.ObjectStreamMode.generate, compress_streams=True)
+    optimized = out.getvalue()
+    stats = {"before": len(data), "after": len(optimized), "deduplicated": len(merged), "recompressed": recompressed}
+    if len(optimized) > len(data) and not linearize:
+        return data, dict(stats, after=len(data))
+    return optimized, stats
+
+async def postprocess_pdf(data: bytes, settings: dict, log_fn=print) -> bytes:
+    """
+    ⚡ Bolt: Runs optimize_pdf ("pdf_optimize") on the CPU executor, in a worker
+    process for large files ("cpu_executor"), so the event loop and the
+    browser go on with the next render. Returns data unchanged without pikepdf.
+    """
+    if not HAS_PIKEPDF:
+        if log_fn: log_fn("Warning: PDF optimization needs pikepdf (pip install pikepdf); writing the PDF as is.")
+        return data
+    quality = int(settings.get("pdf_image_quality", 80))
+    optimized, stats = await run_cpu(optimize_pdf, data, quality, settings.get("pdf_linearize", True), settings=settings, size=len(data))
+    if log_fn:
+        log_fn(f"Optimized PDF: {stats['before'] / 1024:.0f} KB -> {stats['after'] / 1024:.0f} KB "
+               f"(duplicate streams merged: {stats['deduplicated']}, images recompressed: {stats['recompressed']})")
+    return optimized
+
+async def _document_html(md_text: str, settings: dict, diagram_svgs: Optional[dict] = None) -> str:
+    """
+    create_html_content off the event loop, so one render does not stall the
+    other jobs in flight. Callers have usually parsed the document here already
+    (for its diagram list), so it stays on the thread pool next to the parse
+    cache: a process-pool worker would get the source pickled across and parse
+    it again.
+    """
+    return await run_cpu(create_html_content, md_text, settings, None, diagram_svgs)
+
+async def render_pdf(md_text: str, output, settings: dict, base_dir: Optional[Path] = None, log_fn=print, prog_fn=None, browser=None, html_path: Optional[Path] = None) -> Optional[bytes]:
+    """
+    Renders markdown text to PDF. Returns the PDF bytes when output is None,
+    otherwise writes to output (a path or a binary stream).
+    """
+    u_height = settings.get("unlimited_height", True)
+    a4_width = settings.get("a4_fixed_width", True)
+
+    if browser is None:
+        browser = await _get_browser()
+
+    # Parse on the thread pool first so every later stage hits the parse cache
+    await run_cpu(parse_document, md_text)
+    diagram_svgs = await prerender_diagrams(md_text, settings, browser, log_fn)
+    html_content = await _document_html(md_text, settings, diagram_svgs)
+    needs_js = _needs_mermaid_runtime(md_text, settings, diagram_svgs)
     if prog_fn: prog_fn(30)
-    
-    tmp_h = md_path.with_suffix(".tmp.html")
-    await asyncio.get_running_loop().run_in_executor(None, lambda: tmp_h.write_text(html_content, encoding="utf-8"))
+
+    if html_path is not None:
+        await asyncio.get_running_loop().run_in_executor(None, lambda: html_path.write_text(html_content, encoding="utf-8"))
     if prog_fn: prog_fn(40)
-    
+
+    out_path = Path(output) if isinstance(output, (str, Path)) else None
+
     async def render_pdf_page(browser_inst):
         v_w = 800 if a4_width else 1200
-        page = await browser_inst.new_page(viewport={"width": v_w, "height": 1000})
-        abs_url = f"file:///{str(tmp_h.resolve()).replace(os.sep, '/')}"
-        # using 'load' instead of 'networkidle' saves ~500ms per PDF
-        await page.goto(abs_url, wait_until="load")
+        page = await _new_render_page(browser_inst, settings, needs_js, viewport={"width": v_w, "height": 1000})
+        # 'load' instead of 'networkidle' saves ~500ms per PDF
+        await _load_html(page, html_content, base_dir)
         
         # Smart wait for diagrams
         mermaid_count = await page.locator(".mermaid").count()
-        if mermaid_count > 0:
+        if mermaid_count > 0 and not needs_js:
+            if log_fn: log_fn(f"{mermaid_count} diagrams pre-rendered, skipping wait.")
+        elif mermaid_count > 0:
             if log_fn: log_fn(f"Waiting for {mermaid_count} diagrams to render...")
             try:
                 await page.wait_for_function("""
@@ -469,7 +2036,7 @@ async def generate_pdf_core(md_path: Path, pdf_path: Path, settings: dict, log_f
                         const error = document.querySelectorAll('.mermaid-error');
                         return (processed.length + error.length) === all.length;
                     }
-                """, timeout=10000)
+                """, timeout=_diagrams_timeout_ms(parse_document(md_text).diagrams))
                 await page.wait_for_timeout(500) # Buffer for layout
             except Exception as e:
                 if log_fn: log_fn(f"Warning: Timeout waiting for diagrams: {e}")
@@ -477,172 +2044,271 @@ async def generate_pdf_core(md_path: Path, pdf_path: Path, settings: dict, log_f
             if log_fn: log_fn("No diagrams detected, skipping wait.")
         if prog_fn: prog_fn(70)
         
-        # Save Diagrams if enabled
-        if settings.get("save_diagrams", False):
-            elements = await page.locator(".mermaid").all()
-            if elements:
-                if log_fn: log_fn(f"Saving {len(elements)} diagrams to separate files...")
-                out_dir = pdf_path.parent
-                stem = pdf_path.stem
-                for i, element in enumerate(elements):
-                    d_path = out_dir / f"{stem}_diagram_{i+1}.png"
-                    await element.screenshot(path=str(d_path))
-                    if log_fn: log_fn(f"Saved diagram: {d_path}")
-
-        opts = {"path": str(pdf_path.resolve()), "print_background": True}
+        # Save Diagrams if enabled (needs a file output to name them after)
+        if settings.get("save_diagrams", False) and out_path is not None and settings.get("diagram_format", "png") == "svg":
+            if diagram_svgs:
+                svgs = _standalone_svgs(diagram_svgs, settings.get("theme", "GitHub Light"))
+            else:
+                svgs = await _serialize_page_svgs(page)
+            await _write_diagram_svgs(svgs, out_path.parent, out_path.stem, log_fn)
+        elif settings.get("save_diagrams", False) and out_path is not None:
+            saved = await capture_diagrams(page, lambda i: out_path.parent / f"{out_path.stem}_diagram_{i+1}.png")
+            if log_fn:
+                for d_path in saved: log_fn(f"Saved diagram: {d_path}")
+
+        opts = {"print_background": True}
         if u_height:
             h = await page.evaluate("document.body.scrollHeight")
             if log_fn: log_fn(f"Canvas: {v_w}px x {h}px")
             opts["width"] = f"{v_w}px"; opts["height"] = f"{h+100}px"; opts["margin"] = {"top":"0","bottom":"0","left":"0","right":"0"}
+            cdp_params = {"paperWidth": v_w / 96, "paperHeight": (h + 100) / 96, "marginTop": 0, "marginBottom": 0, "marginLeft": 0, "marginRight": 0}
         else:
             opts["format"] = "A4"; opts["margin"] = {"top": "1cm", "bottom": "1cm", "left": "1cm", "right": "1cm"}
-        
-        await page.pdf(**opts)
-        await page.close()
-
-    if browser:
-        await render_pdf_page(browser)
-    else:
-        browser_instance = await _get_browser()
-        await render_pdf_page(browser_instance)
+            cm = 1 / 2.54
+            cdp_params = {"paperWidth": 8.27, "paperHeight": 11.7, "marginTop": cm, "marginBottom": cm, "marginLeft": cm, "marginRight": cm}
 
-    if not settings.get("save_html", False): 
-        try: os.remove(tmp_h)
-        except: pass
-
-async def render_png_page(browser, md_path: Path, png_path: Path, settings: dict, log_fn=print, prog_fn=None) -> None:
-    theme_name = settings.get("theme", "GitHub Light")
-    if log_fn: log_fn(f"Rendering PNG ({theme_name}): {md_path.name}")
-    
-    md_text = await asyncio.get_running_loop().run_in_executor(None, lambda: md_path.read_text(encoding="utf-8"))
-    html_content = create_html_content(md_text, settings)
-    
-    tmp_h = md_path.with_suffix(f".{uuid.uuid4().hex[:8]}.tmp.html")
-    await asyncio.get_running_loop().run_in_executor(None, lambda: tmp_h.write_text(html_content, encoding="utf-8"))
-        
-    # Use an extreme viewport and device scale for 24K resolution
-    page = await browser.new_page(
-        viewport={"width": 6000, "height": 6000},
-        device_scale_factor=4
-    )
+        try:
+            if settings.get("stream_pdf", True) and (output is not None or optimize):
+                cdp_params["printBackground"] = True
+                # The optimizer needs the whole document; it still arrives in chunks
+                target = io.BytesIO() if optimize else output
+                await _print_pdf_streamed(page, cdp_params, target)
+                return target.getvalue() if optimize else None
+            if out_path is not None and not optimize:
+                opts["path"] = str(out_path.resolve())
+            return await page.pdf(**opts)
+        finally:
+            await page.close()
 
-    # Log console messages with prefix
-    page.on("console", lambda msg: log_fn(f"BROWSER CONSOLE: {msg.text}"))
-    page.on("pageerror", lambda exc: log_fn(f"BROWSER ERROR: {exc}"))
+    optimize = settings.get("pdf_optimize", False)
+    pdf_bytes = await render_pdf_page(browser)
 
-    abs_url = f"file:///{str(tmp_h.resolve()).replace(os.sep, '/')}"
-    if log_fn: log_fn(f"Loading: {abs_url}")
-    # using 'load' instead of 'networkidle' saves ~500ms
-    await page.goto(abs_url, wait_until="load")
+    if optimize:
+        # The page is closed already, so the browser can take the next render meanwhile
+        pdf_bytes = await postprocess_pdf(pdf_bytes, settings, log_fn)
+        return await asyncio.get_running_loop().run_in_executor(None, _write_output, pdf_bytes, output)
+    if pdf_bytes is None or out_path is not None:
+        return None
+    return _write_output(pdf_bytes, output)
 
-    # Wait for mermaid to finish rendering
+async def generate_pdf_core(md_path: Path, pdf_path: Path, settings: dict, log_fn=print, prog_fn=None, browser=None) -> None:
+    if log_fn: log_fn(f"Parsing Markdown: {md_path.name}")
     try:
-        if log_fn: log_fn("Waiting for Mermaid SVG (60s timeout)...")
+        md_text = await asyncio.get_running_loop().run_in_executor(None, lambda: md_path.read_text(encoding="utf-8"))
+    except UnicodeDecodeError:
+        raise ValueError(f"The file '{md_path.name}' is not a valid text file. Please ensure you are converting a Markdown (.md) file, not a binary file like PDF.")
+    if prog_fn: prog_fn(20)
 
-        # Check if mermaid blocks exist first to avoid 60s timeout on files without diagrams
-        has_mermaid = await page.evaluate("() => document.querySelectorAll('.mermaid').length > 0")
+    diagram = extract_pure_mermaid(md_text)
+    if diagram is not None:
+        if log_fn: log_fn("Single diagram detected, using the diagram fast path.")
+        await render_diagram(diagram, "pdf", settings, pdf_path, browser, log_fn)
+        return
+
+    html_path = md_path.with_suffix(".tmp.html") if settings.get("save_html", False) else None
+    await render_pdf(md_text, pdf_path, settings, md_path.parent, log_fn, prog_fn, browser, html_path=html_path)
+
+# Union of the captured .mermaid boxes in page coordinates
+_MEASURE_DIAGRAMS_JS = """
+() => {
+    const boxes = [...document.querySelectorAll('.mermaid')].map(el => el.getBoundingClientRect());
+    if (!boxes.length) return null;
+    const left = Math.min(...boxes.map(b => b.left)), top = Math.min(...boxes.map(b => b.top));
+    const right = Math.max(...boxes.map(b => b.right)), bottom = Math.max(...boxes.map(b => b.bottom));
+    return { x: left + window.scrollX, y: top + window.scrollY, width: right - left, height: bottom - top };
+}
+"""
 
-        if not has_mermaid:
-            if log_fn: log_fn("No mermaid diagrams found to wait for.")
+def _png_scale(width: float, height: float, settings: dict) -> float:
+    """
+    Device scale for a PNG capture of width x height CSS pixels: the "png_dpi"
+    target (96 dpi = 1x), capped so the longest side stays within "png_max_pixels".
+    """
+    scale = float(settings.get("png_dpi", 384)) / 96
+    longest = max(width, height, 1)
+    return max(min(scale, int(settings.get("png_max_pixels", 16384)) / longest), 0.1)
+
+def _diagrams_markdown(diagrams: list) -> str:
+    """Rebuilds a document holding only the given diagram sources as fences."""
+    fences = []
+    for code in diagrams:
+        ticks = "`" * max(3, max((len(m) for m in re.findall(r"`+", code)), default=0) + 1)
+        fences.append(f"{ticks}mermaid\n{code if code.endswith(chr(10)) else code + chr(10)}{ticks}")
+    return "\n\n".join(fences) + "\n"
+
+async def render_png(md_text: str, output, settings: dict, base_dir: Optional[Path] = None, log_fn=print, prog_fn=None, browser=None, html_path: Optional[Path] = None, all_diagrams: Optional[bool] = None) -> Optional[bytes]:
+    """
+    Renders the first Mermaid diagram of markdown text (or, with all_diagrams /
+    the "png_all_diagrams" setting, every diagram stacked) to PNG. Returns the
+    PNG bytes when output is None, otherwise writes to output (a path or a binary stream).
+    Raises RuntimeError when a diagram fails to render.
+
+    ⚡ Bolt: The capture is sized from the diagrams' measured bounding box
+    instead of a fixed 6000x6000 viewport at 4x. Only the diagrams are laid
+    out, a 1x page measures them, and the capture page gets a viewport of that
+    size with a device scale from "png_dpi", capped by "png_max_pixels".
+    A typical flowchart now needs a few megapixels of backing store instead of ~576M.
+    """
+    import math
+    if browser is None:
+        browser = await _get_browser()
+
+    def _abort(reason: str):
+        # Standardized error reporting for terminal detection
+        clean_msg = reason.strip().split('\n')[0] # Get just the first line
+        if log_fn:
+            log_fn(f"\n[!] MERMAID RENDER FAILURE [!]")
+            log_fn(f"Reason: {clean_msg}")
+            log_fn(f"Status: ABORTED\n")
+        raise RuntimeError(f"Mermaid render failure: {clean_msg}")
+
+    if all_diagrams is None:
+        all_diagrams = settings.get("png_all_diagrams", False)
+    diagrams = (await run_cpu(parse_document, md_text)).diagrams
+    if not diagrams:
+        if log_fn: log_fn("Error: No Mermaid diagram found to capture.")
+        return None
+    chosen = diagrams if all_diagrams else diagrams[:1]
+    capture_md = _diagrams_markdown(chosen)
+
+    diagram_svgs = await prerender_diagrams(capture_md, settings, browser, log_fn)
+    for svg in (diagram_svgs or {}).values():
+        error = _mermaid_error_text(svg)
+        if error is not None:
+            _abort(error)
+    needs_js = _needs_mermaid_runtime(capture_md, settings, diagram_svgs)
+
+    html_content = await _document_html(capture_md, settings, diagram_svgs)
+    if html_path is not None:
+        await asyncio.get_running_loop().run_in_executor(None, lambda: html_path.write_text(html_content, encoding="utf-8"))
+
+    view_w = int(settings.get("content_width", 800))
+
+    async def _open(html: str, viewport: dict, scale: float, js: bool):
+        page = await _new_render_page(browser, settings, js, viewport=viewport, device_scale_factor=scale)
+        # Log console messages with prefix
+        if log_fn:
+            page.on("console", lambda msg: log_fn(f"BROWSER CONSOLE: {msg.text}"))
+            page.on("pageerror", lambda exc: log_fn(f"BROWSER ERROR: {exc}"))
+        # 'load' instead of 'networkidle' saves ~500ms
+        await _load_html(page, html, base_dir)
+        return page
+
+    # Pass 1: lay the diagrams out at 1x and measure them
+    page = await _open(html_content, {"width": view_w, "height": 1000}, 1, needs_js)
+    try:
+        if not needs_js:
+            if log_fn: log_fn("Diagrams pre-rendered, skipping Mermaid wait.")
         else:
-            # Wait for either a successful render or an error message
-            await page.wait_for_function("""
-                () => document.querySelector('.mermaid svg') ||
-                        document.querySelector('.mermaid-error') ||
-                        document.querySelector('.mermaid[data-processed="true"]')
-            """, timeout=60000)
-        
-        # Check for error elements or "Syntax error" in SVG
-        is_error = await page.evaluate("""
-            () => {
-                if (document.querySelector('.mermaid-error')) return true;
-                const svg = document.querySelector('.mermaid svg');
-                if (svg && (svg.textContent.includes('Syntax error') || svg.id.includes('error'))) return true;
-                // Some versions use data-processed="error" (hypothetical, but safe to check)
-                if (document.querySelector('.mermaid[data-processed="error"]')) return true;
-                return false;
-            }
-        """)
-
-        if is_error:
-            error_msg = await page.evaluate("""
-                () => {
-                    const errEl = document.querySelector('.mermaid-error');
-                    if (errEl) return errEl.innerText;
-                    const svg = document.querySelector('.mermaid svg');
-                    if (svg) return svg.textContent;
-                    return "Unknown Mermaid Error";
-                }
-            """)
-            # Standardized error reporting for terminal detection
-            clean_msg = error_msg.strip().split('\n')[0] # Get just the first line
-            if log_fn:
-                log_fn(f"\n[!] MERMAID RENDER FAILURE [!]")
-                log_fn(f"Reason: {clean_msg}")
-                log_fn(f"Status: ABORTED\n")
+            # Wait for mermaid to finish rendering
+            try:
+                if log_fn: log_fn("Waiting for Mermaid SVG...")
+
+                # Wait for every diagram to render or for an error message
+                await page.wait_for_function("""
+                    () => document.querySelector('.mermaid-error') ||
+                            [...document.querySelectorAll('.mermaid')].every(el => el.querySelector('svg') || el.dataset.processed === 'true')
+                """, timeout=_diagrams_timeout_ms(chosen, minimum=60000))
             
-            await page.close()
-            if "--gallery" not in sys.argv:
-                try: os.remove(tmp_h)
-                except: pass
-            sys.exit(1)
-
-        if has_mermaid:
-            # ⚡ Bolt: Only apply the 2000ms stabilization timeout when Mermaid diagrams are actually present.
-            # This skips an unnecessary 2-second sleep for standard documents, improving PNG generation speed.
-            await page.wait_for_timeout(2000) # Final stabilization
-    except Exception as e:
-        if log_fn: log_fn(f"Timeout or Error: {e}")
-        # Check if it was a timeout but maybe it still rendered
-        has_svg = await page.evaluate("() => document.querySelectorAll('.mermaid svg').length > 0")
-        if not has_svg:
-            if log_fn: log_fn("FAILED: No SVG generated and no explicit error detected. Probably a silent crash.")
-            await page.close()
-            sys.exit(1)
-    
-    # Get the first mermaid diagram
-    element = await page.query_selector(".mermaid")
-    if element:
-        # Clip to the element size
-        await element.screenshot(path=str(png_path.resolve()), scale="device", omit_background=False)
-        if log_fn: log_fn(f"Created: {png_path.resolve()}")
-    else:
+                # Check for error elements or "Syntax error" in SVG
+                error_msg = await page.evaluate("""
+                    () => {
+                        const errEl = document.querySelector('.mermaid-error');
+                        if (errEl) return errEl.innerText;
+                        for (const svg of document.querySelectorAll('.mermaid svg')) {
+                            if (svg.textContent.includes('Syntax error') || svg.id.includes('error')) return svg.textContent;
+                        }
+                        // Some versions use data-processed="error" (hypothetical, but safe to check)
+                        if (document.querySelector('.mermaid[data-processed="error"]')) return "Unknown Mermaid Error";
+                        return null;
+                    }
+                """)
+                if error_msg is not None:
+                    _abort(error_msg)
+
+                # ⚡ Bolt: Only apply the 2000ms stabilization timeout when Mermaid diagrams are actually present.
+                # This skips an unnecessary 2-second sleep for standard documents, improving PNG generation speed.
+                await page.wait_for_timeout(2000) # Final stabilization
+            except RuntimeError:
+                raise
+            except Exception as e:
+                if log_fn: log_fn(f"Timeout or Error: {e}")
+                # Check if it was a timeout but maybe it still rendered
+                has_svg = await page.evaluate("() => document.querySelectorAll('.mermaid svg').length > 0")
+                if not has_svg:
+                    if log_fn: log_fn("FAILED: No SVG generated and no explicit error detected. Probably a silent crash.")
+                    raise RuntimeError("No SVG generated and no explicit error detected")
+
+            # Reuse the in-page renders so the capture page needs no JavaScript
+            rendered = await page.eval_on_selector_all(".mermaid", "els => els.map(el => el.innerHTML)")
+            html_content = await _document_html(capture_md, settings, dict(enumerate(rendered)))
+
+        box = await page.evaluate(_MEASURE_DIAGRAMS_JS)
+    finally:
+        await page.close()
+
+    if not box or box["width"] <= 0 or box["height"] <= 0:
         if log_fn: log_fn("Error: No Mermaid diagram found to capture.")
+        return None
 
-    await page.close()
+    # Pass 2: capture at the target resolution with a viewport just covering the diagrams
+    scale = _png_scale(box["width"], box["height"], settings)
+    viewport = {"width": view_w, "height": max(1, math.ceil(box["y"] + box["height"]))}
+    if log_fn: log_fn(f"Capturing {math.ceil(box['width'] * scale)}x{math.ceil(box['height'] * scale)} px (scale {scale:.2f})")
+    page = await _open(html_content, viewport, scale, False)
+    try:
+        png_bytes = await page.screenshot(clip=box, scale="device", omit_background=False)
+    finally:
+        await page.close()
 
-    # KEEP tmp_h for debugging in gallery mode
-    if "--gallery" not in sys.argv:
-        try: os.remove(tmp_h)
-        except: pass
+    result = _write_output(png_bytes, output)
+    if log_fn and isinstance(output, (str, Path)): log_fn(f"Created: {Path(output).resolve()}")
+    return result
 
-async def generate_png_core(md_path: Path, png_path: Path, settings: dict, log_fn=print, prog_fn=None, browser=None) -> None:
-    def _check_mermaid():
-        text = md_path.read_text("utf-8")
-        return bool(MERMAID_PATTERN.search(text))
+async def render_png_page(browser, md_path: Path, png_path: Path, settings: dict, log_fn=print, prog_fn=None, md_text: Optional[str] = None) -> None:
+    theme_name = settings.get("theme", "GitHub Light")
+    if log_fn: log_fn(f"Rendering PNG ({theme_name}): {md_path.name}")
+    
+    if md_text is None:
+        md_text = await asyncio.get_running_loop().run_in_executor(None, lambda: md_path.read_text(encoding="utf-8"))
 
+    # KEEP the generated HTML for debugging in gallery mode
+    html_path = None
+    if "--gallery" in sys.argv or settings.get("save_html", False):
+        html_path = md_path.with_suffix(f".{uuid.uuid4().hex[:8]}.tmp.html")
+
+    try:
+        await render_png(md_text, png_path, settings, md_path.parent, log_fn, prog_fn, browser, html_path=html_path)
+    except RuntimeError:
+        sys.exit(1)
+
+async def generate_png_core(md_path: Path, png_path: Path, settings: dict, log_fn=print, prog_fn=None, browser=None) -> None:
     try:
         loop = asyncio.get_running_loop()
-        has_mermaid = await loop.run_in_executor(None, _check_mermaid)
+        md_text = await loop.run_in_executor(None, lambda: md_path.read_text("utf-8"))
+        diagram = extract_pure_mermaid(md_text)
+        has_mermaid = diagram is not None or bool((await run_cpu(parse_document, md_text)).diagrams)
     except Exception as e:
         if log_fn: log_fn(f"Error reading {md_path}: {e}")
         return
 
+    if diagram is not None:
+        if log_fn: log_fn("Single diagram detected, using the diagram fast path.")
+        await render_diagram(diagram, "png", settings, png_path, browser, log_fn)
+        return
+
     if not has_mermaid:
         if log_fn: log_fn(f"Skipping PNG generation: No Mermaid diagrams found in {md_path.name}")
         return
 
     if browser:
-        await render_png_page(browser, md_path, png_path, settings, log_fn, prog_fn)
+        await render_png_page(browser, md_path, png_path, settings, log_fn, prog_fn, md_text=md_text)
     else:
         browser_instance = await _get_browser()
-        await render_png_page(browser_instance, md_path, png_path, settings, log_fn, prog_fn)
+        await render_png_page(browser_instance, md_path, png_path, settings, log_fn, prog_fn, md_text=md_text)
 
-async def generate_docx_core(md_path: Path, docx_path: Path, log_fn=print, prog_fn=None, settings: dict=None, browser=None) -> None:
-    if log_fn: log_fn(f"Converting to DOCX: {md_path.name}")
-    if prog_fn: prog_fn(10)
-    
-    # Check for pandoc
+async def _ensure_pandoc() -> None:
+    """Checks for pandoc once per process; raises RuntimeError when it is missing."""
     global _PANDOC_AVAILABLE
     if _PANDOC_AVAILABLE is None:
         try:
@@ -656,221 +2322,883 @@ async def generate_docx_core(md_path: Path, docx_path: Path, log_fn=print, prog_
 
     if _PANDOC_AVAILABLE is False:
         raise RuntimeError("Pandoc not found. Please install pandoc to export to DOCX.")
-    
-    # Determine Theme Colors for Alerts
-    theme_name = settings.get("theme", "GitHub Light") if settings else "GitHub Light"
-    if theme_name not in THEMES: theme_name = "GitHub Light"
-    t = THEMES[theme_name]
-    
-    # Define Alert Styles based on Theme
-    # Note: Pandoc handles minimal CSS on tables. We use border-left and background.
-    alert_styles = {
-        "NOTE": {"color": "#0969da", "bg": t['secondary'], "icon": "ℹ️"},
-        "TIP": {"color": "#1f883d", "bg": t['secondary'], "icon": "💡"},
-        "IMPORTANT": {"color": "#8250df", "bg": t['secondary'], "icon": "📢"},
-        "WARNING": {"color": "#bf8700", "bg": t['secondary'], "icon": "⚠️"},
-        "CAUTION": {"color": "#cf222e", "bg": t['secondary'], "icon": "🛑"}
-    }
-    
-    # Override for Dark Modes to ensure visibility
-    if "Dark" in theme_name or "Dracula" in theme_name or "Cyberpunk" in theme_name or "Obsidian" in theme_name or "Monokai" in theme_name:
-         alert_styles["NOTE"]["color"] = "#58a6ff"
-         alert_styles["TIP"]["color"] = "#3fb950"
-         alert_styles["IMPORTANT"]["color"] = "#a371f7"
-         alert_styles["WARNING"]["color"] = "#d29922"
-         alert_styles["CAUTION"]["color"] = "#f85149"
-
-    if prog_fn: prog_fn(20)
 
-    try:
-        md_text = await asyncio.get_running_loop().run_in_executor(None, lambda: md_path.read_text(encoding="utf-8"))
-    except UnicodeDecodeError:
-        raise ValueError(f"The file '{md_path.name}' is not a valid text file. Please ensure you are converting a Markdown (.md) file, not a binary file like PDF or Image.")
-    
-    # --- PROCESS ALERTS ---
-    # ⚡ Bolt: Fast-path optimization. Bypass expensive line-by-line processing
-    # if the document clearly contains no alerts.
-    if "[!" in md_text and re.search(r"^\s*>\s*\[!", md_text, re.MULTILINE):
-        # Regex to capture > [!TYPE] ... content ...
-        # We iterate line by line to handle the quote blocks correctly
-        lines = md_text.split('\n')
-        processed_lines = []
-        in_alert = False
-        alert_type = None
-        alert_content = []
-
-        for line in lines:
-            # Optimization: fast skip for non-alert lines
-            if not in_alert and '>' not in line:
-                processed_lines.append(line)
-                continue
+class PandocServer:
+    """
+    A long-lived `pandoc server` process converting documents over its local
+    HTTP API. Start-up is paid once per session instead of once per document.
+    The server has no filesystem access, so every resource a document uses
+    is sent along with it. The process is a plain Popen so it outlives the
+    event loop that started it (headless runs use one asyncio.run per file).
+    """
 
-            # Check for alert header with flexible whitespace
-            # matches: > [!NOTE],   > [!NOTE], >[!NOTE]
-            match = ALERT_PATTERN.match(line)
-            if match:
-                # If we were already in an alert, close it first
-                if in_alert:
-                    style = alert_styles.get(alert_type.upper(), alert_styles["NOTE"])
-                    c_html = "<br/>".join(alert_content)
-                    html_table = f'<table style="width:100%; border-left: 5px solid {style["color"]}; background-color: {style["bg"]}; margin-bottom: 10px;"><tr><td style="padding: 10px;"><strong>{style["icon"]} {alert_type.upper()} - </strong><br/>{c_html}</td></tr></table>'
-                    processed_lines.append(html_table)
-                    processed_lines.append("") # Ensure separation
-                    alert_content = []
-
-                in_alert = True
-                alert_type = match.group(1).upper()
+    def __init__(self, proc, port: int):
+        self.proc = proc
+        self.url = f"http://127.0.0.1:{port}"
+
+    @classmethod
+    async def start(cls, timeout: float = 5.0) -> "PandocServer":
+        """Launches the server on a free local port; raises RuntimeError if it never answers."""
+        import socket
+        import time
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            port = sock.getsockname()[1]
+        try:
+            proc = subprocess.Popen(["pandoc", "server", "--port", str(port), "--timeout", "120"],
+                                    stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        except OSError:
+            raise RuntimeError("pandoc not found")
+        server = cls(proc, port)
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if proc.poll() is not None:
+                break
+            try:
+                await asyncio.get_running_loop().run_in_executor(None, server._request, "/version", None, 1)
+                return server
+            except OSError:
+                await asyncio.sleep(0.05)
+        server.close()
+        raise RuntimeError("pandoc server did not start")
+
+    def _request(self, path: str, payload: Optional[dict], timeout: float = 130):
+        import urllib.request
+        data = json.dumps(payload).encode("utf-8") if payload is not None else None
+        req = urllib.request.Request(self.url + path, data=data, headers={"Content-Type": "application/json", "Accept": "application/json"})
+        with urllib.request.urlopen(req, timeout=timeout) as response:
+            return response.read()
+
+    def _convert(self, md_text: str, files: dict) -> bytes:
+        import urllib.error
+        payload = {"text": md_text, "from": "markdown", "to": "docx",
+                   "files": {name: base64.b64encode(data).decode("ascii") for name, data in files.items()}}
+        try:
+            body = self._request("/", payload)
+        except urllib.error.HTTPError as e:
+            raise RuntimeError(f"Pandoc failed: {e.read().decode('utf-8', 'replace')}")
+        result = json.loads(body)
+        if result.get("error"):
+            raise RuntimeError(f"Pandoc failed: {result['error']}")
+        output = result["output"]
+        return base64.b64decode(output) if result.get("base64") else output.encode("utf-8")
+
+    async def convert(self, md_text: str, files: dict) -> bytes:
+        """Converts markdown to DOCX bytes; files maps the paths the markdown references to their contents."""
+        return await asyncio.get_running_loop().run_in_executor(None, self._convert, md_text, files)
+
+    @property
+    def alive(self) -> bool:
+        return self.proc.poll() is None
+
+    def close(self) -> None:
+        if self.alive:
+            self.proc.kill()
+            self.proc.wait()
+
+_pandoc_server = None
+_pandoc_server_lock = None
+_pandoc_server_failed = False
+
+async def _get_pandoc_server() -> Optional[PandocServer]:
+    """Returns the shared PandocServer, starting it on first use, or None when pandoc cannot run as a server."""
+    global _pandoc_server, _pandoc_server_lock, _pandoc_server_failed
+    if _pandoc_server_lock is None:
+        _pandoc_server_lock = asyncio.Lock()
+    async with _pandoc_server_lock:
+        if _pandoc_server is not None and not _pandoc_server.alive:
+            _pandoc_server = None # Exited; start a fresh one
+        if _pandoc_server is None and not _pandoc_server_failed:
+            try:
+                _pandoc_server = await PandocServer.start()
+                import atexit
+                atexit.register(_pandoc_server.close)
+            except RuntimeError:
+                _pandoc_server_failed = True
+        return _pandoc_server
+
+def _pandoc_files(md_text: str, resource_dirs: list) -> dict:
+    """Reads every local image the markdown references, keyed the way it is referenced, for pandoc server."""
+    files = {}
+    for ref in parse_document(md_text).images:
+        if not ref or ref in files or "://" in ref or ref.startswith("data:"):
+            continue
+        candidates = [Path(ref)] if Path(ref).is_absolute() else [Path(d) / ref for d in resource_dirs]
+        for candidate in candidates:
+            try:
+                files[ref] = candidate.read_bytes()
+                break
+            except OSError:
                 continue
+    return files
 
-            if in_alert:
-                # Check if line continues the blockquote
-                if line.strip().startswith(">"):
-                    # Remove the first > and stripping leading spaces
-                    # Be careful not to strip too much indentation from content
-                    content = line.strip()[1:]
-                    if content.startswith(" "): content = content[1:]
-                    alert_content.append(content)
-                else:
-                    # End of alert block
-                    style = alert_styles.get(alert_type.upper(), alert_styles["NOTE"])
-                    c_html = "<br/>".join(alert_content)
-                    html_table = f'<table style="width:100%; border-left: 5px solid {style["color"]}; background-color: {style["bg"]}; margin-bottom: 10px;"><tr><td style="padding: 10px; color: {t["txt"]};"><strong>{style["icon"]} {alert_type.upper()} - </strong><br/>{c_html}</td></tr></table>'
-                    processed_lines.append(html_table)
-                    processed_lines.append("") # Spacer
-                    in_alert = False
-                    alert_content = []
-                    processed_lines.append(line)
+async def _run_pandoc(md_text: str, output, resource_dirs: list, settings: Optional[dict] = None) -> Optional[bytes]:
+    """
+    Converts markdown to DOCX with pandoc over pipes: the markdown goes in on
+    stdin, and the DOCX is written to output when it is a path, otherwise read
+    back from stdout and delivered like _write_output. Relative images resolve
+    against resource_dirs. The pandoc process is killed if the task is cancelled.
+    """
+    if (settings or {}).get("pandoc_server", True):
+        server = await _get_pandoc_server()
+        if server is not None:
+            files = await run_cpu(_pandoc_files, md_text, resource_dirs)
+            try:
+                data = await server.convert(md_text, files)
+            except OSError:
+                server.close() # Unreachable; this document falls back to a subprocess
             else:
-                processed_lines.append(line)
-
-        # Flush pending alert at end of file
-        if in_alert:
-            style = alert_styles.get(alert_type.upper(), alert_styles["NOTE"])
-            c_html = "<br/>".join(alert_content)
-            html_table = f'<table style="width:100%; border-left: 5px solid {style["color"]}; background-color: {style["bg"]}; margin-bottom: 10px;"><tr><td style="padding: 10px; color: {t["txt"]};"><strong>{style["icon"]} {alert_type.upper()} - </strong><br/>{c_html}</td></tr></table>'
-            processed_lines.append(html_table)
-            processed_lines.append("")
-            
-        md_text = "\n".join(processed_lines)
-    
-    mermaid_blocks = list(MERMAID_PATTERN.finditer(md_text))
-    
-    temp_images = []
-    temp_files_to_cleanup = []
-    
+                return await asyncio.get_running_loop().run_in_executor(None, _write_output, data, output)
+
+    await _ensure_pandoc()
+    target = str(Path(output).resolve()) if isinstance(output, (str, Path)) else "-"
+    cmd = ["pandoc", "-f", "markdown", "-t", "docx", "--resource-path", os.pathsep.join(str(d) for d in resource_dirs), "-o", target]
+    proc = await asyncio.create_subprocess_exec(*cmd, stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+    try:
+        stdout, stderr = await proc.communicate(md_text.encode("utf-8"))
+    except BaseException:
+        if proc.returncode is None:
+            proc.kill()
+            await proc.wait()
+        raise
+
+    if proc.returncode != 0:
+        raise RuntimeError(f"Pandoc failed: {stderr.decode()}")
+    if target != "-":
+        return None
+    return await asyncio.get_running_loop().run_in_executor(None, _write_output, stdout, output)
+
+async def _prepare_docx(md_text: str, scratch: Path, settings: Optional[dict], base_dir: Path, out_path: Optional[Path], log_fn=print, prog_fn=None, browser=None) -> str:
+    """
+    The browser half of a DOCX conversion: renders the diagrams into scratch
+    and returns the pandoc-ready markdown that references them by name.
+    """
+    # Determine Theme Colors for Alerts
+    theme_name = settings.get("theme", "GitHub Light") if settings else "GitHub Light"
+    if theme_name not in THEMES: theme_name = "GitHub Light"
+
+    # One analysis pass gives the diagram spans and alerts; parsing runs off the event loop
+    doc = await run_cpu(parse_document, md_text)
+    mermaid_blocks = doc.diagram_spans
+
+    loop = asyncio.get_running_loop()
+    temp_images = {}
     if mermaid_blocks:
         if log_fn: log_fn(f"Found {len(mermaid_blocks)} diagrams. Rendering...")
         if prog_fn: prog_fn(30)
-        
+
         # Override settings for images to use the selected Theme
         img_settings = settings.copy() if settings else {"theme": "GitHub Light", "mermaid_enabled": True, "content_width": 800}
         img_settings["mermaid_enabled"] = True
-        
-        html_content = create_html_content(md_text, img_settings)
-        
-        tmp_h = md_path.with_suffix(f".{uuid.uuid4()}.tmp.html")
-        temp_files_to_cleanup.append(tmp_h)
-        await asyncio.get_running_loop().run_in_executor(None, lambda: tmp_h.write_text(html_content, encoding="utf-8"))
-
-            
-        async def render_docx_page(browser_inst):
-            page = await browser_inst.new_page(device_scale_factor=2) # Higher DPI for docs
-            abs_url = f"file:///{str(tmp_h.resolve()).replace(os.sep, '/')}"
-            await page.goto(abs_url, wait_until="load")
-            
-            # Smart wait for diagrams
+        # ⚡ Bolt: "docx_diagrams": "svg" embeds the vector diagrams themselves,
+        # drawn with SVG text labels since Word cannot display HTML in a
+        # <foreignObject>. Only diagrams that still need one (or failed) are
+        # rasterized, and the page is not even opened when none do.
+        vector = img_settings.get("docx_diagrams", "png") == "svg"
+        if vector:
+            img_settings["mermaid_html_labels"] = False
+        save_diagrams = bool(settings and settings.get("save_diagrams", False) and out_path is not None)
+        save_svgs = save_diagrams and settings.get("diagram_format", "png") == "svg"
+
+        if browser is None:
+            browser = await _get_browser()
+        diagram_svgs = await prerender_diagrams(md_text, img_settings, browser, log_fn)
+        svgs = _standalone_svgs(diagram_svgs, theme_name) if diagram_svgs else {}
+
+        async def _embed_svgs():
+            for i, svg in svgs.items():
+                if i < len(mermaid_blocks) and i not in temp_images and _docx_svg_ok(svg):
+                    temp_images[i] = scratch / f"diagram_{i}.svg"
+                    await loop.run_in_executor(None, lambda p=temp_images[i], svg=svg: p.write_text(svg, encoding="utf-8"))
+
+        if vector:
+            await _embed_svgs()
+        # Saved PNG diagrams need every diagram captured
+        need_png = save_diagrams and not save_svgs
+        need_png = need_png or len(temp_images) < len(mermaid_blocks) or (save_svgs and not svgs)
+
+        if need_png:
+            needs_js = _needs_mermaid_runtime(md_text, img_settings, diagram_svgs)
+            html_content = await _document_html(md_text, img_settings, diagram_svgs)
+
+            page = await _new_render_page(browser, img_settings, needs_js, device_scale_factor=2) # Higher DPI for docs
             try:
-                await page.wait_for_function("""
-                    () => {
-                        const all = document.querySelectorAll('.mermaid');
-                        const processed = document.querySelectorAll('.mermaid[data-processed="true"]');
-                        const error = document.querySelectorAll('.mermaid-error');
-                        return (processed.length + error.length) === all.length;
-                    }
-                """, timeout=10000)
-                await page.wait_for_timeout(500) # Buffer for layout
-            except Exception as e:
-                if log_fn: log_fn(f"Warning: Timeout waiting for diagrams: {e}")
+                await _load_html(page, html_content, base_dir)
 
-            elements = await page.locator(".mermaid").all()
-            
-            if len(elements) != len(mermaid_blocks):
-                 if log_fn: log_fn(f"Warning: Block count ({len(mermaid_blocks)}) != Element count ({len(elements)})")
-            
-            for i, (block, element) in enumerate(zip(mermaid_blocks, elements)):
-                 img_path = md_path.parent / f"diagram_{uuid.uuid4()}.png"
-                 await element.screenshot(path=str(img_path))
-                 temp_images.append(img_path)
-                 temp_files_to_cleanup.append(img_path)
+                # Smart wait for diagrams (pre-rendered diagrams are already in the page)
+                if needs_js:
+                    try:
+                        await page.wait_for_function("""
+                            () => {
+                                const all = document.querySelectorAll('.mermaid');
+                                const processed = document.querySelectorAll('.mermaid[data-processed="true"]');
+                                const error = document.querySelectorAll('.mermaid-error');
+                                return (processed.length + error.length) === all.length;
+                            }
+                        """, timeout=_diagrams_timeout_ms(doc.diagrams))
+                        await page.wait_for_timeout(500) # Buffer for layout
+                    except Exception as e:
+                        if log_fn: log_fn(f"Warning: Timeout waiting for diagrams: {e}")
+
+                if not svgs and (save_svgs or vector):
+                    svgs = await _serialize_page_svgs(page)
+                    if vector:
+                        await _embed_svgs()
+
+                keep_all = save_diagrams and not save_svgs
+                captured = await capture_diagrams(page, lambda i: scratch / f"diagram_{i}.png" if keep_all or i not in temp_images else None)
+            finally:
+                await page.close()
+
+            if len(captured) != len(mermaid_blocks):
+                 if log_fn: log_fn(f"Warning: Block count ({len(mermaid_blocks)}) != Element count ({len(captured)})")
+
+            for i, img_path in enumerate(captured[:len(mermaid_blocks)]):
+                 if img_path is None:
+                     continue
+                 temp_images.setdefault(i, img_path)
 
                  # Save to output if enabled
-                 if settings and settings.get("save_diagrams", False):
+                 if keep_all:
                      try:
-                         d_out = docx_path.parent / f"{docx_path.stem}_diagram_{i+1}.png"
-                         await asyncio.get_running_loop().run_in_executor(None, shutil.copy2, img_path, d_out)
+                         d_out = out_path.parent / f"{out_path.stem}_diagram_{i+1}.png"
+                         await loop.run_in_executor(None, shutil.copy2, img_path, d_out)
                          if log_fn: log_fn(f"Saved diagram: {d_out}")
                      except Exception as e:
                          if log_fn: log_fn(f"Failed to save diagram png: {e}")
 
                  if log_fn: log_fn(f"Captured diagram {i+1}")
-            await page.close()
 
-        if browser:
-            await render_docx_page(browser)
+        if save_svgs:
+            await _write_diagram_svgs(svgs, out_path.parent, out_path.stem, log_fn)
+        if vector and log_fn:
+            embedded = sum(1 for path in temp_images.values() if path.suffix == ".svg")
+            log_fn(f"Embedded {embedded} diagrams as SVG, {len(temp_images) - embedded} as PNG.")
+
+    # Replace diagram blocks with images and alerts with pandoc-ready tables.
+    # Build the result in a single forward pass (O(N)) over the spans from the
+    # one parse instead of repeatedly slicing the whole string per block (O(N^2)).
+    replacements = []
+    for i, (start, end) in enumerate(mermaid_blocks):
+        if i not in temp_images:
+            continue
+        # Scratch images are referenced by name and found through --resource-path
+        # Keep the list indent / quote markers of blocks nested in other blocks
+        prefix = _block_prefix(md_text, start)
+        replacements.append((start, end, f"{prefix}![Diagram]({temp_images[i].name})"))
+    if doc.alerts:
+        alerts = await run_cpu(doc.alert_blocks)
+        replacements.extend((start, end, _block_prefix(md_text, start, own_quote=True) + _alert_table_html(kind, body, theme_name))
+                            for kind, start, end, body in alerts)
+    replacements.sort(key=lambda rep: rep[0])
+
+    parts = []
+    last_end = 0
+    for start, end, text in replacements:
+        if start < last_end:
+            continue # Inside an alert that was already replaced
+        parts.append(md_text[last_end:start])
+        parts.append(text)
+        last_end = end
+    parts.append(md_text[last_end:])
+    modified_md = "".join(parts)
+
+    return modified_md
+
+async def render_docx(md_text: str, output, settings: Optional[dict] = None, base_dir: Optional[Path] = None, log_fn=print, prog_fn=None, browser=None) -> Optional[bytes]:
+    """
+    Renders markdown text to DOCX. Returns the bytes when output is None,
+    otherwise writes to output (a path or a binary stream).
+
+    ⚡ Bolt: Nothing is staged next to the source. The diagram page is loaded
+    from memory, diagram PNGs go to a private scratch directory that is removed
+    even on errors or cancellation, and pandoc reads the rewritten markdown on
+    stdin and streams the DOCX back on stdout when output is not a file.
+    Works on read-only source trees and leaves no diagram_*.png behind.
+    Conversions go to a persistent pandoc server when one can be started
+    ("pandoc_server", default on), otherwise to one pandoc process each.
+    """
+    if not (settings or {}).get("pandoc_server", True):
+        await _ensure_pandoc()
+    if prog_fn: prog_fn(20)
+
+    base_dir = Path(base_dir) if base_dir else Path.cwd()
+    out_path = Path(output) if isinstance(output, (str, Path)) else None
+    loop = asyncio.get_running_loop()
+    scratch = Path(await loop.run_in_executor(None, tempfile.mkdtemp, None, "md2docx_"))
+    try:
+        modified_md = await _prepare_docx(md_text, scratch, settings, base_dir, out_path, log_fn, prog_fn, browser)
+
+        if prog_fn: prog_fn(60)
+        if log_fn: log_fn(f"Running pandoc...")
+        result = await _run_pandoc(modified_md, output, [scratch, base_dir], settings)
+    finally:
+        await asyncio.shield(loop.run_in_executor(None, lambda: shutil.rmtree(scratch, ignore_errors=True)))
+
+    if prog_fn: prog_fn(100)
+    if log_fn and out_path is not None: log_fn(f"Created: {out_path.name}")
+    return result
+
+async def generate_docx_core(md_path: Path, docx_path: Path, log_fn=print, prog_fn=None, settings: dict=None, browser=None) -> None:
+    if log_fn: log_fn(f"Converting to DOCX: {md_path.name}")
+    if prog_fn: prog_fn(10)
+
+    try:
+        md_text = await asyncio.get_running_loop().run_in_executor(None, lambda: md_path.read_text(encoding="utf-8"))
+    except UnicodeDecodeError:
+        raise ValueError(f"The file '{md_path.name}' is not a valid text file. Please ensure you are converting a Markdown (.md) file, not a binary file like PDF or Image.")
+
+    await render_docx(md_text, docx_path, settings, md_path.parent, log_fn, prog_fn, browser)
+
+
+OUTPUT_FORMATS = ("pdf", "png", "docx", "svg")
+
+async def convert_markdown(md_text: str, fmt: str = "pdf", settings: Optional[dict] = None, output=None, base_dir: Optional[Path] = None, log_fn=print, prog_fn=None, browser=None) -> Optional[bytes]:
+    """
+    Public text-in / bytes-out conversion API.
+    Converts markdown text to PDF, PNG or DOCX without staging the source on disk,
+    or a single bare/fenced Mermaid diagram to SVG.
+    Returns the bytes when output is None, otherwise writes them to output
+    (a path or a binary stream such as sys.stdout.buffer) and returns None.
+    Relative resources resolve against base_dir (default: the working directory).
+    """
+    fmt = fmt.lower()
+    if fmt not in OUTPUT_FORMATS:
+        raise ValueError(f"Unsupported output format '{fmt}'. Expected one of: {', '.join(OUTPUT_FORMATS)}")
+    if settings is None:
+        settings = load_settings()
+    base_dir = Path(base_dir) if base_dir else Path.cwd()
+
+    if fmt in ("pdf", "png", "svg"):
+        diagram = extract_pure_mermaid(md_text)
+        if diagram is None and fmt == "svg":
+            raise ValueError("SVG output needs a single Mermaid diagram; use export_diagrams_svg for documents")
+        if diagram is not None:
+            if log_fn: log_fn("Single diagram detected, using the diagram fast path.")
+            return await render_diagram(diagram, fmt, settings, output, browser, log_fn)
+
+    loop = asyncio.get_running_loop()
+    temp_dir_str = await loop.run_in_executor(None, tempfile.mkdtemp)
+    try:
+        temp_path = Path(temp_dir_str)
+        md_text = await loop.run_in_executor(None, process_resources, md_text, temp_path)
+        if prog_fn: prog_fn(20)
+
+        if fmt == "pdf":
+            return await render_pdf(md_text, output, settings, base_dir, log_fn, prog_fn, browser)
+        if fmt == "png":
+            if not (await run_cpu(parse_document, md_text)).diagrams:
+                if log_fn: log_fn("Skipping PNG generation: No Mermaid diagrams found")
+                return None
+            return await render_png(md_text, output, settings, base_dir, log_fn, prog_fn, browser)
+
+        return await render_docx(md_text, output, settings, base_dir, log_fn, prog_fn, browser)
+    finally:
+        await loop.run_in_executor(None, lambda: shutil.rmtree(temp_dir_str, ignore_errors=True))
+
+BATCH_FORMATS = ("pdf", "png", "docx")
+
+async def convert_batch(md_paths: list, fmt: str = "pdf", settings: Optional[dict] = None, out_dir: Optional[Path] = None, log_fn=print, browser=None) -> list:
+    """
+    ⚡ Bolt: Pipelined multi-document conversion. Every document passes through
+    the same stages (load + resource downloads -> parse -> browser render ->
+    pandoc for DOCX), but each stage has its own bounded set of workers and a
+    bounded queue in front of it, so while one document holds a browser page
+    the next is downloading and parsing and the previous one is in pandoc.
+    Full queues stall the stage before them (backpressure), which keeps the
+    number of documents in memory bounded. Batch time approaches the time of
+    the slowest stage instead of the sum of all of them.
+
+    Slots per stage come from "batch_io_workers", "batch_cpu_workers",
+    "batch_page_slots", "batch_pandoc_slots" and "batch_optimize_slots" (0 =
+    automatic); the optimize stage only exists with "pdf_optimize". Outputs go to
+    out_dir (default: next to each input). Returns [(input, output, error)] in
+    input order; output is None for skipped documents, error None on success.
+    """
+    fmt = fmt.lower()
+    if fmt not in BATCH_FORMATS:
+        raise ValueError(f"Unsupported batch format '{fmt}'. Expected one of: {', '.join(BATCH_FORMATS)}")
+    if settings is None:
+        settings = load_settings()
+    loop = asyncio.get_running_loop()
+    cpus = os.cpu_count() or 1
+    optimize = fmt == "pdf" and settings.get("pdf_optimize", False)
+
+    jobs = []
+    for md_path in md_paths:
+        md_path = Path(md_path)
+        out_path = (Path(out_dir) if out_dir else md_path.parent) / f"{md_path.stem}.{fmt}"
+        jobs.append({"input": md_path, "output": out_path, "error": None, "text": None, "scratch": []})
+
+    async def _load(job):
+        md_path = job["input"]
+        try:
+            md_text = await loop.run_in_executor(None, lambda: md_path.read_text(encoding="utf-8"))
+        except UnicodeDecodeError:
+            raise ValueError(f"The file '{md_path.name}' is not a valid text file.")
+        temp_dir = await loop.run_in_executor(None, tempfile.mkdtemp)
+        job["scratch"].append(temp_dir)
+        job["text"] = await loop.run_in_executor(None, process_resources, md_text, Path(temp_dir))
+
+    async def _parse(job):
+        # Warms the parse cache, so the render stage starts from tokens
+        doc = await run_cpu(parse_document, job["text"])
+        if fmt == "png" and not doc.diagrams:
+            if log_fn: log_fn(f"Skipping PNG generation: No Mermaid diagrams found in {job['input'].name}")
+            job["output"] = None
+
+    async def _render(job):
+        if job["output"] is None:
+            return
+        md_text, base_dir = job["text"], job["input"].parent
+        if fmt == "docx":
+            scratch = await loop.run_in_executor(None, tempfile.mkdtemp, None, "md2docx_")
+            job["scratch"].append(scratch)
+            job["text"] = await _prepare_docx(md_text, Path(scratch), settings, base_dir, job["output"], log_fn, None, browser)
+            return
+        diagram = extract_pure_mermaid(md_text)
+        if diagram is not None:
+            await render_diagram(diagram, fmt, settings, job["output"], browser, log_fn)
+        elif fmt == "pdf":
+            html_path = job["input"].with_suffix(".tmp.html") if settings.get("save_html", False) else None
+            if optimize:
+                # Bytes go on to the optimize stage, freeing the page for the next document
+                job["pdf"] = await render_pdf(md_text, None, dict(settings, pdf_optimize=False), base_dir, log_fn, None, browser, html_path=html_path)
+            else:
+                await render_pdf(md_text, job["output"], settings, base_dir, log_fn, None, browser, html_path=html_path)
         else:
-            browser_instance = await _get_browser()
-            await render_docx_page(browser_instance)
-            
-        # Replace blocks in MD text with images.
-        # Build the result in a single forward pass (O(N)) instead of repeatedly
-        # slicing the whole string per block (O(N^2)).
-        parts = []
-        last_end = 0
-        for i, match in enumerate(mermaid_blocks):
-            parts.append(md_text[last_end:match.start()])
-            if i < len(temp_images):
-                # Absolute path for safety since pandoc may run from anywhere
-                abs_img_path = str(temp_images[i].resolve()).replace("\\", "/")
-                parts.append(f"![Diagram]({abs_img_path})")
+            await render_png(md_text, job["output"], settings, base_dir, log_fn, None, browser)
+
+    async def _pandoc(job):
+        if job["output"] is not None:
+            await _run_pandoc(job["text"], job["output"], [job["scratch"][-1], job["input"].parent], settings)
+
+    async def _optimize(job):
+        if job.get("pdf") is not None:
+            data = await postprocess_pdf(job.pop("pdf"), settings, log_fn)
+            await loop.run_in_executor(None, _write_output, data, job["output"])
+
+    def _cleanup(job):
+        job["text"] = None
+        job.pop("pdf", None)
+        for path in job["scratch"]:
+            shutil.rmtree(path, ignore_errors=True)
+        job["scratch"] = []
+
+    # Browser pages are the expensive slot: their count adapts to the host
+    # unless "batch_page_slots" pins it
+    page_slots = int(settings.get("batch_page_slots", 0))
+    controller = ConcurrencyController(dict(settings, max_concurrency=page_slots) if page_slots else settings)
+
+    async def _render_adaptive(job):
+        if job["output"] is None:
+            return
+        # Latency per 10 kB, so small and large documents compare fairly
+        async with controller.slot(max(1.0, len(job["text"]) / 10_000)):
+            await _render(job)
+
+    stages = [
+        (_load, int(settings.get("batch_io_workers", 0)) or 4),
+        (_parse, int(settings.get("batch_cpu_workers", 0)) or min(4, cpus)),
+        (_render_adaptive, controller.max_limit),
+    ]
+    if fmt == "docx":
+        if not settings.get("pandoc_server", True):
+            await _ensure_pandoc()
+        stages.append((_pandoc, int(settings.get("batch_pandoc_slots", 0)) or min(4, cpus)))
+    if optimize:
+        stages.append((_optimize, int(settings.get("batch_optimize_slots", 0)) or min(4, cpus)))
+    queues = [asyncio.Queue(maxsize=slots) for _, slots in stages]
+
+    async def _feed():
+        for job in jobs:
+            await queues[0].put(job)
+        for _ in range(stages[0][1]):
+            await queues[0].put(None)
+
+    async def _worker(k):
+        stage_fn = stages[k][0]
+        while True:
+            job = await queues[k].get()
+            if job is None:
+                return
+            if job["error"] is None:
+                try:
+                    await stage_fn(job)
+                except Exception as e:
+                    job["error"] = e
+                    if log_fn: log_fn(f"Failed: {job['input'].name}: {e}")
+            if k + 1 < len(stages) and job["error"] is None:
+                await queues[k + 1].put(job)
             else:
-                # Diagram failed to render; keep the original mermaid block
-                parts.append(match.group(0))
-            last_end = match.end()
-        parts.append(md_text[last_end:])
-        modified_md = "".join(parts)
+                await loop.run_in_executor(None, _cleanup, job)
+                if log_fn and job["error"] is None and job["output"] is not None:
+                    log_fn(f"Created: {job['output'].name}")
+
+    async def _stage(k):
+        await asyncio.gather(*(_worker(k) for _ in range(stages[k][1])))
+        if k + 1 < len(stages):
+            for _ in range(stages[k + 1][1]):
+                await queues[k + 1].put(None)
+
+    try:
+        await asyncio.gather(_feed(), *(_stage(k) for k in range(len(stages))))
+    finally:
+        for job in jobs:
+            await asyncio.shield(loop.run_in_executor(None, _cleanup, job))
+    return [(job["input"], job["output"], job["error"]) for job in jobs]
+
+# --- Spool Directory Worker ---
+# Jobs are <name>.job.json files dropped into a spool directory. A worker claims
+# one by renaming it to <name>.job.json.<worker>.claimed (rename is atomic, also
+# on NFS, so exactly one worker wins) and leaves <name>.result.json or
+# <name>.error.json next to it when done.
+SPOOL_JOB_SUFFIX = ".job.json"
+SPOOL_CLAIM_SUFFIX = ".claimed"
+
+def _spool_worker_id() -> str:
+    import socket
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+def _spool_job_name(path: Path) -> str:
+    return path.name[:path.name.index(SPOOL_JOB_SUFFIX)]
+
+def _write_json_atomic(path: Path, data: dict) -> None:
+    """Writes data so readers on any host see either nothing or the complete record."""
+    tmp = path.with_name(f".{path.name}.{uuid.uuid4().hex[:8]}.tmp")
+    tmp.write_text(json.dumps(data, indent=2), encoding="utf-8")
+    os.replace(tmp, path)
+
+def _claim_spool_job(spool_dir: Path, worker_id: str) -> Optional[Path]:
+    """Claims the oldest unclaimed job by renaming it; returns the claimed path or None."""
+    pending = []
+    for job in spool_dir.glob(f"*{SPOOL_JOB_SUFFIX}"):
+        try:
+            pending.append((job.stat().st_mtime, job.name, job))
+        except FileNotFoundError:
+            continue # Claimed by another worker meanwhile
+    for _, _, job in sorted(pending):
+        claimed = job.with_name(f"{job.name}.{worker_id}{SPOOL_CLAIM_SUFFIX}")
+        try:
+            os.rename(job, claimed)
+            return claimed
+        except FileNotFoundError:
+            continue
+    return None
 
+def _spool_clock(spool_dir: Path) -> float:
+    """
+    The spool's own notion of "now": the mtime of a freshly touched probe file.
+    Claim mtimes are stamped by the file server, so comparing them with this
+    host's clock would misjudge staleness by however far the clocks drift.
+    """
+    probe = spool_dir / f".clock.{_spool_worker_id()}"
+    try:
+        probe.touch()
+        return probe.stat().st_mtime
+    finally:
+        with contextlib.suppress(FileNotFoundError):
+            probe.unlink()
+
+def _reclaim_stale_spool_jobs(spool_dir: Path, stale_seconds: float) -> int:
+    """Puts back jobs whose claim has not been touched for stale_seconds (their worker died)."""
+    now = _spool_clock(spool_dir)
+    reclaimed = 0
+    for claimed in spool_dir.glob(f"*{SPOOL_JOB_SUFFIX}.*{SPOOL_CLAIM_SUFFIX}"):
+        try:
+            if now - claimed.stat().st_mtime < stale_seconds:
+                continue
+            os.rename(claimed, spool_dir / f"{_spool_job_name(claimed)}{SPOOL_JOB_SUFFIX}")
+            reclaimed += 1
+        except FileNotFoundError:
+            continue
+    return reclaimed
+
+async def run_spool_job(claimed: Path, settings: dict, log_fn=print, browser=None) -> dict:
+    """
+    Renders one claimed job and returns its result record. A job file holds
+    "input" (a markdown path) or "markdown" (inline text), and optionally
+    "format" (default pdf), "theme", "output" and "settings" overrides.
+    Relative paths resolve against the spool directory; the default output
+    is <name>.<format> next to the job.
+    """
+    import time
+    spool_dir = claimed.parent
+    job = json.loads(await asyncio.get_running_loop().run_in_executor(None, lambda: claimed.read_text(encoding="utf-8")))
+    fmt = str(job.get("format", "pdf")).lower()
+    job_settings = dict(settings)
+    job_settings.update(job.get("settings") or {})
+    if job.get("theme"):
+        if job["theme"] not in THEMES:
+            raise ValueError(f"Unknown theme '{job['theme']}'")
+        job_settings["theme"] = job["theme"]
+
+    if "markdown" in job:
+        md_text, base_dir = job["markdown"], spool_dir
+    elif "input" in job:
+        md_path = spool_dir / job["input"]
+        md_text = await asyncio.get_running_loop().run_in_executor(None, lambda: md_path.read_text(encoding="utf-8"))
+        base_dir = md_path.parent
     else:
-        modified_md = md_text
+        raise ValueError("Job needs an 'input' path or inline 'markdown'")
+    out_path = spool_dir / job.get("output", f"{_spool_job_name(claimed)}.{fmt}")
+    await asyncio.get_running_loop().run_in_executor(None, lambda: out_path.parent.mkdir(parents=True, exist_ok=True))
 
-    if prog_fn: prog_fn(60)
-    
-    # Save modified markdown
-    tmp_md = md_path.with_suffix(f".{uuid.uuid4()}.tmp.md")
-    temp_files_to_cleanup.append(tmp_md)
-    await asyncio.get_running_loop().run_in_executor(None, lambda: tmp_md.write_text(modified_md, encoding="utf-8"))
-    
-    cmd = ["pandoc", str(tmp_md), "-o", str(docx_path)]
-    
-    if log_fn: log_fn(f"Running pandoc...")
-    proc = await asyncio.create_subprocess_exec(*cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
-    stdout, stderr = await proc.communicate()
-    
-    # Cleanup
-    for p in temp_files_to_cleanup:
+    started = time.perf_counter()
+    if fmt == "svg" and extract_pure_mermaid(md_text) is None:
+        await export_diagrams_svg(md_text, out_path.parent, out_path.stem, job_settings, base_dir, log_fn, browser)
+    else:
+        await convert_markdown(md_text, fmt, job_settings, output=out_path, base_dir=base_dir, log_fn=log_fn, browser=browser)
+    return {"status": "ok", "output": str(out_path), "format": fmt, "seconds": round(time.perf_counter() - started, 3)}
+
+async def run_spool_worker(spool_dir: Path, settings: Optional[dict] = None, log_fn=print, drain: bool = False, max_jobs: Optional[int] = None) -> int:
+    """
+    ⚡ Bolt: Brokerless horizontal scaling. Any number of worker processes, on
+    this machine or on others sharing the directory over NFS, drain the same
+    spool; each keeps one warm browser across all the jobs it renders.
+    Claims are refreshed every "spool_heartbeat" seconds while a job renders,
+    and claims idle for "spool_stale_seconds" are put back for other workers.
+    With drain=True the worker exits once the spool is empty. Returns the
+    number of jobs processed.
+    """
+    settings = settings if settings is not None else load_settings()
+    spool_dir = Path(spool_dir)
+    loop = asyncio.get_running_loop()
+    worker_id = _spool_worker_id()
+    poll = float(settings.get("spool_poll_seconds", 1.0))
+    heartbeat = float(settings.get("spool_heartbeat", 30))
+    stale = float(settings.get("spool_stale_seconds", 300))
+
+    prewarm = None
+    if settings.get("prewarm_browser", True):
+        async def _prewarm():
+            try:
+                await prewarm_browser(settings)
+            except Exception as e:
+                if log_fn: log_fn(f"Warning: Browser pre-warm failed: {e}")
+        prewarm = asyncio.create_task(_prewarm())
+
+    async def _keep_claim(claimed: Path, job: asyncio.Task) -> bool:
+        while True:
+            await asyncio.sleep(heartbeat)
+            try:
+                await loop.run_in_executor(None, os.utime, claimed)
+            except FileNotFoundError:
+                # Put back as stale (and maybe claimed elsewhere): stop rendering it here
+                job.cancel()
+                return True
+
+    processed = 0
+    try:
+        while max_jobs is None or processed < max_jobs:
+            await loop.run_in_executor(None, _reclaim_stale_spool_jobs, spool_dir, stale)
+            claimed = await loop.run_in_executor(None, _claim_spool_job, spool_dir, worker_id)
+            if claimed is None:
+                if drain:
+                    break
+                await asyncio.sleep(poll)
+                continue
+
+            name = _spool_job_name(claimed)
+            if log_fn: log_fn(f"[{worker_id}] Claimed {name}")
+            job = asyncio.create_task(run_spool_job(claimed, settings, log_fn))
+            keeper = asyncio.create_task(_keep_claim(claimed, job))
+            try:
+                record = await job
+                result_path = spool_dir / f"{name}.result.json"
+            except Exception as e:
+                record = {"status": "error", "error": str(e) or type(e).__name__}
+                result_path = spool_dir / f"{name}.error.json"
+            except BaseException:
+                if keeper.done() and not keeper.cancelled() and keeper.result():
+                    if log_fn: log_fn(f"[{worker_id}] {name}: claim lost, abandoned")
+                    continue
+                # Interrupted: hand the job straight back instead of waiting for it to go stale
+                with contextlib.suppress(FileNotFoundError):
+                    os.rename(claimed, spool_dir / f"{name}{SPOOL_JOB_SUFFIX}")
+                raise
+            finally:
+                keeper.cancel()
+                with contextlib.suppress(asyncio.CancelledError):
+                    await keeper
+            record.update({"job": name, "worker": worker_id})
+            try:
+                # Retiring the claim first proves it is still ours; the claimed job
+                # stays next to its record as <name>.job.json.done
+                await loop.run_in_executor(None, os.replace, claimed, spool_dir / f"{name}{SPOOL_JOB_SUFFIX}.done")
+                await loop.run_in_executor(None, _write_json_atomic, result_path, record)
+            except FileNotFoundError:
+                if log_fn: log_fn(f"[{worker_id}] {name}: claim lost, result left to its new worker")
+                continue
+            processed += 1
+            if log_fn: log_fn(f"[{worker_id}] {name}: {record['status']}")
+    finally:
+        # Cancelling Playwright mid-launch would leave its driver behind; the launch is short
+        if prewarm is not None:
+            await prewarm
+    return processed
+
+# --- Memory Benchmark ---
+def _process_tree_rss(root_pid: int) -> Optional[int]:
+    """Sums the resident memory (bytes) of root_pid's descendants from /proc; None off Linux."""
+    proc = Path("/proc")
+    if not (proc / "self" / "stat").exists():
+        return None
+    children = {}
+    for stat in proc.glob("[0-9]*/stat"):
         try:
-            if p.exists(): os.remove(p)
-        except: pass
-    
-    if proc.returncode != 0:
-        raise RuntimeError(f"Pandoc failed: {stderr.decode()}")
-        
-    if prog_fn: prog_fn(100)
-    if log_fn: log_fn(f"Created: {docx_path.name}")
+            # The command name may contain spaces and parentheses; ppid follows the last ')'
+            fields = stat.read_text().rsplit(")", 1)[1].split()
+            children.setdefault(int(fields[1]), []).append(int(stat.parent.name))
+        except (OSError, IndexError, ValueError):
+            continue
+    page = os.sysconf("SC_PAGE_SIZE")
+    total = 0
+    pending = list(children.get(root_pid, []))
+    while pending:
+        pid = pending.pop()
+        pending.extend(children.get(pid, []))
+        try:
+            total += int((proc / str(pid) / "statm").read_text().split()[1]) * page
+        except (OSError, IndexError, ValueError):
+            continue # Exited meanwhile
+    return total
+
+class MemoryProfiler:
+    """
+    Peak memory per stage of a document: Python allocations through tracemalloc
+    (all threads, so executor stages count too) and, sampled on a background
+    thread while the profiler runs, the RSS of this process's child tree, which
+    holds Chromium, its renderers and pandoc.
+    """
+
+    def __init__(self, interval: float = 0.05):
+        self.interval = interval
+        self.stages = {}
+        self.rss_peak = None
+        self._stop = None
+        self._thread = None
+
+    def __enter__(self):
+        import tracemalloc
+        self._owns_tracing = not tracemalloc.is_tracing()
+        if self._owns_tracing:
+            tracemalloc.start()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, name="md2pdf-rss", daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        import tracemalloc
+        self._stop.set()
+        self._thread.join()
+        if self._owns_tracing:
+            tracemalloc.stop()
+        return False
 
+    def _sample(self):
+        pid = os.getpid()
+        while True:
+            rss = _process_tree_rss(pid)
+            if rss is not None:
+                self.rss_peak = max(self.rss_peak or 0, rss)
+            if self._stop.wait(self.interval):
+                return
+
+    @contextlib.contextmanager
+    def stage(self, name: str):
+        """Records the Python allocation peak above the stage's starting point."""
+        import tracemalloc
+        tracemalloc.reset_peak()
+        base = tracemalloc.get_traced_memory()[0]
+        try:
+            yield
+        finally:
+            self.stages[name] = max(0, tracemalloc.get_traced_memory()[1] - base)
+
+def _memory_violations(report: dict, budgets: dict) -> list:
+    """Compares a report against {stage | "python" | "rss": megabytes}; returns the overruns."""
+    measured = dict(report["stages"], python=report["python_peak"], rss=report["rss_peak"])
+    violations = []
+    for name, budget_mb in budgets.items():
+        value = measured.get(name)
+        if budget_mb and value is not None and value > budget_mb * 2**20:
+            violations.append(f"{name}: {value / 2**20:.1f} MB > {budget_mb} MB budget")
+    return violations
+
+async def memory_benchmark(md_paths: list, fmt: str = "pdf", settings: Optional[dict] = None, budgets: Optional[dict] = None, log_fn=print, browser=None) -> list:
+    """
+    Converts each document on its own and reports its memory peaks: Python
+    allocations for the read, resources (image fetch and rewrite), parse,
+    html and render stages, the largest of
+    those ("python_peak"), and the child process tree RSS ("rss_peak", i.e.
+    Chromium and pandoc; None off Linux). budgets (default: the
+    "memory_budgets" setting) maps stage names, "python" or "rss" to MB;
+    overruns are listed under "violations" in each report.
+    """
+    settings = dict(settings if settings is not None else load_settings())
+    # Thread executors keep every stage inside this process, where tracemalloc sees it
+    settings["cpu_executor"] = "thread"
+    budgets = budgets if budgets is not None else settings.get("memory_budgets", {})
+    loop = asyncio.get_running_loop()
+    reports = []
+    for md_path in md_paths:
+        md_path = Path(md_path)
+        temp_dir_str = await loop.run_in_executor(None, tempfile.mkdtemp)
+        try:
+            with MemoryProfiler() as profiler:
+                with profiler.stage("read"):
+                    md_text = await loop.run_in_executor(None, lambda: md_path.read_text(encoding="utf-8"))
+                with profiler.stage("resources"):
+                    # As convert_markdown does first; later stages see the rewritten text
+                    processed = await loop.run_in_executor(None, process_resources, md_text, Path(temp_dir_str))
+                with _DOC_CACHE_LOCK:
+                    _DOC_CACHE.clear() # Measure a cold parse
+                with profiler.stage("parse"):
+                    await run_cpu(parse_document, processed)
+                with profiler.stage("html"):
+                    await run_cpu(create_html_content, processed, settings)
+                with profiler.stage("render"):
+                    await convert_markdown(processed, fmt, settings, output=io.BytesIO(), base_dir=md_path.parent, log_fn=None, browser=browser)
+        finally:
+            await loop.run_in_executor(None, lambda: shutil.rmtree(temp_dir_str, ignore_errors=True))
+        report = {"document": str(md_path), "format": fmt, "size": len(md_text), "stages": profiler.stages,
+                  "python_peak": max(profiler.stages.values()), "rss_peak": profiler.rss_peak}
+        report["violations"] = _memory_violations(report, budgets)
+        reports.append(report)
+        if log_fn:
+            stages = ", ".join(f"{name} {peak / 2**20:.1f} MB" for name, peak in report["stages"].items())
+            rss = f"{report['rss_peak'] / 2**20:.0f} MB" if report["rss_peak"] is not None else "n/a"
+            log_fn(f"{md_path.name}: {stages}; child RSS {rss}")
+            for violation in report["violations"]:
+                log_fn(f"  Over budget: {violation}")
+    return reports
 
 
 # --- Textual GUI Wrapper ---
-if HAS_TEXTUAL:
+_TUI_CLASSES = None
+
+def _build_tui() -> dict:
+    """Imports Textual and defines the TUI classes on first use."""
+    global _TUI_CLASSES
+    if _TUI_CLASSES is not None:
+        return _TUI_CLASSES
+
+    import webbrowser
+    from textual.app import App, ComposeResult
+    from textual.containers import Container, Horizontal, Vertical, VerticalScroll, Center
+    from textual.widgets import (
+        Button, Footer, Input, Label, RichLog, Static, 
+        Select, Switch, ProgressBar, Rule, TabbedContent, TabPane, Markdown, TextArea, ContentSwitcher
+    )
+    from textual.binding import Binding
+    from textual.screen import ModalScreen
+    from textual import work
+    if HAS_PIXELS:
+        from rich_pixels import Pixels
+        from PIL import Image
+
     class HelpScreen(ModalScreen):
         BINDINGS = [Binding("escape", "dismiss", "Close"), Binding("f1", "dismiss", "Close")]
         def compose(self) -> ComposeResult:
@@ -905,6 +3233,7 @@ if HAS_TEXTUAL:
         #convert-btn { background: #238636; color: white; width: 22; margin-left: 1; }
         #docx-btn { background: #1f6feb; color: white; width: 22; margin-left: 1; }
         #preview-controls { height: 3; align: right middle; padding-right: 1; }
+        #engine-status { width: 1fr; height: 3; content-align: left middle; color: #8b949e; }
         #editor-toolbar { height: 3; margin-bottom: 1; align: left middle; background: #21262d; padding-left: 1; }
         .tool-btn { min-width: 5; margin-right: 1; height: 1; background: #30363d; border: none; }
         .tool-btn:hover { background: #58a6ff; color: #161b22; }
@@ -921,6 +3250,9 @@ if HAS_TEXTUAL:
 
         def __init__(self, cli_file=None, paste_content=None):
             super().__init__(); self.cli_file = cli_file; self.paste_content = paste_content; self.settings = load_settings(); self.recent_files = load_recent_files(); self.last_output_path = None; self.use_paste_source = bool(paste_content)
+            # One renderer per worker: the preview and the TUI render run at the same
+            # time with different documents and would evict each other's fragments
+            self.preview_renderer = IncrementalRenderer(); self.tui_renderer = IncrementalRenderer()
 
         def notify_user(self, message: str, severity: str = "information", title: str = ""):
             """Helper to log and notify user simultaneously."""
@@ -1028,7 +3360,7 @@ The file `{filepath}` could not be found.
                             with Horizontal(classes="row"):
                                 yield Label("Single Pg:"); yield Switch(value=self.settings.get("unlimited_height", True), id="unlimited-height-switch", tooltip="Generate a continuous PDF without page breaks")
                             with Horizontal(classes="row"):
-                                yield Label("Save Diags:"); yield Switch(value=self.settings.get("save_diagrams", False), id="save-diags-switch", tooltip="Save extracted Mermaid diagrams as separate PNG files")
+                                yield Label("Save Diags:"); yield Switch(value=self.settings.get("save_diagrams", False), id="save-diags-switch", tooltip="Save extracted Mermaid diagrams as separate files (PNG, or SVG when diagram_format is 'svg')")
                     with Vertical(id="log-area"):
                         yield ProgressBar(id="progress-bar", show_eta=False); yield RichLog(id="log", markup=True)
                 with TabPane("Paste & Preview"):
@@ -1052,6 +3384,7 @@ The file `{filepath}` could not be found.
                             yield Markdown(id="md-preview")
                         yield TextArea(id="paste-area")
             with Horizontal(id="button-bar"): 
+                yield Static("", id="engine-status")
                 yield Button("📄 Open File", id="open-btn", disabled=True, tooltip="Open the last generated PDF/DOCX file")
                 yield Button("📝 Export DOCX", id="docx-btn", tooltip="Convert the current Markdown to a Word document")
                 yield Button("▶ GENERATE PDF", id="convert-btn", tooltip="Convert the current Markdown to a PDF file")
@@ -1067,6 +3400,21 @@ The file `{filepath}` could not be found.
             if self.paste_content:
                 self.query_one("#paste-area", TextArea).text = self.paste_content
                 self.query_one("#source-switch", Switch).value = True
+
+            if self.settings.get("prewarm_browser", True):
+                self.worker_prewarm()
+
+        @work(group="prewarm")
+        async def worker_prewarm(self):
+            # Launch the rendering engine while the user picks a file, so the first export costs the same as any other
+            status = self.query_one("#engine-status", Static)
+            status.update("⏳ Starting render engine...")
+            try:
+                elapsed = await prewarm_browser(self.settings)
+                status.update(f"[green]●[/] Render engine ready ({elapsed:.1f}s)")
+            except Exception as e:
+                status.update("[yellow]●[/] Render engine starts on first export")
+                self.query_one("#log", RichLog).write(f"[yellow]Browser pre-warm failed: {e}[/]")
         
         def on_select_changed(self, event: Select.Changed):
             if event.select.id == "theme-select":
@@ -1242,7 +3590,7 @@ The file `{filepath}` could not be found.
              try:
                 temp_dir = Path(temp_dir_str)
                 processed_content = await loop.run_in_executor(None, process_resources, content, temp_dir)
-                html = await loop.run_in_executor(None, create_html_content, processed_content, self.settings)
+                html = await loop.run_in_executor(None, create_html_content, processed_content, self.settings, self.preview_renderer)
                 preview_path = temp_dir / "preview.html"
                 await loop.run_in_executor(None, lambda: preview_path.write_text(html, encoding="utf-8"))
                 await loop.run_in_executor(None, lambda: webbrowser.open(f"file://{preview_path.resolve()}"))
@@ -1290,8 +3638,13 @@ The file `{filepath}` could not be found.
                 temp_dir = Path(temp_dir_str)
                 processed_content = await loop.run_in_executor(None, process_resources, content, temp_dir)
 
-                # Identify mermaid blocks
-                parts = await loop.run_in_executor(None, MERMAID_PATTERN.split, processed_content)
+                # Identify mermaid blocks: text and diagram parts alternate
+                doc = await run_cpu(parse_document, processed_content)
+                parts, last_end = [], 0
+                for (start, end), code in zip(doc.diagram_spans, doc.diagrams):
+                    parts.extend((processed_content[last_end:start], code))
+                    last_end = end
+                parts.append(processed_content[last_end:])
 
                 # If only 1 part, no mermaid
                 if len(parts) < 2:
@@ -1299,7 +3652,7 @@ The file `{filepath}` could not be found.
                     return
 
                 # Render ALL to get images
-                html = await loop.run_in_executor(None, create_html_content, processed_content, self.settings)
+                html = await loop.run_in_executor(None, create_html_content, processed_content, self.settings, self.tui_renderer)
                 tmp_h = temp_dir / "render.html"
                 await loop.run_in_executor(None, lambda: tmp_h.write_text(html, encoding="utf-8"))
 
@@ -1307,7 +3660,7 @@ The file `{filepath}` could not be found.
 
                 async def capture():
                      browser = await _get_browser()
-                     page = await browser.new_page(device_scale_factor=2)
+                     page = await _new_render_page(browser, self.settings, device_scale_factor=2)
                      await page.goto(f"file://{tmp_h.resolve()}", wait_until="load")
 
                      try:
@@ -1315,11 +3668,7 @@ The file `{filepath}` could not be found.
                          await page.wait_for_timeout(500)
                      except: pass
 
-                     elements = await page.locator(".mermaid").all()
-                     for i, el in enumerate(elements):
-                         p = temp_dir / f"diag_{i}.png"
-                         await el.screenshot(path=str(p))
-                         images.append(p)
+                     images.extend(await capture_diagrams(page, lambda i: temp_dir / f"diag_{i}.png"))
                      await page.close()
 
                 await capture()
@@ -1396,9 +3745,11 @@ The file `{filepath}` could not be found.
                         log("[yellow]⚠️  Paste area is empty![/]")
                         return
 
-                    if text_content.strip().startswith("graph T"):
-                         if not text_content.strip().startswith("```"):
-                             text_content = f"```mermaid\n{text_content}\n```"
+                    # Bare diagrams (e.g. "graph TD ...") become a mermaid block for the document path;
+                    # PDF exports of a single diagram take the fast path in convert_markdown
+                    diagram = extract_pure_mermaid(text_content)
+                    if diagram is not None and not text_content.strip().startswith(("```", "~~~")):
+                        text_content = f"```mermaid\n{diagram}```"
 
                     # Determine Output Path
                     out_dir_str = self.query_one("#out-input", Input).value.strip()
@@ -1411,36 +3762,13 @@ The file `{filepath}` could not be found.
                     filename = f"pasted_export_{uuid.uuid4().hex[:8]}.{fmt}"
                     opath = out_dir / filename
 
-                    # Create temp dir for resources
-                    temp_dir_str = await loop.run_in_executor(None, tempfile.mkdtemp)
-                    try:
-                        temp_path = Path(temp_dir_str)
-                        log(f"Processing resources in temporary env...")
-                        processed_text = await loop.run_in_executor(None, process_resources, text_content, temp_path)
-
-                        # Write processed markdown to temp file
-                        tmp_md = temp_path / f"source_{uuid.uuid4()}.md"
-                        await loop.run_in_executor(None, lambda: tmp_md.write_text(processed_text, encoding="utf-8"))
-
-                        ipath = tmp_md
-
-                        if fmt == "docx":
-                            await generate_docx_core(ipath, opath, log, prog, settings=self.settings)
-                            log(f"[green]✓ DOCX Export Done: {str(opath)}[/]")
-                            self.notify_user(f"Export Done: {opath.name}", title="Success")
-                        else:
-                            # Check for pure mermaid
-                            if is_pure_mermaid(processed_text) and fmt != "docx":
-                                pass
-
-                            await generate_pdf_core(ipath, opath, self.settings, log, prog)
-                            log(f"[green]✓ PDF Export Done: {str(opath)}[/]")
-                            self.notify_user(f"Export Done: {opath.name}", title="Success")
+                    log(f"Converting pasted content...")
+                    await convert_markdown(text_content, fmt, self.settings, output=opath, log_fn=log, prog_fn=prog)
+                    log(f"[green]✓ {fmt.upper()} Export Done: {str(opath)}[/]")
+                    self.notify_user(f"Export Done: {opath.name}", title="Success")
 
-                        self.last_output_path = opath
-                        enable_btn()
-                    finally:
-                        await loop.run_in_executor(None, shutil.rmtree, temp_dir_str)
+                    self.last_output_path = opath
+                    enable_btn()
 
                 else:
                     inp = self.query_one("#md-input", Input).value.strip()
@@ -1476,20 +3804,31 @@ The file `{filepath}` could not be found.
             finally:
                 toggle_loading(False)
 
+    _TUI_CLASSES = {"HelpScreen": HelpScreen, "MarkdownToPdfApp": MarkdownToPdfApp}
+    return _TUI_CLASSES
+
+def __getattr__(name: str):
+    # The TUI classes stay importable as module attributes, built on first access
+    if HAS_TEXTUAL and name in ("HelpScreen", "MarkdownToPdfApp"):
+        return _build_tui()[name]
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
 async def run_gallery_mode(md_path: Path) -> None:
     print("--- Gallery Mode: Generating for all themes ---")
     base_settings = load_settings()
-    sem = asyncio.Semaphore(5)
+    controller = ConcurrencyController(base_settings)
 
     async def render_theme(theme, browser):
-        async with sem:
+        async with controller.slot():
             settings = base_settings.copy()
             settings["theme"] = theme
             gallery_path = md_path.parent / f"{md_path.stem}_{theme.lower().replace(' ', '_')}.png"
             await generate_png_core(md_path, gallery_path, settings, browser=browser)
 
+    from playwright.async_api import async_playwright
     async with async_playwright() as p:
-        browser = await p.chromium.launch()
+        browser = await p.chromium.launch(args=CHROMIUM_LAUNCH_ARGS)
         tasks = [render_theme(theme, browser) for theme in THEMES.keys()]
         await asyncio.gather(*tasks)
         await browser.close()
@@ -1510,74 +3849,174 @@ def main():
     if len(sys.argv) > 1 or content_arg:
         if len(sys.argv) > 1 and sys.argv[1] in ["--help", "-h"]:
             print("Usage: python md_to_pdf_tui.py [input.md] [output] [flags]")
-            print("Flags: --headless, --docx, --png, --gallery, --open, --light, --dark, --content 'markdown text'")
+            print("Flags: --headless, --batch, --memory-bench, --spool DIR [--drain], --docx, --png, --svg, --optimize, --all-diagrams, --gallery, --open, --light, --dark, --content 'markdown text'")
+            print("Use '-' as input to read markdown from stdin and '-' (or -o -) as output to write to stdout.")
             return
         
         if "--headless" in sys.argv:
-            print("--- MDPDFM Background Engine starting ---")
+            # "-" as input reads stdin, "-" as output writes to stdout; "-o PATH" names the output
+            output_arg = None
+            if "-o" in sys.argv[1:]:
+                idx = sys.argv.index("-o", 1)
+                if idx + 1 >= len(sys.argv):
+                    print("Error: -o needs an output path (or - for stdout).", file=sys.stderr)
+                    sys.exit(1)
+                output_arg = sys.argv[idx + 1]
+                del sys.argv[idx:idx + 2]
+            potential_args = [a for a in sys.argv[1:] if not a.startswith("--")]
+            text_input = bool(content_arg) or (bool(potential_args) and potential_args[0] == "-")
+            out_args = potential_args if content_arg else potential_args[1:]
+            if output_arg is not None:
+                out_args = [output_arg]
+            to_stdout = bool(out_args) and out_args[0] == "-"
+
+            # Keep stdout clean for the document when streaming
+            def log(m): print(m, file=sys.stderr if to_stdout else sys.stdout)
+            log("--- MDPDFM Background Engine starting ---")
+
+            if "--spool" in sys.argv:
+                # Worker mode: drain <name>.job.json files from a spool directory
+                idx = sys.argv.index("--spool")
+                if idx + 1 >= len(sys.argv):
+                    print("Error: --spool needs a directory.", file=sys.stderr)
+                    sys.exit(1)
+                spool_dir = Path(sys.argv[idx + 1]).resolve()
+                try:
+                    count = asyncio.run(run_spool_worker(spool_dir, load_settings(), log, drain="--drain" in sys.argv))
+                except KeyboardInterrupt:
+                    return
+                log(f"Spool worker done: {count} jobs.")
+                return
+
+            if "--memory-bench" in sys.argv:
+                # Report memory peaks per document; exit 1 when a budget is exceeded
+                fmt = "docx" if "--docx" in sys.argv else ("png" if "--png" in sys.argv else "pdf")
+                inputs = [Path(a).resolve() for a in potential_args]
+                if not inputs:
+                    print("Error: No input files provided.", file=sys.stderr)
+                    sys.exit(1)
+                reports = asyncio.run(memory_benchmark(inputs, fmt, load_settings(), log_fn=log))
+                if any(report["violations"] for report in reports):
+                    sys.exit(1)
+                return
+
+            if "--batch" in sys.argv:
+                # Every positional argument is an input; outputs go next to each one
+                fmt = "docx" if "--docx" in sys.argv else ("png" if "--png" in sys.argv else "pdf")
+                settings = load_settings()
+                chosen_theme = next((THEME_SLUGS[arg] for arg in sys.argv if arg in THEME_SLUGS), None)
+                if chosen_theme:
+                    settings["theme"] = chosen_theme
+                if fmt == "docx" and "--svg" in sys.argv:
+                    settings["docx_diagrams"] = "svg"
+                if "--optimize" in sys.argv:
+                    settings["pdf_optimize"] = True
+                inputs = [Path(a).resolve() for a in potential_args]
+                if not inputs:
+                    print("Error: No input files provided.", file=sys.stderr)
+                    sys.exit(1)
+                results = asyncio.run(convert_batch(inputs, fmt, settings, log_fn=log))
+                failed = [md_path for md_path, _, error in results if error is not None]
+                log(f"Batch complete: {len(results) - len(failed)} succeeded, {len(failed)} failed.")
+                if failed:
+                    sys.exit(1)
+                return
             
             temp_dir = None
             md_path = None
+            md_text = None
 
             try:
                 if content_arg:
-                    temp_dir = tempfile.mkdtemp()
-                    temp_path = Path(temp_dir)
-                    print("Processing content resources...")
-                    processed_text = process_resources(content_arg, temp_path)
-                    md_path = temp_path / f"content_{uuid.uuid4().hex[:8]}.md"
-                    md_path.write_text(processed_text, encoding="utf-8")
+                    md_text = content_arg
+                elif text_input:
+                    md_text = sys.stdin.buffer.read().decode("utf-8")
                 elif len(sys.argv) > 1 and not sys.argv[1].startswith("--"):
                     md_path = Path(sys.argv[1]).resolve()
                     if not md_path.exists():
-                        print(f"Error: {md_path} not found")
+                        print(f"Error: {md_path} not found", file=sys.stderr)
                         sys.exit(1)
                 else:
-                    print("Error: No input file or content provided.")
+                    print("Error: No input file or content provided.", file=sys.stderr)
                     sys.exit(1)
 
                 pdf_path = None
-                # Determine output path logic considering content_arg shifting
-                potential_args = [a for a in sys.argv[1:] if not a.startswith("--")]
-
-                if content_arg:
-                    if potential_args:
-                        pdf_path = Path(potential_args[0]).resolve()
-                else:
-                    if len(potential_args) > 1:
-                         pdf_path = Path(potential_args[1]).resolve()
+                if out_args and not to_stdout:
+                    pdf_path = Path(out_args[0]).resolve()
 
                 is_docx = "--docx" in sys.argv or (pdf_path and pdf_path.suffix.lower() == ".docx")
                 is_png = "--png" in sys.argv or "--gallery" in sys.argv or (pdf_path and pdf_path.suffix.lower() == ".png")
+                # With --docx, --svg picks vector diagrams inside the DOCX instead
+                is_svg = not is_docx and ("--svg" in sys.argv or (pdf_path and pdf_path.suffix.lower() == ".svg"))
+                fmt = "docx" if is_docx else ("png" if is_png else ("svg" if is_svg else "pdf"))
 
                 # theme gallery mode
                 if "--gallery" in sys.argv:
+                    if md_path is None:
+                        temp_dir = tempfile.mkdtemp()
+                        md_path = Path(temp_dir) / f"content_{uuid.uuid4().hex[:8]}.md"
+                        md_path.write_text(process_resources(md_text, Path(temp_dir)), encoding="utf-8")
                     asyncio.run(run_gallery_mode(md_path))
                     return
 
-                if not pdf_path:
-                    ext = ".docx" if is_docx else (".png" if is_png else ".pdf")
-                    if content_arg:
-                        pdf_path = Path(f"output_{uuid.uuid4().hex[:8]}{ext}").resolve()
+                if not pdf_path and not to_stdout:
+                    if text_input:
+                        pdf_path = Path(f"output_{uuid.uuid4().hex[:8]}.{fmt}").resolve()
                     else:
-                        pdf_path = md_path.with_suffix(ext)
+                        pdf_path = md_path.with_suffix("." + fmt)
 
                 settings = load_settings()
                 chosen_theme = next((THEME_SLUGS[arg] for arg in sys.argv if arg in THEME_SLUGS), None)
 
                 if chosen_theme:
                     settings["theme"] = theme_name = chosen_theme
-
-                if is_docx:
+                if "--all-diagrams" in sys.argv:
+                    settings["png_all_diagrams"] = True
+                if is_docx and "--svg" in sys.argv:
+                    settings["docx_diagrams"] = "svg"
+                if "--optimize" in sys.argv:
+                    settings["pdf_optimize"] = True
+
+                if not is_docx and not to_stdout and not text_input:
+                    # Single-diagram files take the diagram fast path too
+                    try:
+                        md_text = md_path.read_text(encoding="utf-8")
+                    except UnicodeDecodeError:
+                        md_text = None # The core reports non-text input
+                    if md_text is not None and extract_pure_mermaid(md_text) is None:
+                        md_text = None
+
+                svg_source = None
+                if is_svg and not to_stdout:
+                    svg_source = md_text if md_text is not None else md_path.read_text(encoding="utf-8")
+                    if extract_pure_mermaid(svg_source) is not None:
+                        svg_source = None
+
+                if svg_source is not None:
+                    # Documents export one SVG per diagram next to the output path
+                    base_dir = md_path.parent if md_path else None
+                    if not asyncio.run(export_diagrams_svg(svg_source, pdf_path.parent, pdf_path.stem, settings, base_dir, log)):
+                        sys.exit(1)
+                elif to_stdout or text_input or md_text is not None:
+                    if md_text is None:
+                        md_text = md_path.read_text(encoding="utf-8")
+                    base_dir = md_path.parent if md_path else None
+                    output = sys.stdout.buffer if to_stdout else pdf_path
+                    try:
+                        asyncio.run(convert_markdown(md_text, fmt, settings, output=output, base_dir=base_dir, log_fn=log))
+                    except (RuntimeError, ValueError) as e:
+                        print(f"Error: {e}", file=sys.stderr)
+                        sys.exit(1)
+                elif is_docx:
                     asyncio.run(generate_docx_core(md_path, pdf_path, settings=settings))
                 elif is_png:
                     asyncio.run(generate_png_core(md_path, pdf_path, settings=settings))
                 else:
                     asyncio.run(generate_pdf_core(md_path, pdf_path, settings))
 
-                print(f"Success: {pdf_path}")
+                log(f"Success: {pdf_path or '<stdout>'}")
 
-                if "--open" in sys.argv:
+                if "--open" in sys.argv and pdf_path:
                     print(f"Opening: {pdf_path}")
                     os.startfile(str(pdf_path.resolve()))
             finally:
@@ -1591,11 +4030,11 @@ def main():
             file_arg = None
             if len(sys.argv) > 1 and not sys.argv[1].startswith("--"):
                 file_arg = sys.argv[1]
-            MarkdownToPdfApp(cli_file=file_arg, paste_content=content_arg).run()
+            _build_tui()["MarkdownToPdfApp"](cli_file=file_arg, paste_content=content_arg).run()
         else:
             print("Error: Textual not installed. Use --headless.")
     elif HAS_TEXTUAL:
-        MarkdownToPdfApp(paste_content=content_arg).run()
+        _build_tui()["MarkdownToPdfApp"](paste_content=content_arg).run()
     else:
         print("Usage: python md_to_pdf_tui.py [input.md] --headless")
 
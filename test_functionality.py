@@ -2,8 +2,13 @@ import unittest
 import tempfile
 import shutil
 import os
+import io
+import asyncio
+import base64
 from pathlib import Path
-from md_to_pdf_tui import process_resources, sanitize_mermaid_code, is_pure_mermaid
+from md_to_pdf_tui import process_resources, sanitize_mermaid_code, is_pure_mermaid, parse_document, create_html_content, _get_md_parser, IncrementalRenderer, convert_markdown, _write_output, _make_request_filter, _mermaid_error_html, _mermaid_error_text
+from md_to_pdf_tui import MermaidRenderer, _diagram_timeout_ms, _diagrams_timeout_ms, extract_pure_mermaid, _svg_fixed_size, _standalone_svg, THEMES, _png_scale, _diagrams_markdown, _plan_capture_bands, capture_diagrams, run_cpu, optimize_pdf, HAS_PIKEPDF
+import time
 
 class TestSanitizeMermaidCode(unittest.TestCase):
     def test_basic_sanitize(self):
@@ -82,5 +87,1103 @@ class TestIsPureMermaid(unittest.TestCase):
         self.assertFalse(is_pure_mermaid(""))
         self.assertFalse(is_pure_mermaid("   "))
 
+class TestExtractPureMermaid(unittest.TestCase):
+    def test_fenced_diagram(self):
+        self.assertEqual(extract_pure_mermaid("```mermaid\ngraph TD\nA-->B\n```"), "graph TD\nA-->B\n")
+        self.assertEqual(extract_pure_mermaid("  ~~~mermaid\ngraph\n~~~  \n"), "graph\n")
+
+    def test_bare_diagram(self):
+        self.assertEqual(extract_pure_mermaid("graph TD\nA-->B"), "graph TD\nA-->B\n")
+        self.assertEqual(extract_pure_mermaid("sequenceDiagram\nA->>B: hi\n"), "sequenceDiagram\nA->>B: hi\n")
+
+    def test_documents_are_not_pure(self):
+        self.assertIsNone(extract_pure_mermaid("# Title\n```mermaid\ngraph\n```"))
+        self.assertIsNone(extract_pure_mermaid("```mermaid\na\n```\ntext\n```mermaid\nb\n```"))
+        self.assertIsNone(extract_pure_mermaid("```mermaid"))
+        self.assertIsNone(extract_pure_mermaid("pie is tasty"))
+        self.assertIsNone(extract_pure_mermaid(""))
+
+class TestSvgFixedSize(unittest.TestCase):
+    def test_pins_root_to_viewbox(self):
+        svg = '<svg width="100%" style="max-width: 320px;" viewBox="0 0 320 140.5" id="d"><g><svg width="5"></svg></g></svg>'
+        fixed, w, h = _svg_fixed_size(svg)
+        self.assertEqual((w, h), (320.0, 140.5))
+        self.assertTrue(fixed.startswith('<svg style="" viewBox="0 0 320 140.5" id="d" width="320" height="140.5">'))
+        self.assertIn('<svg width="5"></svg>', fixed)
+
+    def test_without_viewbox(self):
+        self.assertEqual(_svg_fixed_size("<svg></svg>"), ("<svg></svg>", None, None))
+
+class TestStandaloneSvg(unittest.TestCase):
+    def test_self_contained(self):
+        svg = '<svg id="m0" width="100%" style="max-width: 320px;" viewBox="0 0 320 140"><g></g></svg>'
+        out = _standalone_svg(svg, "GitHub Dark")
+        root = out[:out.index(">") + 1]
+        self.assertIn('xmlns="http://www.w3.org/2000/svg"', root)
+        self.assertIn('width="320"', root)
+        self.assertIn(f'background-color: {THEMES["GitHub Dark"]["bg"]}', root)
+        self.assertTrue(out[len(root):].startswith("<style>"))
+        self.assertIn("#m0 ", out)
+
+class TestPngSizing(unittest.TestCase):
+    def test_scale_from_dpi(self):
+        self.assertEqual(_png_scale(400, 300, {"png_dpi": 192}), 2.0)
+
+    def test_scale_capped_by_max_pixels(self):
+        self.assertEqual(_png_scale(4000, 1000, {"png_dpi": 384, "png_max_pixels": 8000}), 2.0)
+
+    def test_diagrams_markdown_round_trip(self):
+        diagrams = ["graph TD\nA --> B\n", "sequenceDiagram\nA->>B: ```x```"]
+        doc = parse_document(_diagrams_markdown(diagrams))
+        self.assertEqual(doc.diagrams, [diagrams[0], diagrams[1] + "\n"])
+
+class TestParsedDocument(unittest.TestCase):
+    SAMPLE = (
+        "---\ntitle: Demo\n---\n# Title\n\n![logo](logo.png) <img src='inline.png'>\n\n"
+        "```mermaid\ngraph TD\nA --> B\n```\n\nText with a note[^1].\n\n[^1]: The note.\n"
+    )
+
+    def test_metadata(self):
+        doc = parse_document(self.SAMPLE)
+        self.assertEqual(doc.front_matter, "title: Demo")
+        self.assertEqual(doc.diagrams, ["graph TD\nA --> B\n"])
+        self.assertEqual(doc.images, ["logo.png", "inline.png"])
+
+    def test_parsed_once_per_source(self):
+        self.assertIs(parse_document(self.SAMPLE), parse_document(self.SAMPLE))
+
+    def test_profile(self):
+        text = "> [!WARNING]\n> Careful.\n\n- item\n\n  ```mermaid\n  graph TD\n  ```\n\n<div class='mermaid'>x</div>\n"
+        doc = parse_document(text)
+        self.assertEqual(doc.alerts, [("WARNING", 0, 2)])
+        self.assertEqual([text[a:b] for a, b in doc.diagram_spans], ["  ```mermaid\n  graph TD\n  ```"])
+        self.assertTrue(doc.raw_mermaid)
+        self.assertEqual(doc.size, len(text))
+
+    def test_alerts_render_in_the_parse(self):
+        text = "> [!TIP]\n> Use **this**.\n\n> A quote [!NOTE]\n"
+        body = parse_document(text).render_body()
+        self.assertIn('<div class="markdown-alert markdown-alert-tip"><p class="markdown-alert-title">💡 Tip</p>', body)
+        self.assertIn("<p>Use <strong>this</strong>.</p>", body)
+        self.assertIn("<blockquote>\n<p>A quote [!NOTE]</p>", body)
+        self.assertIn(".markdown-alert-tip", create_html_content(text, {"theme": "Dracula"}))
+
+    def test_alert_blocks_for_docx(self):
+        text = "Intro\n\n> [!CAUTION]\n> Hot.\n\nOutro\n"
+        [(kind, start, end, body)] = parse_document(text).alert_blocks()
+        self.assertEqual((kind, text[start:end], body), ("CAUTION", "> [!CAUTION]\n> Hot.", "<p>Hot.</p>\n"))
+
+    def test_mermaid_in_prose_skips_runtime(self):
+        html = create_html_content("Mermaid is great; see `mermaid.js`.\n\n```python\nimport mermaid\n```\n", {})
+        self.assertNotIn("mermaid.min.js", html)
+        self.assertIn("mermaid.min.js", create_html_content(self.SAMPLE, {}))
+
+    def test_body_matches_direct_render(self):
+        for enabled in (True, False):
+            expected = _get_md_parser().render(self.SAMPLE, env={"mermaid_enabled": enabled})
+            self.assertEqual(parse_document(self.SAMPLE).render_body(enabled), expected)
+
+    def test_themes_share_parse(self):
+        light = create_html_content(self.SAMPLE, {"theme": "GitHub Light"})
+        dark = create_html_content(self.SAMPLE, {"theme": "Dracula"})
+        body = parse_document(self.SAMPLE).render_body(True)
+        self.assertIn(body, light)
+        self.assertIn(body, dark)
+
+class TestIncrementalRenderer(unittest.TestCase):
+    BASE = (
+        "# Title\n\nIntro with a [link][ref] and a note[^a].\n\n"
+        "- tight\n- list\n\n> quote\n> more\n\n"
+        "| a | b |\n|---|---|\n| 1 | 2 |\n\n"
+        "```mermaid\ngraph TD\nA[\"- x\"] --> B\n```\n\n"
+        "<div>html block</div>\n\nSecond note[^b] and inline ^[footnote].\n\n"
+        "[ref]: https://example.com \"Example\"\n\n[^a]: First.\n[^b]: Second.\n"
+    )
+    EDITS = [
+        lambda s: s.replace("Intro with", "Edited intro with"),
+        lambda s: s.replace("https://example.com", "https://example.org"),
+        lambda s: s.replace("Intro with a [link][ref] and a note[^a].", "Intro without notes."),
+        lambda s: s.replace("- tight\n- list\n", "- loose\n\n- list\n"),
+        lambda s: "Prefix paragraph.\n\n" + s,
+        lambda s: s.replace("^[footnote]", "^[changed] and [^a]"),
+        lambda s: s.replace("> quote", "> [!NOTE]\n> quote"),
+        lambda s: s.replace("Second note", "```\nSecond note"), # Unclosed fence swallows the rest
+        lambda s: s.replace("```\nSecond note", "Second note"),
+        lambda s: s.replace("| a | b |", "Setext\n===\n\n| a | b |"),
+        lambda s: s + "\n[ref]: https://example.net\n", # Duplicate definition, ignored
+        lambda s: s.replace("[ref]: https://example.org \"Example\"\n", ""), # ... until the first one goes
+        lambda s: "---\ntitle: x\n" + s.replace("# Title", "---\n# Title"), # Front matter closed further down
+        lambda s: s.replace("[^b]: Second.\n", "[^b]: Second.\n[^c]: Unused.\n").replace("tight", "tight[^c]"),
+        lambda s: s.replace("\n", "\r\n"),
+    ]
+
+    def assert_identical(self, renderer, text, mermaid_enabled=True):
+        expected = _get_md_parser().render(text, env={"mermaid_enabled": mermaid_enabled})
+        self.assertEqual(renderer.render(parse_document(text), mermaid_enabled), expected)
+
+    def test_byte_identical_across_edits(self):
+        renderer = IncrementalRenderer()
+        text = self.BASE
+        self.assert_identical(renderer, text)
+        for edit in self.EDITS:
+            text = edit(text)
+            self.assert_identical(renderer, text)
+            self.assert_identical(renderer, text, mermaid_enabled=False)
+
+    def test_only_changed_blocks_rerender(self):
+        text = "\n\n".join(f"Paragraph {i}" for i in range(50))
+        renderer = IncrementalRenderer()
+        renderer.render(parse_document(text))
+        self.assertEqual(renderer.last_misses, 50)
+        renderer.render(parse_document(text.replace("Paragraph 7", "Paragraph seven")))
+        self.assertEqual(renderer.last_misses, 1)
+
+    def test_shared_between_threads(self):
+        # The browser preview and the TUI render can use one renderer at the same time
+        texts = [self.BASE, self.EDITS[0](self.BASE), self.EDITS[3](self.BASE), self.EDITS[6](self.BASE)]
+        expected = [_get_md_parser().render(text, env={"mermaid_enabled": True}) for text in texts]
+        renderer = IncrementalRenderer()
+
+        def render(k):
+            return renderer.render(parse_document(texts[k % len(texts)]))
+
+        import concurrent.futures
+        with concurrent.futures.ThreadPoolExecutor(max_workers=4) as pool:
+            results = list(pool.map(render, range(200)))
+        self.assertEqual(results, [expected[k % len(texts)] for k in range(200)])
+
+    def test_create_html_content_matches_full_render(self):
+        renderer = IncrementalRenderer()
+        settings = {"theme": "Nordic"}
+        self.assertEqual(create_html_content(self.BASE, settings, renderer), create_html_content(self.BASE, settings))
+
+class TestConvertMarkdownApi(unittest.TestCase):
+    def test_rejects_unknown_format(self):
+        with self.assertRaises(ValueError):
+            asyncio.run(convert_markdown("# Hi", "odt", settings={}))
+
+    def test_write_output_targets(self):
+        self.assertEqual(_write_output(b"data", None), b"data")
+
+        stream = io.BytesIO()
+        self.assertIsNone(_write_output(b"data", stream))
+        self.assertEqual(stream.getvalue(), b"data")
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            out = Path(temp_dir) / "out.pdf"
+            self.assertIsNone(_write_output(b"data", out))
+            self.assertEqual(out.read_bytes(), b"data")
+
+class TestFileExportFastPath(unittest.TestCase):
+    def test_single_diagram_files_skip_the_document_render(self):
+        from unittest import mock
+        import md_to_pdf_tui as m
+        calls = []
+
+        async def fake_diagram(diagram, fmt, settings, output, browser=None, log_fn=None):
+            calls.append((diagram, fmt, Path(output).name))
+
+        async def no_document(*args, **kwargs):
+            raise AssertionError("document render used for a single diagram")
+
+        with tempfile.TemporaryDirectory() as tmp:
+            md_path = Path(tmp) / "flow.md"
+            md_path.write_text("```mermaid\ngraph TD\nA --> B\n```\n")
+            with mock.patch.object(m, "render_diagram", fake_diagram), mock.patch.object(m, "render_pdf", no_document), \
+                    mock.patch.object(m, "render_png_page", no_document):
+                asyncio.run(m.generate_pdf_core(md_path, md_path.with_suffix(".pdf"), {}, log_fn=None))
+                asyncio.run(m.generate_png_core(md_path, md_path.with_suffix(".png"), {}, log_fn=None))
+        self.assertEqual(calls, [("graph TD\nA --> B\n", "pdf", "flow.pdf"), ("graph TD\nA --> B\n", "png", "flow.png")])
+
+    def test_single_diagram_png_honours_png_settings(self):
+        from unittest import mock
+        import md_to_pdf_tui as m
+        scales = []
+
+        class FakeRenderer:
+            async def render(self, code, theme_name, timeout):
+                return '<svg viewBox="0 0 400 300" width="100%" style="max-width: 400px;"><g/></svg>'
+
+        class FakePage:
+            async def set_content(self, html): pass
+            async def screenshot(self, clip): return b"PNG"
+            async def close(self): pass
+
+        async def fake_renderer(browser):
+            return FakeRenderer()
+
+        async def fake_page(browser, settings, js, viewport=None, device_scale_factor=1):
+            scales.append(device_scale_factor)
+            return FakePage()
+
+        with mock.patch.object(m, "_get_mermaid_renderer", fake_renderer), mock.patch.object(m, "_new_render_page", fake_page):
+            for settings in ({"png_dpi": 288}, {"png_dpi": 384, "png_max_pixels": 800}):
+                self.assertEqual(asyncio.run(m.render_diagram("graph TD\nA --> B\n", "png", settings, browser=object(), log_fn=None)), b"PNG")
+        self.assertEqual(scales, [3.0, 2.0])
+
+class TestDocxPipeline(unittest.TestCase):
+    """Runs render_docx against a stand-in pandoc that echoes its stdin as the 'DOCX'."""
+    FAKE_PANDOC = (
+        "#!/usr/bin/env python3\n"
+        "import sys, time\n"
+        "if '--version' in sys.argv: sys.exit(0)\n"
+        "data = sys.stdin.buffer.read()\n"
+        "if b'SLOW' in data: time.sleep(30)\n"
+        "out = sys.argv[sys.argv.index('-o') + 1]\n"
+        "payload = b'DOCX:' + ' '.join(sys.argv[1:]).encode() + b'\\n' + data\n"
+        "sys.stdout.buffer.write(payload) if out == '-' else open(out, 'wb').write(payload)\n"
+    )
+
+    def setUp(self):
+        import md_to_pdf_tui as m
+        self.module = m
+        self.tmp = tempfile.TemporaryDirectory()
+        self.src = Path(self.tmp.name)
+        bin_dir = self.src / "bin"
+        bin_dir.mkdir()
+        pandoc = bin_dir / "pandoc"
+        pandoc.write_text(self.FAKE_PANDOC)
+        pandoc.chmod(0o755)
+        self.saved = os.environ["PATH"], m._PANDOC_AVAILABLE
+        os.environ["PATH"] = f"{bin_dir}{os.pathsep}{os.environ['PATH']}"
+        m._PANDOC_AVAILABLE = None
+        m._pandoc_server, m._pandoc_server_failed = None, False
+
+    def tearDown(self):
+        if self.module._pandoc_server is not None:
+            self.module._pandoc_server.close()
+        self.module._pandoc_server, self.module._pandoc_server_failed = None, False
+        os.environ["PATH"], self.module._PANDOC_AVAILABLE = self.saved
+        self.tmp.cleanup()
+
+    def test_stdin_to_stdout_without_temp_files(self):
+        text = "# Notes\n\n> [!NOTE]\n> Read me.\n"
+        data = asyncio.run(self.module.render_docx(text, None, {"pandoc_server": False}, self.src, log_fn=None))
+        self.assertTrue(data.startswith(b"DOCX:-f markdown -t docx --resource-path"))
+        self.assertIn(b"<strong>\xe2\x84\xb9\xef\xb8\x8f NOTE - </strong><br/><p>Read me.</p>", data)
+        self.assertEqual(sorted(p.name for p in self.src.iterdir()), ["bin"])
+
+    def test_nested_alerts_stay_in_their_list(self):
+        text = "- item\n\n  > [!NOTE]\n  > Nested.\n\n- > [!TIP]\n  > First.\n\n> > [!WARNING]\n> > Quoted.\n"
+        data = asyncio.run(self.module.render_docx(text, None, {"pandoc_server": False}, self.src, log_fn=None)).decode()
+        self.assertIn("- item\n\n  <table ", data)
+        self.assertIn("\n- <table ", data)
+        self.assertIn("\n> <table ", data)
+        self.assertNotIn("[!", data)
+
+    def test_cancellation_kills_pandoc(self):
+        async def run():
+            task = asyncio.create_task(self.module.render_docx("SLOW\n", None, {"pandoc_server": False}, self.src, log_fn=None))
+            await asyncio.sleep(0.5)
+            task.cancel()
+            started = time.perf_counter()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+            return time.perf_counter() - started
+        self.assertLess(asyncio.run(run()), 5)
+
+    def test_vector_diagrams_skip_the_capture_page(self):
+        import md_to_pdf_tui as m
+        text = "```mermaid\ngraph TD\nA --> B\n```\n\nText\n\n- item\n\n  ```mermaid\n  graph TD\n  C --> D\n  ```\n"
+        browser = FakeBrowser()
+        saved = m._mermaid_renderer, m._mermaid_renderer_lock
+        m._mermaid_renderer, m._mermaid_renderer_lock = None, None
+        try:
+            settings = {"pandoc_server": False, "docx_diagrams": "svg", "diagram_shards": 1}
+            data = asyncio.run(m.render_docx(text, None, settings, self.src, log_fn=None, browser=browser))
+        finally:
+            m._mermaid_renderer, m._mermaid_renderer_lock = saved
+        self.assertIn(b"![Diagram](diagram_0.svg)\n\nText", data)
+        self.assertIn(b"  ![Diagram](diagram_1.svg)", data)
+        # Only the worker page was opened: SVG labels need no rasterized fallback
+        self.assertEqual(len(browser.pages), 1)
+
+    def test_falls_back_when_server_unavailable(self):
+        # This fake pandoc has no server mode, so every document goes through a subprocess
+        data = asyncio.run(self.module.render_docx("Hello\n", None, {}, self.src, log_fn=None))
+        self.assertTrue(data.startswith(b"DOCX:-f markdown"))
+        self.assertTrue(self.module._pandoc_server_failed)
+
+class FakeCdpSession:
+    """Serves Page.printToPDF as an IO stream of the given chunks; an Exception chunk fails the read."""
+    def __init__(self, chunks):
+        self.chunks = list(chunks)
+        self.calls = []
+        self.detached = False
+
+    async def send(self, method, params=None):
+        self.calls.append(method)
+        if method == "Page.printToPDF":
+            assert params["transferMode"] == "ReturnAsStream"
+            return {"stream": "stream-1"}
+        if method == "IO.read":
+            chunk = self.chunks.pop(0)
+            if isinstance(chunk, Exception):
+                raise chunk
+            return chunk
+        return {}
+
+    async def detach(self):
+        self.detached = True
+
+class TestStreamedPdf(unittest.TestCase):
+    CHUNKS = [
+        {"data": base64.b64encode(b"%PDF-1.7\n\x00\xff").decode(), "base64Encoded": True},
+        {"data": "raw text\n", "base64Encoded": False},
+        {"data": base64.b64encode(b"%%EOF").decode(), "base64Encoded": True, "eof": True},
+    ]
+
+    def print_to(self, output, chunks):
+        from md_to_pdf_tui import _print_pdf_streamed
+        cdp = FakeCdpSession(chunks)
+
+        class Context:
+            async def new_cdp_session(self, page): return cdp
+
+        page = type("Page", (), {"context": Context()})()
+        try:
+            asyncio.run(_print_pdf_streamed(page, {"paperWidth": 8.5}, output))
+        finally:
+            self.assertEqual(cdp.calls[-1], "IO.close")
+            self.assertTrue(cdp.detached)
+
+    def test_chunks_to_path_and_stream(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            target = Path(tmp) / "out.pdf"
+            self.print_to(target, self.CHUNKS)
+            self.assertEqual(target.read_bytes(), b"%PDF-1.7\n\x00\xffraw text\n%%EOF")
+            self.assertEqual(os.listdir(tmp), ["out.pdf"])
+        buf = io.BytesIO()
+        self.print_to(buf, self.CHUNKS)
+        self.assertEqual(buf.getvalue(), b"%PDF-1.7\n\x00\xffraw text\n%%EOF")
+
+    def test_failure_mid_stream_leaves_target_untouched(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            target = Path(tmp) / "out.pdf"
+            target.write_bytes(b"previous")
+            with self.assertRaises(ConnectionError):
+                self.print_to(target, self.CHUNKS[:2] + [ConnectionError("target closed")])
+            self.assertEqual(target.read_bytes(), b"previous")
+            self.assertEqual(os.listdir(tmp), ["out.pdf"])
+
+def _chromium_installed():
+    try:
+        from playwright.sync_api import sync_playwright
+        with sync_playwright() as p:
+            return Path(p.chromium.executable_path).exists()
+    except Exception:
+        return False
+
+class TestHeadlessStreams(unittest.TestCase):
+    """Runs the CLI with markdown on stdin and the document on stdout; logs must stay on stderr."""
+    FAKE_PANDOC = TestDocxPipeline.FAKE_PANDOC
+    setUp, tearDown = TestDocxPipeline.setUp, TestDocxPipeline.tearDown
+
+    def run_cli(self, *args):
+        import subprocess, sys, json
+        home = self.src / "home"
+        (home / ".md_to_pdf").mkdir(parents=True, exist_ok=True)
+        (home / ".md_to_pdf" / "settings.json").write_text(json.dumps({"pandoc_server": False, "prewarm_browser": False}))
+        script = Path(__file__).with_name("md_to_pdf_tui.py")
+        return subprocess.run([sys.executable, str(script), *args], input=b"# Piped\n\nFrom stdin.\n",
+                              capture_output=True, cwd=self.src, env=dict(os.environ, HOME=str(home)), timeout=120)
+
+    def test_docx_to_stdout(self):
+        for args in (["--headless", "-", "-o", "-", "--docx"], ["-", "-", "--headless", "--docx"]):
+            with self.subTest(args=args):
+                result = self.run_cli(*args)
+                self.assertEqual(result.returncode, 0, result.stderr)
+                self.assertTrue(result.stdout.startswith(b"DOCX:-f markdown -t docx"), result.stdout[:80])
+                self.assertTrue(result.stdout.endswith(b"# Piped\n\nFrom stdin.\n"))
+                self.assertIn(b"Success: <stdout>", result.stderr)
+                self.assertNotIn(b"MDPDFM", result.stdout)
+        self.assertEqual(sorted(p.name for p in self.src.iterdir()), ["bin", "home"])
+
+    def test_trailing_o_is_a_usage_error(self):
+        result = self.run_cli("--headless", "-", "--docx", "-o")
+        self.assertEqual(result.returncode, 1)
+        self.assertIn(b"-o needs an output path", result.stderr)
+        self.assertEqual(sorted(p.name for p in self.src.iterdir()), ["bin", "home"])
+
+    @unittest.skipUnless(_chromium_installed(), "Chromium for Playwright not installed")
+    def test_pdf_to_stdout(self):
+        result = self.run_cli("--headless", "-", "-o", "-")
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertTrue(result.stdout.startswith(b"%PDF-"), result.stdout[:80])
+        self.assertTrue(result.stdout.rstrip().endswith(b"%%EOF"))
+        self.assertIn(b"Success: <stdout>", result.stderr)
+
+class TestPandocServer(unittest.TestCase):
+    FAKE_PANDOC = (
+        "#!/usr/bin/env python3\n"
+        "import sys, json, base64\n"
+        "from http.server import BaseHTTPRequestHandler, HTTPServer\n"
+        "class H(BaseHTTPRequestHandler):\n"
+        "    def log_message(self, *a): pass\n"
+        "    def reply(self, body):\n"
+        "        self.send_response(200); self.end_headers(); self.wfile.write(body)\n"
+        "    def do_GET(self): self.reply(b'3.1')\n"
+        "    def do_POST(self):\n"
+        "        req = json.loads(self.rfile.read(int(self.headers['Content-Length'])))\n"
+        "        out = ('SERVER:' + json.dumps(sorted(req['files'])) + '\\n' + req['text']).encode()\n"
+        "        self.reply(json.dumps({'output': base64.b64encode(out).decode(), 'base64': True, 'messages': []}).encode())\n"
+        "HTTPServer(('127.0.0.1', int(sys.argv[sys.argv.index('--port') + 1])), H).serve_forever()\n"
+    )
+    setUp, tearDown = TestDocxPipeline.setUp, TestDocxPipeline.tearDown
+
+    def test_documents_share_one_server(self):
+        (self.src / "pic.png").write_bytes(b"png")
+        async def run():
+            first = await self.module.render_docx("![p](pic.png)\n", None, {}, self.src, log_fn=None)
+            server = self.module._pandoc_server
+            second = await self.module.render_docx("Again\n", None, {}, self.src, log_fn=None)
+            self.assertIs(self.module._pandoc_server, server)
+            return first, second
+        first, second = asyncio.run(run())
+        self.assertEqual(first, b'SERVER:["pic.png"]\n![p](pic.png)\n')
+        self.assertEqual(second, b"SERVER:[]\nAgain\n")
+        self.assertEqual(sorted(p.name for p in self.src.iterdir()), ["bin", "pic.png"])
+
+
+class TestConcurrencyController(unittest.TestCase):
+    def controller(self, pressure, **settings):
+        from md_to_pdf_tui import ConcurrencyController
+        return ConcurrencyController(dict({"max_concurrency": 16}, **settings), probe=lambda: pressure[0])
+
+    def test_grows_then_backs_off_like_tcp(self):
+        pressure = [(0.3, 0.8)]
+        c = self.controller(pressure)
+        self.assertEqual(c.limit, 2)
+        for _ in range(6):
+            c.record(1.0)
+        self.assertEqual(c.limit, 8) # Slow start: +1 per finished job
+        pressure[0] = (0.3, 0.05) # Memory nearly gone
+        c.record(1.0)
+        self.assertEqual(c.limit, 4)
+        pressure[0] = (0.3, 0.8)
+        c.record(1.0)
+        self.assertAlmostEqual(c.limit, 4.25) # Additive increase above the threshold
+        c.record(10.0) # 10x slower than the best job
+        self.assertAlmostEqual(c.limit, 2.125)
+        pressure[0] = (2.5, 0.8) # Oversubscribed CPUs
+        for _ in range(5):
+            c.record(1.0)
+        self.assertEqual(c.limit, 1)
+
+    def test_caps_and_in_flight_limit(self):
+        pressure = [(0.1, 0.9)]
+        c = self.controller(pressure, min_concurrency=3, max_concurrency=4, latency_factor=100)
+        peak = [0]
+
+        async def job():
+            async with c.slot():
+                peak[0] = max(peak[0], c.in_flight)
+                await asyncio.sleep(0.01)
+
+        async def run():
+            await asyncio.gather(*(job() for _ in range(40)))
+        asyncio.run(run())
+        self.assertEqual((c.limit, peak[0]), (4, 4))
+
+class TestBatchPipeline(unittest.TestCase):
+    def test_stages_overlap_within_their_slots(self):
+        from unittest import mock
+        import md_to_pdf_tui as m
+        active = {"render": 0, "pandoc": 0}
+        peak = dict(active)
+
+        async def stage(name):
+            active[name] += 1
+            peak[name] = max(peak[name], active[name])
+            await asyncio.sleep(0.1)
+            active[name] -= 1
+
+        async def fake_prepare(md_text, scratch, *args):
+            await stage("render")
+            return md_text.upper()
+
+        async def fake_pandoc(md_text, output, resource_dirs, settings=None):
+            await stage("pandoc")
+            Path(output).write_text(md_text)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            paths = []
+            for i in range(4):
+                paths.append(Path(tmp) / f"doc{i}.md")
+                paths[-1].write_text(f"# Doc {i}\n")
+            paths.insert(2, Path(tmp) / "missing.md")
+            settings = {"batch_page_slots": 1, "batch_pandoc_slots": 1}
+            with mock.patch.object(m, "_prepare_docx", fake_prepare), mock.patch.object(m, "_run_pandoc", fake_pandoc):
+                started = time.perf_counter()
+                results = asyncio.run(m.convert_batch(paths, "docx", settings, log_fn=None))
+                elapsed = time.perf_counter() - started
+            self.assertEqual((Path(tmp) / "doc3.docx").read_text(), "# DOC 3\n")
+
+        self.assertEqual([r[0].name for r in results], [p.name for p in paths])
+        self.assertEqual([r[2] is None for r in results], [True, True, False, True, True])
+        self.assertEqual(peak, {"render": 1, "pandoc": 1})
+        # Sequential stages would take 4 x (0.1 + 0.1); pipelined, about 5 x 0.1
+        self.assertLess(elapsed, 0.7)
+
+class TestSpoolWorker(unittest.TestCase):
+    FAKE_PANDOC = TestDocxPipeline.FAKE_PANDOC
+    setUp, tearDown = TestDocxPipeline.setUp, TestDocxPipeline.tearDown
+    WORKER = ("import asyncio, sys, md_to_pdf_tui as m; "
+              "print(asyncio.run(m.run_spool_worker(sys.argv[1], {'prewarm_browser': False, 'pandoc_server': False}, log_fn=None, drain=True)))")
+
+    def test_workers_share_one_spool(self):
+        import subprocess, sys, json
+        spool = self.src / "spool"
+        spool.mkdir()
+        (spool / "doc.md").write_text("# From a file\n")
+        for i in range(8):
+            (spool / f"job{i}.job.json").write_text(json.dumps({"markdown": f"# Job {i}\n", "format": "docx", "output": f"out/job{i}.docx"}))
+        (spool / "file.job.json").write_text(json.dumps({"input": "doc.md", "format": "docx"}))
+        (spool / "broken.job.json").write_text(json.dumps({"input": "missing.md", "format": "docx"}))
+
+        here = str(Path(__file__).resolve().parent)
+        workers = [subprocess.Popen([sys.executable, "-c", self.WORKER, str(spool)], cwd=here, stdout=subprocess.PIPE, text=True) for _ in range(3)]
+        counts = [int(w.communicate(timeout=60)[0].split()[-1]) for w in workers]
+
+        self.assertEqual(sum(counts), 10) # Every job claimed exactly once
+        self.assertEqual(sorted(p.name for p in spool.glob("*.error.json")), ["broken.error.json"])
+        self.assertEqual(len(list(spool.glob("*.result.json"))), 9)
+        self.assertEqual(list(spool.glob("*.claimed")) + list(spool.glob("*.job.json")), [])
+        self.assertTrue((spool / "out" / "job7.docx").read_bytes().endswith(b"# Job 7\n"))
+        self.assertTrue((spool / "file.docx").read_bytes().endswith(b"# From a file\n"))
+        record = json.loads((spool / "job0.result.json").read_text())
+        self.assertEqual((record["status"], record["job"]), ("ok", "job0"))
+
+    def test_stale_claims_are_put_back(self):
+        import md_to_pdf_tui as m
+        stale = self.src / "a.job.json.host-1.claimed"
+        fresh = self.src / "b.job.json.host-2.claimed"
+        stale.write_text("{}")
+        fresh.write_text("{}")
+        os.utime(stale, (time.time() - 600, time.time() - 600))
+        self.assertEqual(m._reclaim_stale_spool_jobs(self.src, 300), 1)
+        self.assertTrue((self.src / "a.job.json").exists())
+        self.assertTrue(fresh.exists())
+        self.assertEqual(m._claim_spool_job(self.src, "me"), self.src / "a.job.json.me.claimed")
+        self.assertIsNone(m._claim_spool_job(self.src, "me"))
+
+    def test_staleness_uses_the_spool_clock(self):
+        import md_to_pdf_tui as m
+        from unittest import mock
+        now = time.time()
+        stale = self.src / "a.job.json.host-1.claimed"
+        fresh = self.src / "b.job.json.host-2.claimed"
+        stale.write_text("{}")
+        fresh.write_text("{}")
+        os.utime(stale, (now - 400, now - 400))
+        # This host's clock runs 20 minutes ahead of the file server: the fresh
+        # claim still counts as fresh, and the stale one is judged by server time
+        with mock.patch("time.time", return_value=now + 1200):
+            self.assertEqual(m._reclaim_stale_spool_jobs(self.src, 300), 1)
+        self.assertTrue((self.src / "a.job.json").exists())
+        self.assertTrue(fresh.exists())
+        self.assertEqual([p.name for p in self.src.glob(".clock.*")], [])
+
+    def _run_worker(self, fake_job, **settings):
+        import md_to_pdf_tui as m
+        from unittest import mock
+        (self.src / "a.job.json").write_text("{}")
+        logs = []
+        settings = {"prewarm_browser": False, **settings}
+        with mock.patch.object(m, "run_spool_job", fake_job):
+            count = asyncio.run(m.run_spool_worker(self.src, settings, log_fn=logs.append, drain=True))
+        return count, logs
+
+    def test_lost_claim_aborts_the_job(self):
+        cancelled = []
+        async def fake_job(claimed, settings, log_fn=None, browser=None):
+            # Another worker put the claim back and took the job over
+            os.rename(claimed, claimed.with_name("a.job.json.other.claimed"))
+            try:
+                await asyncio.sleep(5)
+            except asyncio.CancelledError:
+                cancelled.append(claimed.name)
+                raise
+            return {"status": "ok"}
+
+        started = time.perf_counter()
+        count, logs = self._run_worker(fake_job, spool_heartbeat=0.02)
+        self.assertLess(time.perf_counter() - started, 2)
+        self.assertEqual(count, 0)
+        self.assertEqual(len(cancelled), 1)
+        self.assertTrue(any("claim lost" in line for line in logs))
+        self.assertEqual(list(self.src.glob("a.*.json")), [])
+        self.assertTrue((self.src / "a.job.json.other.claimed").exists())
+
+    def test_claim_lost_before_the_result_is_written(self):
+        async def fake_job(claimed, settings, log_fn=None, browser=None):
+            os.rename(claimed, claimed.with_name("a.job.json.other.claimed"))
+            return {"status": "ok"}
+
+        count, logs = self._run_worker(fake_job)
+        self.assertEqual(count, 0)
+        self.assertTrue(any("claim lost" in line for line in logs))
+        self.assertEqual(list(self.src.glob("a.*.json")) + list(self.src.glob("*.done")), [])
+
+class TestMemoryBenchmark(unittest.TestCase):
+    FAKE_PANDOC = TestDocxPipeline.FAKE_PANDOC
+    setUp, tearDown = TestDocxPipeline.setUp, TestDocxPipeline.tearDown
+    DOC = "".join(f"## Section {i}\n\nSome *text* with `code`.\n\n| a | b |\n|---|---|\n| {i} | x |\n\n> [!NOTE]\n> Note {i}\n\n" for i in range(300))
+
+    def test_reports_stage_peaks_and_budget_overruns(self):
+        import md_to_pdf_tui as m
+        md_path = self.src / "doc.md"
+        (self.src / "pic.png").write_bytes(b"PNG")
+        md_path.write_text(self.DOC[:2000] + "\n![pic](pic.png)\n")
+        budgets = {"parse": 0.001, "rss": 10_000}
+        [report] = asyncio.run(m.memory_benchmark([md_path], "docx", {"pandoc_server": False}, budgets, log_fn=None))
+        self.assertEqual(list(report["stages"]), ["read", "resources", "parse", "html", "render"])
+        self.assertGreater(report["stages"]["resources"], 0)
+        self.assertEqual(report["python_peak"], max(report["stages"].values()))
+        self.assertIsNotNone(report["rss_peak"]) # pandoc ran as a child process
+        self.assertEqual(len(report["violations"]), 1)
+        self.assertTrue(report["violations"][0].startswith("parse: "))
+
+    def test_memory_budgets_per_byte_of_input(self):
+        # Regression guard: token stream and HTML stay within fixed multiples of the input
+        import md_to_pdf_tui as m
+        with m.MemoryProfiler() as profiler:
+            with m._DOC_CACHE_LOCK:
+                m._DOC_CACHE.clear()
+            with profiler.stage("parse"):
+                parse_document(self.DOC)
+            with profiler.stage("html"):
+                create_html_content(self.DOC, {})
+        self.assertLess(profiler.stages["parse"], 250 * len(self.DOC))
+        self.assertLess(profiler.stages["html"], 25 * len(self.DOC))
+
+@unittest.skipUnless(HAS_PIKEPDF, "pikepdf not installed")
+class TestPdfOptimize(unittest.TestCase):
+    @staticmethod
+    def make_pdf(pages=3):
+        # Every page carries its own copy of the same photo-like image, as a
+        # theme background or logo repeated per page would
+        import pikepdf, zlib, random
+        rng = random.Random(0)
+        raw = bytes((x * 2 + y + rng.randrange(8)) % 256 for y in range(96) for x in range(96) for _ in range(3))
+        pdf = pikepdf.new()
+        for _ in range(pages):
+            image = pikepdf.Stream(pdf, zlib.compress(raw), Type=pikepdf.Name.XObject, Subtype=pikepdf.Name.Image,
+                                   Width=96, Height=96, ColorSpace=pikepdf.Name.DeviceRGB, BitsPerComponent=8,
+                                   Filter=pikepdf.Name.FlateDecode)
+            page = pdf.add_blank_page(page_size=(200, 200))
+            page.Resources = pikepdf.Dictionary(XObject=pikepdf.Dictionary(Im0=image))
+            page.Contents = pdf.make_stream(b"q 96 0 0 96 10 10 cm /Im0 Do Q")
+        buf = io.BytesIO()
+        pdf.save(buf)
+        return buf.getvalue()
+
+    def test_dedupes_recompresses_and_linearizes(self):
+        import pikepdf
+        data = self.make_pdf()
+        optimized, stats = optimize_pdf(data, quality=60)
+        # Two image copies and two content streams
+        self.assertEqual(stats["deduplicated"], 4)
+        self.assertEqual(stats["recompressed"], 1)
+        self.assertLess(len(optimized), len(data) / 2)
+        with pikepdf.open(io.BytesIO(optimized)) as pdf:
+            self.assertTrue(pdf.is_linearized)
+            images = {page.Resources.XObject.Im0.objgen for page in pdf.pages}
+            self.assertEqual(len(images), 1)
+            self.assertEqual(pdf.pages[0].Resources.XObject.Im0.Filter, pikepdf.Name.DCTDecode)
+            self.assertEqual(pdf.pages[2].Contents.read_bytes(), b"q 96 0 0 96 10 10 cm /Im0 Do Q")
+
+    def test_alpha_masks_keep_their_images_apart(self):
+        import pikepdf
+        import md_to_pdf_tui as m
+        raw = bytes(range(256)) * 108
+        masks = [bytes(64) + bytes([k]) * (96 * 96 - 64) for k in (0, 255, 0)]
+        pdf = pikepdf.new()
+        for mask in masks:
+            # Same pixels on every page; masks 0 and 2 match, mask 1 differs only
+            # after the bytes pikepdf's repr shows
+            smask = pikepdf.Stream(pdf, mask, Type=pikepdf.Name.XObject, Subtype=pikepdf.Name.Image,
+                                   Width=96, Height=96, ColorSpace=pikepdf.Name.DeviceGray, BitsPerComponent=8)
+            image = pikepdf.Stream(pdf, raw, Type=pikepdf.Name.XObject, Subtype=pikepdf.Name.Image,
+                                   Width=96, Height=96, ColorSpace=pikepdf.Name.DeviceRGB, BitsPerComponent=8, SMask=smask)
+            page = pdf.add_blank_page(page_size=(200, 200))
+            page.Resources = pikepdf.Dictionary(XObject=pikepdf.Dictionary(Im0=image))
+        third = pdf.pages[2].Resources.XObject.Im0
+        third = {third.objgen, third.SMask.objgen}
+        merged = m._dedupe_pdf_streams(pdf)
+        images = [page.Resources.XObject.Im0 for page in pdf.pages]
+        self.assertEqual(images[0].objgen, images[2].objgen)
+        self.assertNotEqual(images[0].objgen, images[1].objgen)
+        self.assertEqual([image.SMask.read_bytes() for image in images], masks)
+        # Page 3's mask merges first, then its image in the next round
+        self.assertLessEqual(third, merged)
+
+    def test_recompression_keeps_icc_profiles(self):
+        import pikepdf, zlib
+        from PIL import ImageCms
+        profile = ImageCms.ImageCmsProfile(ImageCms.createProfile("sRGB")).tobytes()
+        data = self.make_pdf(pages=1)
+        with pikepdf.open(io.BytesIO(data)) as pdf:
+            image = pdf.pages[0].Resources.XObject.Im0
+            icc = pikepdf.Stream(pdf, zlib.compress(profile), N=3, Filter=pikepdf.Name.FlateDecode)
+            image.ColorSpace = pikepdf.Array([pikepdf.Name.ICCBased, icc])
+            buf = io.BytesIO()
+            pdf.save(buf)
+        optimized, stats = optimize_pdf(buf.getvalue(), quality=60)
+        self.assertEqual(stats["recompressed"], 1)
+        with pikepdf.open(io.BytesIO(optimized)) as pdf:
+            image = pdf.pages[0].Resources.XObject.Im0
+            self.assertEqual(image.Filter, pikepdf.Name.DCTDecode)
+            self.assertEqual(image.ColorSpace[0], pikepdf.Name.ICCBased)
+            self.assertEqual(image.ColorSpace[1].read_bytes(), profile)
+
+    def test_batch_writes_optimized_output(self):
+        from unittest import mock
+        import md_to_pdf_tui as m
+        import pikepdf
+        data = self.make_pdf()
+
+        async def fake_render(md_text, output, settings, *args, **kwargs):
+            self.assertIsNone(output) # Bytes are handed to the optimize stage
+            self.assertFalse(settings["pdf_optimize"])
+            return data
+
+        with tempfile.TemporaryDirectory() as tmp:
+            md_path = Path(tmp) / "doc.md"
+            md_path.write_text("# Doc\n")
+            settings = {"pdf_optimize": True, "cpu_executor": "thread"}
+            with mock.patch.object(m, "render_pdf", fake_render):
+                results = asyncio.run(m.convert_batch([md_path], "pdf", settings, log_fn=None))
+            self.assertIsNone(results[0][2])
+            with pikepdf.open(Path(tmp) / "doc.pdf") as pdf:
+                self.assertTrue(pdf.is_linearized)
+
+class TestLinearScanners(unittest.TestCase):
+    # Adversarial inputs that drove the old regex scanners quadratic
+    CORPUS = {
+        "unclosed image alt": ("md", lambda n: "![" * n + "]" + " " * n),
+        "image titles without close": ("md", lambda n: "![](a '" * n),
+        "image urls without close": ("md", lambda n: "![a](b " * n),
+        "image urls without stop": ("md", lambda n: "![a](" * n),
+        "img tags without >": ("html", lambda n: "<img " * n),
+        "img unterminated quotes": ("html", lambda n: "<img a='" * n),
+        "img quote swallowing tags": ("html", lambda n: '<img a="' + "<img b='x' " * n),
+        "diagram escaped quotes": ("mermaid", lambda n: '"' + "\\'" * n),
+        "diagram unterminated quotes": ("mermaid", lambda n: "'" + "a" * n + '"x' * n),
+        "diagram blank runs": ("mermaid", lambda n: '"' + " \n" * n + 'x"'),
+        "document of image openers": ("resources", lambda n: "![" * n + "<img " * n + "]"),
+    }
+
+    def scan(self, kind, text):
+        import md_to_pdf_tui as m
+        if kind == "md":
+            return m._scan_md_images(text)
+        if kind == "html":
+            return m._scan_html_images(text)
+        if kind == "mermaid":
+            return sanitize_mermaid_code(text)
+        return process_resources(text, Path(tempfile.gettempdir()))
+
+    def timed(self, kind, text):
+        best = float("inf")
+        for _ in range(3):
+            started = time.perf_counter()
+            self.scan(kind, text)
+            best = min(best, time.perf_counter() - started)
+        return best
+
+    def test_scan_time_scales_linearly(self):
+        for name, (kind, make) in self.CORPUS.items():
+            with self.subTest(name):
+                small, large = self.timed(kind, make(2000)), self.timed(kind, make(8000))
+                # 4x the input: linear costs ~4x, quadratic ~16x
+                self.assertLess(large, 8 * small + 0.005)
+                self.assertLess(large, 1.0)
+
+    def test_scanners_find_well_formed_images(self):
+        import md_to_pdf_tui as m
+        text = '![a](x.png "Title") ![b]( y.png )\n<img alt="1 > 0" data-src="no" src="z.png"/>'
+        self.assertEqual([(alt, url) for _, _, alt, url in m._scan_md_images(text)], [("a", "x.png"), ("b", "y.png")])
+        self.assertEqual([url for _, _, url in m._scan_html_images(text)], ["z.png"])
+        # Unquoted values, junk attributes and nested tags are not images
+        for junk in ("<img src=<img>", "<img src=![a](b.png)>", "<img ] src=a>", "<img <img src=x >", "<img src=\"it's.png\">"):
+            with self.subTest(junk):
+                self.assertEqual(m._scan_html_images(junk), [])
+        self.assertEqual([url for _, _, url in m._scan_html_images('<img <img src="x.png">')], ["x.png"])
+        self.assertEqual(m._scan_md_images('![a](x.png "open\n")'), [])
+        self.assertEqual(sanitize_mermaid_code('A["\\"- x"] --> B[\'\n\n1. y\']'), 'A["\\"- x"] --> B[\'\n\n1.&#8203; y\']')
+
+class TestRequestFilter(unittest.TestCase):
+    class FakeRoute:
+        def __init__(self, url):
+            self.request = type("Request", (), {"url": url})()
+            self.outcome = None
+
+        async def continue_(self):
+            self.outcome = "continue"
+
+        async def abort(self, error_code=None):
+            self.outcome = "abort"
+
+    def outcome(self, url):
+        route = self.FakeRoute(url)
+        asyncio.run(_make_request_filter({"cdn.jsdelivr.net"})(route))
+        return route.outcome
+
+    def test_local_and_allowlisted_requests_pass(self):
+        self.assertEqual(self.outcome("file:///tmp/image.png"), "continue")
+        self.assertEqual(self.outcome("data:image/png;base64,AAAA"), "continue")
+        self.assertEqual(self.outcome("https://cdn.jsdelivr.net/npm/mermaid@11.4.1/dist/mermaid.min.js"), "continue")
+
+    def test_other_hosts_are_aborted(self):
+        self.assertEqual(self.outcome("https://unreachable.example/logo.png"), "abort")
+        self.assertEqual(self.outcome("http://cdn.jsdelivr.net.evil.example/x.js"), "abort")
+
+class TestPrerenderedDiagrams(unittest.TestCase):
+    DOC = "# Doc\n\n```mermaid\ngraph TD\nA --> B\n```\n\n```mermaid\ngraph LR\nC --> D\n```\n"
+
+    def test_all_inlined_drops_runtime(self):
+        svgs = {0: "<svg id='one'></svg>", 1: "<svg id='two'></svg>"}
+        html = create_html_content(self.DOC, {}, diagram_svgs=svgs)
+        self.assertIn('<div class="mermaid" data-processed="true"><svg id=\'one\'></svg></div>', html)
+        self.assertIn("<svg id='two'></svg>", html)
+        self.assertNotIn("<script", html)
+
+    def test_partial_inlining_keeps_runtime(self):
+        html = create_html_content(self.DOC, {}, diagram_svgs={0: "<svg id='one'></svg>"})
+        self.assertIn("<svg id='one'></svg>", html)
+        self.assertIn("mermaid.initialize", html)
+
+    def test_incremental_renderer_tracks_svg_changes(self):
+        renderer = IncrementalRenderer()
+        first = renderer.render(parse_document(self.DOC), True, {0: "<svg>a</svg>", 1: "<svg>b</svg>"})
+        second = renderer.render(parse_document(self.DOC), True, {0: "<svg>c</svg>", 1: "<svg>b</svg>"})
+        self.assertIn("<svg>a</svg>", first)
+        self.assertIn("<svg>c</svg>", second)
+        self.assertEqual(renderer.last_misses, 1)
+
+    def test_error_box_round_trip(self):
+        fragment = _mermaid_error_html("Parse error on line 2: <b>")
+        self.assertEqual(_mermaid_error_text(fragment), "Parse error on line 2: <b>")
+        self.assertIsNone(_mermaid_error_text("<svg></svg>"))
+
+class FakePage:
+    """Stands in for a Playwright page holding a loaded Mermaid bundle."""
+    def __init__(self, delay=0.05):
+        self.delay = delay
+        self.closed = False
+
+    async def route(self, pattern, handler): pass
+    async def set_content(self, html, **kwargs): pass
+    async def add_script_tag(self, **kwargs): pass
+    async def wait_for_function(self, *args, **kwargs): pass
+    async def close(self): self.closed = True
+
+    async def evaluate(self, script, args):
+        render_id, code, config = args
+        await asyncio.sleep(self.delay if "slow" not in code else 10)
+        if "bad" in code:
+            return {"error": "Parse error"}
+        labels = "<foreignObject></foreignObject>" if config["flowchart"]["htmlLabels"] else ""
+        return {"svg": f"<svg id='{render_id}'>{labels}{code}</svg>"}
+
+class FakeBrowser:
+    def __init__(self):
+        self.pages = []
+
+    async def new_page(self, **kwargs):
+        self.pages.append(FakePage())
+        return self.pages[-1]
+
+class FakeCapturePage:
+    """A 2x page with two diagrams; screenshots paint the clip red on white."""
+    BOXES = [{"x": 10, "y": 100, "width": 200, "height": 50}, {"x": 20, "y": 400, "width": 100, "height": 80}]
+
+    def __init__(self):
+        self.clips = []
+
+    async def evaluate(self, script):
+        return [2, 800] if "devicePixelRatio" in script else self.BOXES
+
+    async def screenshot(self, clip, full_page=False):
+        from PIL import Image
+        self.clips.append(clip)
+        buf = io.BytesIO()
+        Image.new("RGB", (clip["width"] * 2, clip["height"] * 2), "white").save(buf, "PNG")
+        return buf.getvalue()
+
+class TestCaptureDiagrams(unittest.TestCase):
+    def test_bands_skip_gaps_and_split_tall_pages(self):
+        boxes = [{"y": 0, "height": 100}, {"y": 150, "height": 100}, {"y": 5000, "height": 9000}]
+        self.assertEqual(_plan_capture_bands(boxes, 4096), [(0, 250, [0, 1]), (5000, 14000, [2])])
+
+    def test_single_capture_crops_every_diagram(self):
+        from PIL import Image
+        page = FakeCapturePage()
+        with tempfile.TemporaryDirectory() as tmp:
+            paths = asyncio.run(capture_diagrams(page, lambda i: Path(tmp) / f"d{i}.png"))
+            sizes = [Image.open(p).size for p in paths]
+        self.assertEqual(len(page.clips), 1)
+        self.assertEqual(sizes, [(400, 100), (200, 160)])
+
+    def test_skipped_diagrams_are_not_captured(self):
+        page = FakeCapturePage()
+        with tempfile.TemporaryDirectory() as tmp:
+            paths = asyncio.run(capture_diagrams(page, lambda i: Path(tmp) / f"d{i}.png" if i else None))
+            self.assertEqual([p and p.name for p in paths], [None, "d1.png"])
+            self.assertEqual(os.listdir(tmp), ["d1.png"])
+        self.assertEqual(page.clips[0]["y"], 400)
+
+class TestMermaidRendererShards(unittest.TestCase):
+    def test_renders_concurrently_across_pages(self):
+        async def run():
+            renderer = MermaidRenderer(FakeBrowser(), pages=4)
+            await renderer.start()
+            started = time.perf_counter()
+            svgs = await asyncio.gather(*(renderer.render(f"graph TD\nA{i} --> B", "Dracula") for i in range(8)))
+            return svgs, time.perf_counter() - started
+        svgs, elapsed = asyncio.run(run())
+        self.assertEqual(len(svgs), 8)
+        self.assertTrue(all(svg.startswith("<svg") for svg in svgs))
+        # 8 diagrams x 50ms on 4 shards: two rounds, not eight
+        self.assertLess(elapsed, 0.3)
+
+    def test_errors_and_timeouts(self):
+        async def run():
+            browser = FakeBrowser()
+            renderer = MermaidRenderer(browser, pages=1)
+            with self.assertRaises(ValueError):
+                await renderer.render("bad", "Nordic")
+            with self.assertRaises(asyncio.TimeoutError):
+                await renderer.render("slow", "Nordic", timeout=0.05)
+            # The stuck page is replaced and the pool keeps working
+            self.assertTrue(browser.pages[0].closed)
+            self.assertEqual(renderer.size, 1)
+            return await renderer.render("graph TD\nA --> B", "Nordic")
+        self.assertIn("<svg", asyncio.run(run()))
+
+    def test_failed_replacement_shrinks_pool(self):
+        class FlakyBrowser(FakeBrowser):
+            fail = False
+            async def new_page(self, **kwargs):
+                if self.fail:
+                    raise RuntimeError("browser closed")
+                return await super().new_page(**kwargs)
+
+        async def run():
+            browser = FlakyBrowser()
+            renderer = MermaidRenderer(browser, pages=2)
+            await renderer.start()
+            browser.fail = True
+            with self.assertRaises(asyncio.TimeoutError):
+                await renderer.render("slow", "Nordic", timeout=0.05)
+            self.assertEqual(renderer.size, 1)
+            self.assertIn("<svg", await renderer.render("graph TD\nA --> B", "Nordic"))
+            # Losing the last page fails the waiting renders instead of hanging them
+            waiting = asyncio.ensure_future(renderer.render("graph TD\nC --> D", "Nordic"))
+            with self.assertRaises(asyncio.TimeoutError):
+                await renderer.render("slow", "Nordic", timeout=0.05)
+            with self.assertRaises(RuntimeError):
+                await asyncio.wait_for(waiting, 1)
+            self.assertEqual(renderer.size, 0)
+            # Once pages open again, the pool recovers
+            browser.fail = False
+            self.assertIn("<svg", await renderer.render("graph TD\nA --> B", "Nordic"))
+            self.assertEqual(renderer.size, 1)
+        asyncio.run(run())
+
+    def test_timeouts_scale_with_diagrams(self):
+        small = "graph TD\nA --> B"
+        large = "graph TD\n" + "\n".join(f"N{i} --> N{i+1}" for i in range(500))
+        self.assertGreater(_diagram_timeout_ms(large), _diagram_timeout_ms(small))
+        self.assertEqual(_diagrams_timeout_ms([small]), 10000)
+        self.assertGreater(_diagrams_timeout_ms([large] * 100), 10000)
+        self.assertLess(_diagrams_timeout_ms([large] * 100, shards=4), _diagrams_timeout_ms([large] * 100))
+
+class TestPrewarmBrowser(unittest.TestCase):
+    def test_warms_page_and_mermaid_worker(self):
+        import md_to_pdf_tui as m
+        browser = FakeBrowser()
+        saved = m._browser_instance, m._mermaid_renderer, m._mermaid_renderer_lock
+        m._browser_instance, m._mermaid_renderer, m._mermaid_renderer_lock = browser, None, None
+        try:
+            asyncio.run(m.prewarm_browser({}))
+            self.assertIs(m._mermaid_renderer.browser, browser)
+            # The scratch page is closed again; the worker keeps its own page open
+            self.assertEqual([p.closed for p in browser.pages], [True, False])
+        finally:
+            m._browser_instance, m._mermaid_renderer, m._mermaid_renderer_lock = saved
+
+class TestCpuExecutor(unittest.TestCase):
+    DOC = "".join(f"## Section {i}\n\nSome *text* with `code` and a [link](http://x/{i}).\n\n| a | b |\n|---|---|\n| {i} | x |\n\n" for i in range(2000))
+
+    def test_html_generation_does_not_block_the_loop(self):
+        settings = {"cpu_executor": "thread", "mermaid_enabled": True}
+
+        async def run():
+            gaps, done = [], asyncio.Event()
+            async def heartbeat():
+                last = time.perf_counter()
+                while not done.is_set():
+                    await asyncio.sleep(0.005)
+                    now = time.perf_counter()
+                    gaps.append(now - last)
+                    last = now
+            beat = asyncio.create_task(heartbeat())
+            started = time.perf_counter()
+            html = await run_cpu(create_html_content, self.DOC, settings, None, None, settings=settings)
+            elapsed = time.perf_counter() - started
+            done.set()
+            await beat
+            return html, elapsed, max(gaps)
+
+        html, elapsed, worst_gap = asyncio.run(run())
+        self.assertIn("Section 1999", html)
+        # The loop keeps ticking while the document renders on the pool
+        self.assertLess(worst_gap, max(0.1, elapsed / 4))
+
+    def test_process_pool_matches_inline(self):
+        settings = {"cpu_executor": "process"}
+        doc = "# Title\n\n```mermaid\ngraph TD\nA-->B\n```\n"
+        html = asyncio.run(run_cpu(create_html_content, doc, settings, settings=settings))
+        self.assertEqual(html, create_html_content(doc, settings))
+
+    def test_document_html_stays_next_to_the_parse_cache(self):
+        # A large document in process mode was parsed here for its diagrams; the
+        # HTML stage must not ship it to a cold spawn worker to parse it again.
+        import concurrent.futures
+        from unittest import mock
+        import md_to_pdf_tui
+        settings = {"cpu_executor": "auto", "process_pool_min_bytes": 1}
+        used = []
+        real = md_to_pdf_tui._cpu_executor
+        def spy(*args, **kwargs):
+            executor = real(*args, **kwargs)
+            used.append(executor)
+            return executor
+        parse_document(self.DOC)
+        with mock.patch.object(md_to_pdf_tui, "_cpu_executor", spy):
+            html = asyncio.run(md_to_pdf_tui._document_html(self.DOC, settings))
+        self.assertIn("Section 1999", html)
+        self.assertTrue(used)
+        self.assertFalse(any(isinstance(e, concurrent.futures.ProcessPoolExecutor) for e in used))
+
+class TestStartupImports(unittest.TestCase):
+    """Guards the lightweight headless start: a cold import must not pull in the heavy stack."""
+    HEAVY = ("textual", "rich_pixels", "PIL", "playwright", "markdown_it", "mdit_py_plugins", "urllib.request")
+    SCRIPT = (
+        "import sys, time, json; t = time.perf_counter(); import md_to_pdf_tui; "
+        "print(json.dumps([time.perf_counter() - t, sorted(m for m in %r if m in sys.modules)]))"
+    )
+
+    def test_cold_import(self):
+        import json, subprocess, sys
+        cwd = Path(__file__).resolve().parent
+        subprocess.run([sys.executable, "-c", "import md_to_pdf_tui"], cwd=cwd, check=True) # Warm the bytecode cache
+        out = subprocess.run([sys.executable, "-c", self.SCRIPT % (self.HEAVY,)], cwd=cwd, check=True, capture_output=True, text=True).stdout
+        elapsed, loaded = json.loads(out)
+        self.assertEqual(loaded, [])
+        self.assertLess(elapsed, 0.5)
+
 if __name__ == "__main__":
     unittest.main()